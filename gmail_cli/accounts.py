@@ -0,0 +1,191 @@
+import asyncio
+import json
+import multiprocessing
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .automate import EmailAutomation
+from .exceptions import ValidationError
+from .settings import EMAILS_DB_PATH, EMAIL_TABLE_NAME, TOKEN_FILE_PATH
+
+ACCOUNT_OPTIONS = {
+    'name': str,
+    'db_path': str,
+    'table_name': str,
+    'credentials_file_path': str,
+    'token_file_path': str,
+    'api_endpoint': str,
+    'workers': int,
+    'partitions': int,
+    'quota_per_second': int
+}
+
+
+def read_accounts(accounts_path):
+    '''
+    Read and validate a list of account configs from a JSON file.
+
+    Each account needs a unique `name` and may set any other option in
+    ACCOUNT_OPTIONS. Options left out fall back to the defaults of a
+    single account run.
+    Raises:
+        ValidationError: If the file or an account config is invalid.
+    '''
+    try:
+        with open(accounts_path, 'r') as f:
+            accounts = json.load(f)
+    except FileNotFoundError:
+        raise ValidationError('Accounts file not found', accounts_path)
+    except json.JSONDecodeError:
+        raise ValidationError('Invalid JSON in accounts file', accounts_path)
+
+    if not isinstance(accounts, list) or not accounts:
+        raise ValidationError('Accounts must be a non-empty list', accounts)
+
+    names = set()
+    for account in accounts:
+        if not isinstance(account, dict):
+            raise ValidationError('Account must be an object', account)
+
+        name = account.get('name')
+        if not name:
+            raise ValidationError('Account name is required', account)
+        if name in names:
+            raise ValidationError(f'Duplicate account name: {name}', account)
+        names.add(name)
+
+        for option, value in account.items():
+            if option not in ACCOUNT_OPTIONS:
+                raise ValidationError(
+                    f'Invalid account option: {option}', account)
+            if not isinstance(value, ACCOUNT_OPTIONS[option]):
+                raise ValidationError(
+                    f'Invalid value for account option: {option}', account)
+
+    return accounts
+
+
+def run_account(
+    schema_path,
+    account,
+    force_retrieve=False,
+    search=False,
+    use_async=False
+):
+    '''
+    Run the automation rules on one account.
+
+    Runs in a worker process of run_accounts, so that every account has
+    its own Gmail client, rate limiter and database connections.
+    Returns:
+        dict: The summary of the run. Errors are reported in the summary
+        rather than raised, so that one account failing does not stop
+        the others.
+    '''
+    options = {
+        option: value for option, value in account.items()
+        if option != 'name'
+    }
+    started_at = time.monotonic()
+    result = {
+        'account': account['name'],
+        'status': 'ok',
+        'emails': 0,
+        'modified': 0,
+        'seconds': 0.0,
+        'error': ''
+    }
+    automation = None
+    try:
+        automation = EmailAutomation(schema_path, **options)
+        if use_async:
+            summary = asyncio.run(automation.run_async(
+                force_retrieve=force_retrieve, search=search))
+        else:
+            summary = automation.run(
+                force_retrieve=force_retrieve, search=search)
+
+        result['emails'] = len(automation.db_helper.fetch_message_ids())
+        result['modified'] = summary['modified']
+        if not summary['success']:
+            result['status'] = 'partial'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    finally:
+        if automation is not None:
+            automation.db_helper.close()
+
+    result['seconds'] = round(time.monotonic() - started_at, 2)
+    return result
+
+
+def run_accounts(schema_path, accounts, processes=0, **options):
+    '''
+    Run the automation rules on several accounts in parallel, one
+    process per account.
+
+    Every account is rate limited on its own, like the per-user Gmail
+    quota, so the run takes about as long as the slowest account.
+    Args:
+        accounts (list): The account configs, as read by read_accounts.
+        processes (int): The most accounts run at once. Defaults to all
+        of them.
+        options: The arguments of run_account shared by every account.
+    Returns:
+        list: The summary of each account, in input order.
+    Raises:
+        ValidationError: If two accounts would share a table, or a
+        token and so a mailbox.
+    '''
+    tables = {}
+    mailboxes = {}
+    for account in accounts:
+        table = (
+            account.get('db_path') or EMAILS_DB_PATH,
+            account.get('table_name') or EMAIL_TABLE_NAME
+        )
+        if table in tables:
+            raise ValidationError(
+                f'Accounts {tables[table]} and {account["name"]} '
+                'share a database table', table)
+        tables[table] = account['name']
+
+        mailbox = (
+            account.get('api_endpoint') or '',
+            account.get('token_file_path') or TOKEN_FILE_PATH
+        )
+        if mailbox in mailboxes:
+            raise ValidationError(
+                f'Accounts {mailboxes[mailbox]} and {account["name"]} '
+                'share a token file', mailbox)
+        mailboxes[mailbox] = account['name']
+
+    # Spawned workers share no open connections or locks with this process
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(
+        max_workers=processes or len(accounts),
+        mp_context=context
+    ) as executor:
+        futures = [
+            executor.submit(run_account, schema_path, account, **options)
+            for account in accounts
+        ]
+
+        results = []
+        for account, future in zip(accounts, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # The worker process died before it could report
+                results.append({
+                    'account': account['name'],
+                    'status': 'failed',
+                    'emails': 0,
+                    'modified': 0,
+                    'seconds': 0.0,
+                    'error': str(e)
+                })
+
+    return results
@@ -0,0 +1,128 @@
+import asyncio
+
+from collections import defaultdict
+
+
+class ActionExecutor:
+    '''
+    Collect the label changes of rule actions and apply them together.
+
+    Emails that end up with the same labels added and removed are
+    modified with a single batchModify request per 1000 emails.
+
+    Given a database helper, the labels are recorded in the database once
+    modified. Once the database is synced with Gmail,
+    drop_applied_changes drops the changes Gmail already has, such as
+    marking a read email as read.
+    '''
+    def __init__(
+        self,
+        gmail_client,
+        label_directory=None,
+        db_helper=None
+    ) -> None:
+        self.gmail_client = gmail_client
+        self.label_directory = label_directory or gmail_client.label_directory
+        self.db_helper = db_helper
+        self.label_changes = defaultdict(dict)
+
+    def add(self, message_id, action):
+        '''
+        Queue an action to be performed on an email.
+        '''
+        action_type = action['action']
+        if action_type == 'mark_as_read':
+            self.label_changes[message_id]['UNREAD'] = False
+        elif action_type == 'mark_as_unread':
+            self.label_changes[message_id]['UNREAD'] = True
+        elif action_type == 'move_to_mailbox':
+            label_id = self.label_directory.get_label_id(action['mailbox'])
+            self.label_changes[message_id][label_id] = True
+        else:
+            raise ValueError('Invalid action type')
+
+    def drop_applied_changes(self):
+        '''
+        Drop the queued label changes whose target state the database
+        knows the emails already have. Only call it right after a sync,
+        as the labels in the database miss changes made in Gmail since.
+        '''
+        if self.db_helper is None or not self.label_changes:
+            return
+
+        states = self.db_helper.fetch_label_states(list(self.label_changes))
+        for message_id, (known, labels) in states.items():
+            changes = self.label_changes[message_id]
+            for label_id, add in list(changes.items()):
+                # Labels missing from an email with known labels are absent
+                if labels.get(label_id, False if known else None) == add:
+                    del changes[label_id]
+            if not changes:
+                del self.label_changes[message_id]
+
+    def _record_label_changes(self, group, message_ids):
+        if self.db_helper is not None:
+            add_label_ids, remove_label_ids = group
+            self.db_helper.update_message_labels(
+                message_ids, add_label_ids, remove_label_ids)
+
+    def group_label_changes(self):
+        '''
+        Group the queued emails by the labels to add and remove.
+        Returns:
+            dict: Lists of message ids keyed by a tuple of the label ids
+            to add and the label ids to remove.
+        '''
+        groups = defaultdict(list)
+        for message_id, changes in self.label_changes.items():
+            add_label_ids = tuple(sorted(
+                label_id for label_id, add in changes.items() if add))
+            remove_label_ids = tuple(sorted(
+                label_id for label_id, add in changes.items() if not add))
+            groups[(add_label_ids, remove_label_ids)].append(message_id)
+        return groups
+
+    def flush(self):
+        '''
+        Apply the queued actions.
+        Returns:
+            bool: True if every request succeeded.
+        '''
+        success = True
+        groups = self.group_label_changes()
+        for group, message_ids in groups.items():
+            add_label_ids, remove_label_ids = group
+            modified = self.gmail_client.batch_modify(
+                message_ids,
+                add_label_ids=list(add_label_ids),
+                remove_label_ids=list(remove_label_ids)
+            )
+            if modified:
+                self._record_label_changes(group, message_ids)
+            success &= modified
+
+        self.label_changes.clear()
+        return success
+
+    async def flush_async(self, async_client):
+        '''
+        Apply the queued actions through an AsyncGmailClient, sending the
+        requests of every group concurrently.
+        Returns:
+            bool: True if every request succeeded.
+        '''
+        groups = self.group_label_changes()
+        self.label_changes.clear()
+        results = await asyncio.gather(*(
+            async_client.batch_modify(
+                message_ids,
+                add_label_ids=list(add_label_ids),
+                remove_label_ids=list(remove_label_ids)
+            )
+            for (add_label_ids, remove_label_ids), message_ids
+            in groups.items()
+        ))
+        for (group, message_ids), modified in zip(groups.items(), results):
+            if modified:
+                self._record_label_changes(group, message_ids)
+        return all(results)
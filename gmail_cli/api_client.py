@@ -1,28 +1,153 @@
+import base64
+import html
+import httplib2
+import queue
+import re
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urljoin
+
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+from .settings import (
+    CREDENTIALS_FILE_PATH,
+    TOKEN_FILE_PATH,
+    GMAIL_SCOPES,
+    GMAIL_API_ENDPOINT,
+    TOKEN_REFRESH_MARGIN,
+    HTTP_TIMEOUT,
+    GMAIL_BATCH_SIZE,
+    FETCH_WORKERS,
+    GMAIL_QUOTA_PER_SECOND,
+    LIST_PARTITIONS
+)
+from .exceptions import CredentialsFileNotFound, HistoryExpired
+from .labels import LabelDirectory
+from .query import partition_queries
+from .rate_limit import QUOTA_UNITS, RequestScheduler, is_retryable_error
 
+MAX_BATCH_SIZE = 100  # Gmail rejects batches with more sub-requests
+MAX_BATCH_MODIFY_SIZE = 1000  # Most ids a batchModify request accepts
 
-from .settings import CREDENTIALS_FILE_PATH, TOKEN_FILE_PATH, GMAIL_SCOPES
-from .exceptions import CredentialsFileNotFound
+# Message headers we store, keyed by their lowercase name
+EMAIL_HEADERS = frozenset(['subject', 'date', 'from', 'to'])
+METADATA_HEADERS = ['Subject', 'Date', 'From', 'To']
+METADATA_FIELDS = 'id,labelIds,snippet,payload/headers'
+HTML_TAG = re.compile(r'<[^>]+>')
+HISTORY_TYPES = [
+    'messageAdded',
+    'messageDeleted',
+    'labelAdded',
+    'labelRemoved'
+]
+
+
+def is_not_found_error(exception):
+    '''
+    Check whether a request failed because the resource does not exist.
+    '''
+    return isinstance(exception, HttpError) and exception.resp.status == 404
+
+
+def summarize_history(responses):
+    '''
+    Summarize the pages of a history.list response.
+    Returns:
+        dict: The latest history id, the ids of the messages added,
+        deleted and relabelled, and the labels of the relabelled
+        messages whose records carry them.
+    '''
+    changes = {}
+    labels_changed = set()
+    labels = {}
+    for response in responses:
+        for record in response.get('history', []):
+            for item in record.get('messagesAdded', []):
+                changes[item['message']['id']] = 'added'
+            for item in record.get('messagesDeleted', []):
+                changes[item['message']['id']] = 'deleted'
+            for key in ('labelsAdded', 'labelsRemoved'):
+                for item in record.get(key, []):
+                    message = item['message']
+                    labels_changed.add(message['id'])
+                    if 'labelIds' in message:
+                        # Records come oldest first
+                        labels[message['id']] = message['labelIds']
+
+    return {
+        'history_id': responses[-1]['historyId'],
+        'added': [
+            message_id for message_id, change in changes.items()
+            if change == 'added'
+        ],
+        'deleted': [
+            message_id for message_id, change in changes.items()
+            if change == 'deleted'
+        ],
+        'labels_changed': [
+            message_id for message_id in labels_changed
+            if changes.get(message_id) != 'deleted'
+        ],
+        'labels': {
+            message_id: label_ids for message_id, label_ids in labels.items()
+            if changes.get(message_id) != 'deleted'
+        }
+    }
 
 
 class GmailClient:
     '''
     A client to interact with the Gmail API.
+
+    Requests go to the Gmail API unless `api_endpoint` points the client
+    at another server, such as a local FakeGmailServer. Requests to
+    another endpoint are sent without credentials.
     '''
-    def __init__(self, credential_file_path='', token_file_path=''):
+    def __init__(
+        self,
+        credential_file_path='',
+        token_file_path='',
+        workers=0,
+        api_endpoint='',
+        partitions=0,
+        quota_per_second=0
+    ):
         self.credential_file_path = (
             credential_file_path or
             CREDENTIALS_FILE_PATH
         )
         self.token_file_path = token_file_path or TOKEN_FILE_PATH
+        self.api_endpoint = api_endpoint or GMAIL_API_ENDPOINT
+        self.workers = workers or FETCH_WORKERS
+        self.partitions = partitions or LIST_PARTITIONS
+        # One slot per worker, plus one per thread listing pages
+        self.scheduler = RequestScheduler(
+            quota_per_second=quota_per_second or GMAIL_QUOTA_PER_SECOND,
+            max_concurrency=self.workers + self.partitions
+        )
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._transports = []
+        self.label_directory = LabelDirectory(self)
 
     def authenticate(self):
         '''
         Authenticate using OAuth2 and return Credentials object.
         '''
+        if self.api_endpoint:
+            return AnonymousCredentials()
+
         credentials = None
         try:
             with open(self.credential_file_path, 'r') as token:
@@ -49,113 +174,490 @@ class GmailClient:
                         'Please provide a valid path to the credentials file.'
                     )
 
-            with open(self.token_file_path, 'w') as token:
-                token.write(credentials.to_json())
+            self._save_credentials(credentials)
 
         return credentials
 
+    def _save_credentials(self, credentials):
+        with open(self.token_file_path, 'w') as token:
+            token.write(credentials.to_json())
+
+    def _needs_refresh(self, credentials):
+        if not getattr(credentials, 'refresh_token', None):
+            return False
+        if not credentials.expiry:
+            return not credentials.valid
+
+        refresh_at = credentials.expiry - timedelta(
+            seconds=TOKEN_REFRESH_MARGIN)
+        return datetime.now(timezone.utc).replace(tzinfo=None) >= refresh_at
+
+    def get_credentials(self):
+        '''
+        Return the credentials of this session, refreshing them
+        ahead of expiry.
+        '''
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = self.authenticate()
+            elif self._needs_refresh(self._credentials):
+                self._credentials.refresh(Request())
+                self._save_credentials(self._credentials)
+
+            return self._credentials
+
     def get_service(self):
         '''
-        Create a Gmail service object.
+        Return the Gmail service object of this session for the
+        current thread.
+
+        The service is built once per thread from the static discovery
+        document. Each thread owns its authorized HTTP connection, as
+        httplib2 connections cannot be shared between threads.
         '''
-        credentials = self.authenticate()
-        return build('gmail', 'v1', credentials=credentials)
+        credentials = self.get_credentials()
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            http = AuthorizedHttp(
+                credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+            client_options = None
+            if self.api_endpoint:
+                client_options = {'api_endpoint': self.api_endpoint}
+            service = build(
+                'gmail',
+                'v1',
+                http=http,
+                cache_discovery=False,
+                static_discovery=True,
+                client_options=client_options
+            )
+            self._local.service = service
+            with self._lock:
+                self._transports.append(http)
 
-    def get_emails_from_messages(self, messages):
+        return service
+
+    def execute(self, request, method, count=1):
         '''
-        Get email information from messages.
+        Execute a request through the rate limiter of this session.
+        Args:
+            method (str): The API method of the request, which sets its
+            quota cost.
+            count (int): The number of calls a batch request makes.
         '''
+        return self.scheduler.execute(request, QUOTA_UNITS[method] * count)
+
+    def close(self):
+        '''
+        Close the HTTP connections held by this session.
+        '''
+        with self._lock:
+            transports, self._transports = self._transports, []
+            self._local = threading.local()
+
+        for http in transports:
+            http.close()
+
+    def _get_message_params(self, message_format):
+        if message_format == 'metadata':
+            return {
+                'format': 'metadata',
+                'metadataHeaders': METADATA_HEADERS,
+                'fields': METADATA_FIELDS
+            }
+        elif message_format == 'full':
+            return {'format': 'full'}
+        else:
+            raise ValueError(f'Invalid message format: {message_format}')
+
+    def _execute_batch(self, message_ids, results, failures, params):
         service = self.get_service()
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            else:
+                failures[request_id] = exception
+
+        if self.api_endpoint:
+            # The batch URI of the discovery document ignores the endpoint
+            batch = BatchHttpRequest(
+                callback=callback,
+                batch_uri=urljoin(self.api_endpoint, 'batch/gmail/v1')
+            )
+        else:
+            batch = service.new_batch_http_request(callback=callback)
+        for message_id in message_ids:
+            batch.add(
+                service.users().messages().get(
+                    userId='me',
+                    id=message_id,
+                    **params
+                ),
+                request_id=message_id
+            )
+        self.execute(batch, 'messages.get', len(message_ids))
+
+    def batch_get_messages(self, message_ids, message_format='metadata'):
+        '''
+        Get messages by id using batch requests.
+
+        Failed sub-requests are retried on their own with exponential
+        backoff. Messages that no longer exist are left out. Returns a
+        dictionary of message id to message.
+        '''
+        params = self._get_message_params(message_format)
+        batch_size = min(GMAIL_BATCH_SIZE, MAX_BATCH_SIZE)
+        pending = list(dict.fromkeys(message_ids))
+        results = {}
+        for attempt in range(self.scheduler.max_retries + 1):
+            if attempt:
+                self.scheduler.record_throttled()
+                self.scheduler.backoff(attempt - 1)
+
+            failures = {}
+            for start in range(0, len(pending), batch_size):
+                self._execute_batch(
+                    pending[start:start + batch_size],
+                    results,
+                    failures,
+                    params
+                )
+
+            pending = []
+            for message_id, exception in failures.items():
+                if is_retryable_error(exception):
+                    pending.append(message_id)
+                elif not is_not_found_error(exception):
+                    raise exception
+
+            if not pending:
+                break
+        else:
+            raise failures[pending[0]]
+
+        return results
+
+    def parse_email(self, msg):
+        '''
+        Build the email information of a message in a single pass over
+        its headers.
+        '''
+        email_info = {
+            'message_id': msg['id'],
+            'subject': None,
+            'snippet': msg.get('snippet', ''),
+            'date': None,
+            'from': None,
+            'to': None,
+            'label_ids': msg.get('labelIds')
+        }
+        for header in msg.get('payload', {}).get('headers', []):
+            name = header['name'].lower()
+            if name in EMAIL_HEADERS and email_info[name] is None:
+                email_info[name] = header['value']
+
+        return email_info
+
+    def _iter_text_parts(self, part):
+        if part.get('parts'):
+            for child in part['parts']:
+                yield from self._iter_text_parts(child)
+        elif part.get('body', {}).get('data'):
+            yield part.get('mimeType', ''), part['body']['data']
+
+    def parse_body(self, msg):
+        '''
+        Get the text of a full message, preferring its first plain text
+        part and falling back to its first HTML part with the tags
+        stripped.
+        '''
+        texts = {}
+        for mime_type, data in self._iter_text_parts(msg.get('payload', {})):
+            if mime_type in ('text/plain', 'text/html'):
+                texts.setdefault(mime_type, data)
+
+        if 'text/plain' in texts:
+            data = texts['text/plain']
+        elif 'text/html' in texts:
+            data = texts['text/html']
+        else:
+            return ''
+
+        text = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        text = text.decode('utf-8', errors='replace')
+        if 'text/plain' not in texts:
+            text = html.unescape(HTML_TAG.sub(' ', text))
+        return text
+
+    def get_message_bodies(self, message_ids):
+        '''
+        Fetch the bodies of messages.
+        Returns:
+            dict: The body text keyed by message id. Messages that no
+            longer exist are left out.
+        '''
+        fetched = self.batch_get_messages(message_ids, 'full')
+        return {
+            message_id: self.parse_body(msg)
+            for message_id, msg in fetched.items()
+        }
+
+    def get_emails_from_messages(self, messages, message_format='metadata'):
+        '''
+        Get email information from messages.
+        Args:
+            message_format (str): 'metadata' to fetch only the headers we
+            store, or 'full' to fetch the complete message.
+        '''
+        message_ids = [message['id'] for message in messages]
+        fetched = self.batch_get_messages(message_ids, message_format)
         emails = []
-        for message in messages:
-            message_id = message['id']
-            msg = service.users().messages().get(
-                userId='me',
-                id=message_id
-            ).execute()
-            payload = msg['payload']
-            headers = payload.get('headers', [])
-            subject = next(
-                (
-                    header['value'] for header in headers
-                    if header['name'] == 'Subject'
-                ), None)
-            date = next(
-                (
-                    header['value'] for header in headers
-                    if header['name'] == 'Date'
-                ), None)
-            sender = next(
-                (
-                    header['value'] for header in headers
-                    if header['name'] == 'From'
-                ), None)
-            recipient = next(
-                (
-                    header['value'] for header in headers
-                    if header['name'] == 'To'
-                ), None)
-            snippet = msg.get('snippet', '')
-
-            email_info = {
-                'message_id': message_id,
-                'subject': subject,
-                'snippet': snippet,
-                'date': date,
-                'from': sender,
-                'to': recipient
-            }
-            emails.append(email_info)
+        for message_id in message_ids:
+            msg = fetched.get(message_id)
+            if msg is None:
+                continue
+
+            emails.append(self.parse_email(msg))
         return emails
 
+    def list_message_pages(
+        self,
+        max_results=511,
+        page_token=None,
+        query=None
+    ):
+        '''
+        List the messages in the user's Gmail account, one page at a time.
+        Args:
+            page_token (str): The page to start listing from.
+            query (str): Only list the messages matching a Gmail search
+            query.
+        Yields:
+            tuple: The message ids and thread ids of a page, and the token
+            of the next page or None on the last page.
+        '''
+        service = self.get_service()
+        while True:
+            response = self.execute(service.users().messages().list(
+                userId='me',
+                maxResults=max_results,
+                pageToken=page_token,
+                q=query
+            ), 'messages.list')
+            page_token = response.get('nextPageToken')
+            yield response.get('messages', []), page_token
+
+            if not page_token:
+                break
+
+    def list_partition_pages(
+        self,
+        queries,
+        page_tokens=None,
+        max_results=511
+    ):
+        '''
+        List the messages matching several search queries in parallel,
+        one thread per query.
+        Args:
+            queries (list): The search queries, such as the date ranges of
+            partition_queries.
+            page_tokens (dict): The page to start listing each query from.
+        Yields:
+            tuple: The query, the messages of one of its pages that no
+            other page listed, and the token of its next page or None on
+            its last page. The pages of each query are yielded in order.
+        '''
+        page_tokens = page_tokens or {}
+        pages = queue.Queue(maxsize=len(queries))
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def list_pages(query):
+            try:
+                for messages, page_token in self.list_message_pages(
+                    max_results, page_tokens.get(query), query
+                ):
+                    if not put((query, messages, page_token)):
+                        return
+            except Exception as e:
+                put((query, e, None))
+            put((query, None, None))
+
+        seen_ids = set()
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            for query in queries:
+                executor.submit(list_pages, query)
+
+            try:
+                listing = len(queries)
+                while listing:
+                    query, messages, page_token = pages.get()
+                    if messages is None:
+                        listing -= 1
+                        continue
+                    if isinstance(messages, Exception):
+                        raise messages
+
+                    messages = [
+                        message for message in messages
+                        if message['id'] not in seen_ids
+                    ]
+                    seen_ids.update(message['id'] for message in messages)
+                    yield query, messages, page_token
+            finally:
+                stopped.set()
+
+    def list_messages(self, max_results=511):
+        '''
+        List the messages in the user's Gmail account, one page at a time.
+
+        With more than one partition, the date ranges of the mailbox are
+        listed in parallel and their pages are interleaved.
+        Yields:
+            list: The message ids and thread ids of a page.
+        '''
+        queries = partition_queries(self.partitions)
+        if len(queries) == 1:
+            for messages, _ in self.list_message_pages(max_results):
+                yield messages
+            return
+
+        for _, messages, _ in self.list_partition_pages(
+            queries, max_results=max_results
+        ):
+            yield messages
+
+    def _split_page(self, messages):
+        batch_size = min(GMAIL_BATCH_SIZE, MAX_BATCH_SIZE)
+        return [
+            messages[start:start + batch_size]
+            for start in range(0, len(messages), batch_size)
+        ]
+
+    def hydrate_pages(self, pages, message_format='metadata'):
+        '''
+        Get the emails of pages of messages.
+
+        Pages are hydrated in chunks of a batch request each. With more
+        than one worker, chunks are hydrated by a thread pool while the
+        next pages are still being listed.
+        Yields:
+            list: The emails of each page, in input order.
+        '''
+        if self.workers <= 1:
+            for messages in pages:
+                emails = []
+                for chunk in self._split_page(messages):
+                    emails.extend(
+                        self.get_emails_from_messages(chunk, message_format))
+                yield emails
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            in_flight = 0
+            for messages in pages:
+                futures = [
+                    executor.submit(
+                        self.get_emails_from_messages, chunk, message_format)
+                    for chunk in self._split_page(messages)
+                ]
+                pending.append(futures)
+                in_flight += len(futures)
+                while in_flight > 2 * self.workers and len(pending) > 1:
+                    futures = pending.popleft()
+                    in_flight -= len(futures)
+                    yield [
+                        email for future in futures
+                        for email in future.result()
+                    ]
+
+            while pending:
+                yield [
+                    email for future in pending.popleft()
+                    for email in future.result()
+                ]
+
+    def iter_emails(self, max_results=511):
+        '''
+        Stream the emails of the user's Gmail inbox as they are fetched.
+        Yields:
+            list: The emails of each chunk of listed messages.
+        '''
+        yield from self.hydrate_pages(self.list_messages(max_results))
+
     def fetch_emails(self, max_results=511):
         '''
         Fetch the all email from the user's Gmail inbox.
         '''
+        emails = []
+        for page_emails in self.iter_emails(max_results):
+            emails.extend(page_emails)
+
+        return emails
+
+    def get_profile(self):
+        '''
+        Get the profile of the user, including the current history id.
+        '''
         service = self.get_service()
-        try:
-            response = service.users().messages().list(
-                userId='me', maxResults=max_results).execute()
-            messages = response.get('messages', [])
-            emails = self.get_emails_from_messages(messages)
-            pageToken = None
-            if 'nextPageToken' in response:
-                pageToken = response['nextPageToken']
-
-            while pageToken:
-                response = service.users().messages().list(
-                    userId='me',
-                    maxResults=max_results,
-                    pageToken=pageToken
-                ).execute()
-                messages = response.get('messages', [])
-                emails.extend(self.get_emails_from_messages(messages))
+        return self.execute(
+            service.users().getProfile(userId='me'), 'getProfile')
 
-                if 'nextPageToken' in response:
-                    pageToken = response['nextPageToken']
-                else:
-                    break
+    def list_history(self, start_history_id):
+        '''
+        List the changes made to the mailbox since a history id.
+        Returns:
+            dict: The latest history id and the ids of the messages
+            added, deleted and relabelled since the given history id.
+        Raises:
+            HistoryExpired: If the history id is too old to be used.
+        '''
+        service = self.get_service()
+        responses = []
+        page_token = None
+        while True:
+            try:
+                response = self.execute(service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=HISTORY_TYPES,
+                    maxResults=500,
+                    pageToken=page_token
+                ), 'history.list')
+            except HttpError as e:
+                if is_not_found_error(e):
+                    raise HistoryExpired(
+                        f'History id {start_history_id} has expired.')
+                raise
 
-            return emails
+            responses.append(response)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
 
-        except Exception as e:
-            print(f'An error occurred while fetching emails: {str(e)}')
-            print(e)
-            return []
+        return summarize_history(responses)
 
     def list_mailboxes(self):
         '''
         List all the mailboxes in the user's Gmail account.
+        Raises:
+            HttpError: If the request fails once retries are exhausted.
         '''
         service = self.get_service()
-        try:
-            response = service.users().labels().list(userId='me').execute()
-            labels = response.get('labels', [])
-            return labels
-        except Exception as e:
-            print(f'An error occurred while listing mailboxes: {str(e)}')
-            print(e)
-            return []
+        response = self.execute(
+            service.users().labels().list(userId='me'), 'labels.list')
+        return response.get('labels', [])
 
     def mark_as_read(self, message_id):
         '''
@@ -163,11 +665,11 @@ class GmailClient:
         '''
         service = self.get_service()
         try:
-            service.users().messages().modify(
+            self.execute(service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={'removeLabelIds': ['UNREAD']}
-            ).execute()
+            ), 'messages.modify')
         except Exception as e:
             print(f'An error occurred while marking email as read: {str(e)}')
             print(e)
@@ -181,11 +683,11 @@ class GmailClient:
         '''
         service = self.get_service()
         try:
-            service.users().messages().modify(
+            self.execute(service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={'addLabelIds': ['UNREAD']}
-            ).execute()
+            ), 'messages.modify')
         except Exception as e:
             print(f'An error occurred while marking email as unread: {str(e)}')
             print(e)
@@ -193,28 +695,56 @@ class GmailClient:
 
         return True
 
+    def get_label_id(self, mailbox):
+        '''
+        Get the label id of a mailbox by its name.
+        '''
+        return self.label_directory.get_label_id(mailbox)
+
     def move_to_mailbox(self, message_id, mailbox):
         '''
         Move an email to a specific mailbox.
         '''
-        labels = self.list_mailboxes()
-        for label in labels:
-            if label['name'] == mailbox:
-                mailbox_id = label['id']
-                break
-        else:
-            raise ValueError(f'Mailbox "{mailbox}" not found')
+        mailbox_id = self.get_label_id(mailbox)
 
         service = self.get_service()
         try:
-            service.users().messages().modify(
+            self.execute(service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={'addLabelIds': [mailbox_id]}
-            ).execute()
+            ), 'messages.modify')
         except Exception as e:
             print(f'An error occurred while moving email to mailbox: {str(e)}')
             print(e)
             return False
 
         return True
+
+    def batch_modify(
+        self,
+        message_ids,
+        add_label_ids=None,
+        remove_label_ids=None
+    ):
+        '''
+        Add and remove labels on many emails, in requests of up to 1000
+        emails each.
+        '''
+        service = self.get_service()
+        try:
+            batch_size = MAX_BATCH_MODIFY_SIZE
+            for start in range(0, len(message_ids), batch_size):
+                self.execute(service.users().messages().batchModify(
+                    userId='me',
+                    body={
+                        'ids': message_ids[start:start + batch_size],
+                        'addLabelIds': add_label_ids or [],
+                        'removeLabelIds': remove_label_ids or []
+                    }
+                ), 'messages.batchModify')
+        except Exception as e:
+            print(f'An error occurred while modifying emails: {str(e)}')
+            return False
+
+        return True
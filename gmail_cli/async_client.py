@@ -0,0 +1,416 @@
+import asyncio
+import httplib2
+
+from collections import deque
+from urllib.parse import urljoin
+
+from googleapiclient.errors import HttpError
+
+try:
+    import httpx
+except ImportError:  # httpx is an optional dependency
+    httpx = None
+
+from .api_client import (
+    HISTORY_TYPES,
+    MAX_BATCH_MODIFY_SIZE,
+    GmailClient,
+    is_not_found_error,
+    summarize_history
+)
+from .exceptions import HistoryExpired
+from .query import partition_queries
+from .rate_limit import QUOTA_UNITS, AsyncRequestScheduler
+from .settings import ASYNC_CONCURRENCY, HTTP_TIMEOUT
+
+# Where requests go when the wrapped client sets no api_endpoint
+GMAIL_API_BASE_URL = 'https://gmail.googleapis.com/'
+
+
+class AsyncGmailClient:
+    '''
+    A client to interact with the Gmail API from coroutines.
+
+    Requests are sent one per API call over a pool of keep-alive
+    connections, with up to `concurrency` requests in flight. The wrapped
+    GmailClient provides the credentials and the API endpoint.
+    '''
+    def __init__(self, gmail_client=None, concurrency=0) -> None:
+        if httpx is None:
+            raise ImportError(
+                'The async client requires httpx. '
+                'Install it with: pip install httpx'
+            )
+
+        self.gmail_client = gmail_client or GmailClient()
+        self.concurrency = concurrency or ASYNC_CONCURRENCY
+        # Spend the quota of the wrapped client, which may be set per account
+        self.scheduler = AsyncRequestScheduler(
+            quota_per_second=self.gmail_client.scheduler.quota_per_second,
+            max_concurrency=self.concurrency
+        )
+        self.base_url = urljoin(
+            self.gmail_client.api_endpoint or GMAIL_API_BASE_URL,
+            'gmail/v1/users/me/'
+        )
+        self._http = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency
+            )
+        )
+
+    @property
+    def partitions(self):
+        '''
+        The number of date ranges the mailbox is listed in.
+        '''
+        return self.gmail_client.partitions
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        '''
+        Close the HTTP connections held by this client.
+        '''
+        await self._http.aclose()
+
+    async def _get_headers(self):
+        credentials = self.gmail_client._credentials
+        if (
+            credentials is None or
+            self.gmail_client._needs_refresh(credentials)
+        ):
+            # Authenticating may block on a browser or a token refresh
+            credentials = await asyncio.to_thread(
+                self.gmail_client.get_credentials)
+
+        headers = {}
+        credentials.apply(headers)
+        return headers
+
+    async def request(self, method, http_method, path, params=None, body=None):
+        '''
+        Send a request through the rate limiter of this client.
+        Args:
+            method (str): The API method of the request, which sets its
+            quota cost.
+            path (str): The path of the request below users/me.
+        Returns:
+            dict: The decoded response, empty if it has no body.
+        Raises:
+            HttpError: If the request fails for good.
+        '''
+        url = urljoin(self.base_url, path)
+        params = {
+            key: value for key, value in (params or {}).items()
+            if value is not None
+        }
+
+        async def send():
+            response = await self._http.request(
+                http_method,
+                url,
+                params=params,
+                json=body,
+                headers=await self._get_headers()
+            )
+            if response.status_code >= 400:
+                raise HttpError(
+                    httplib2.Response({
+                        **response.headers,
+                        'status': response.status_code
+                    }),
+                    response.content,
+                    uri=str(response.url)
+                )
+            return response.json() if response.content else {}
+
+        return await self.scheduler.execute(send, QUOTA_UNITS[method])
+
+    async def get_message(self, message_id, message_format='metadata'):
+        '''
+        Get a message by id.
+        Returns:
+            dict: The message, or None if it no longer exists.
+        '''
+        try:
+            return await self.request(
+                'messages.get',
+                'GET',
+                f'messages/{message_id}',
+                self.gmail_client._get_message_params(message_format)
+            )
+        except HttpError as e:
+            if is_not_found_error(e):
+                return None
+            raise
+
+    async def get_emails_from_messages(
+        self,
+        messages,
+        message_format='metadata'
+    ):
+        '''
+        Get email information from messages, fetching them concurrently.
+        Messages that no longer exist are left out.
+        '''
+        fetched = await asyncio.gather(*(
+            self.get_message(message['id'], message_format)
+            for message in messages
+        ))
+        return [
+            self.gmail_client.parse_email(msg)
+            for msg in fetched if msg is not None
+        ]
+
+    async def list_message_pages(
+        self,
+        max_results=511,
+        page_token=None,
+        query=None
+    ):
+        '''
+        List the messages in the user's Gmail account, one page at a time.
+        Yields:
+            tuple: The message ids and thread ids of a page, and the token
+            of the next page or None on the last page.
+        '''
+        while True:
+            response = await self.request(
+                'messages.list', 'GET', 'messages', {
+                    'maxResults': max_results,
+                    'pageToken': page_token,
+                    'q': query
+                }
+            )
+            page_token = response.get('nextPageToken')
+            yield response.get('messages', []), page_token
+
+            if not page_token:
+                break
+
+    async def list_partition_pages(
+        self,
+        queries,
+        page_tokens=None,
+        max_results=511
+    ):
+        '''
+        List the messages matching several search queries concurrently.
+        Yields:
+            tuple: The query, the messages of one of its pages that no
+            other page listed, and the token of its next page or None on
+            its last page. The pages of each query are yielded in order.
+        '''
+        page_tokens = page_tokens or {}
+        pages = asyncio.Queue(maxsize=len(queries))
+
+        async def list_pages(query):
+            try:
+                async for messages, page_token in self.list_message_pages(
+                    max_results, page_tokens.get(query), query
+                ):
+                    await pages.put((query, messages, page_token))
+            except Exception as e:
+                await pages.put((query, e, None))
+            await pages.put((query, None, None))
+
+        tasks = [asyncio.create_task(list_pages(query)) for query in queries]
+        seen_ids = set()
+        try:
+            listing = len(queries)
+            while listing:
+                query, messages, page_token = await pages.get()
+                if messages is None:
+                    listing -= 1
+                    continue
+                if isinstance(messages, Exception):
+                    raise messages
+
+                messages = [
+                    message for message in messages
+                    if message['id'] not in seen_ids
+                ]
+                seen_ids.update(message['id'] for message in messages)
+                yield query, messages, page_token
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def hydrate_pages(self, pages, message_format='metadata'):
+        '''
+        Get the emails of pages of messages.
+
+        The messages of a page are fetched while the next pages are still
+        being listed, keeping about twice `concurrency` messages in
+        flight.
+        Args:
+            pages: An async iterable of lists of messages.
+        Yields:
+            list: The emails of each page, in input order.
+        '''
+        pending = deque()
+        in_flight = 0
+        try:
+            async for messages in pages:
+                pending.append((len(messages), asyncio.create_task(
+                    self.get_emails_from_messages(messages, message_format)
+                )))
+                in_flight += len(messages)
+                while in_flight > 2 * self.concurrency and len(pending) > 1:
+                    count, task = pending.popleft()
+                    in_flight -= count
+                    yield await task
+
+            while pending:
+                yield await pending.popleft()[1]
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def iter_emails(self, max_results=511):
+        '''
+        Stream the emails of the user's Gmail inbox as they are fetched.
+        Yields:
+            list: The emails of each page of listed messages.
+        '''
+        queries = partition_queries(self.partitions)
+
+        async def list_messages():
+            if len(queries) == 1:
+                async for messages, _ in self.list_message_pages(max_results):
+                    yield messages
+                return
+
+            async for _, messages, _ in self.list_partition_pages(
+                queries, max_results=max_results
+            ):
+                yield messages
+
+        async for emails in self.hydrate_pages(list_messages()):
+            yield emails
+
+    async def fetch_emails(self, max_results=511):
+        '''
+        Fetch the all email from the user's Gmail inbox.
+        '''
+        emails = []
+        async for page_emails in self.iter_emails(max_results):
+            emails.extend(page_emails)
+        return emails
+
+    async def get_profile(self):
+        '''
+        Get the profile of the user, including the current history id.
+        '''
+        return await self.request('getProfile', 'GET', 'profile')
+
+    async def list_history(self, start_history_id):
+        '''
+        List the changes made to the mailbox since a history id.
+        Raises:
+            HistoryExpired: If the history id is too old to be used.
+        '''
+        responses = []
+        page_token = None
+        while True:
+            try:
+                response = await self.request(
+                    'history.list', 'GET', 'history', {
+                        'startHistoryId': start_history_id,
+                        'historyTypes': HISTORY_TYPES,
+                        'maxResults': 500,
+                        'pageToken': page_token
+                    }
+                )
+            except HttpError as e:
+                if is_not_found_error(e):
+                    raise HistoryExpired(
+                        f'History id {start_history_id} has expired.')
+                raise
+
+            responses.append(response)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        return summarize_history(responses)
+
+    async def list_mailboxes(self):
+        '''
+        List all the mailboxes in the user's Gmail account.
+        Raises:
+            HttpError: If the request fails once retries are exhausted.
+        '''
+        response = await self.request('labels.list', 'GET', 'labels')
+        return response.get('labels', [])
+
+    async def modify(
+        self,
+        message_id,
+        add_label_ids=None,
+        remove_label_ids=None
+    ):
+        '''
+        Add and remove labels on an email.
+        '''
+        try:
+            await self.request(
+                'messages.modify', 'POST', f'messages/{message_id}/modify',
+                body={
+                    'addLabelIds': add_label_ids or [],
+                    'removeLabelIds': remove_label_ids or []
+                }
+            )
+        except Exception as e:
+            print(f'An error occurred while modifying email: {str(e)}')
+            return False
+
+        return True
+
+    async def mark_as_read(self, message_id):
+        '''
+        Mark an email as read.
+        '''
+        return await self.modify(message_id, remove_label_ids=['UNREAD'])
+
+    async def mark_as_unread(self, message_id):
+        '''
+        Mark an email as unread.
+        '''
+        return await self.modify(message_id, add_label_ids=['UNREAD'])
+
+    async def batch_modify(
+        self,
+        message_ids,
+        add_label_ids=None,
+        remove_label_ids=None
+    ):
+        '''
+        Add and remove labels on many emails, sending the requests of up
+        to 1000 emails each concurrently.
+        '''
+        batch_size = MAX_BATCH_MODIFY_SIZE
+        results = await asyncio.gather(*(
+            self.request(
+                'messages.batchModify', 'POST', 'messages/batchModify',
+                body={
+                    'ids': message_ids[start:start + batch_size],
+                    'addLabelIds': add_label_ids or [],
+                    'removeLabelIds': remove_label_ids or []
+                }
+            )
+            for start in range(0, len(message_ids), batch_size)
+        ), return_exceptions=True)
+
+        errors = [
+            result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            print(f'An error occurred while modifying emails: {str(error)}')
+        return not errors
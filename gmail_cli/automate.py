@@ -1,12 +1,19 @@
+import asyncio
 import pytz
-import re
 
 from datetime import datetime, timedelta
+from itertools import islice
 
-from .db_helper import EmailDBHelper
+from .actions import ActionExecutor
+from .db_helper import ITER_ARRAYSIZE, EmailDBHelper, extract_address
 from .api_client import GmailClient
+from .async_client import AsyncGmailClient
+from .labels import LabelDirectory
+from .query import build_rule_query
+from .sql import build_rule_sql
+from .sync import AsyncEmailSync, EmailSync
 from .validate import AutomationSchemaValidation
-from .settings import TIME_ZONE
+from .settings import SYNC_COMMIT_SIZE, TIME_ZONE
 
 
 class EmailAutomation:
@@ -19,53 +26,229 @@ class EmailAutomation:
         db_path='',
         table_name='',
         credentials_file_path='',
-        token_file_path=''
+        token_file_path='',
+        workers=0,
+        partitions=0,
+        api_endpoint='',
+        quota_per_second=0
     ) -> None:
         self.schema = AutomationSchemaValidation(schema_path)
         self.db_helper = EmailDBHelper(db_path, table_name)
-        self.gmail_client = GmailClient(credentials_file_path, token_file_path)
+        self.gmail_client = GmailClient(
+            credentials_file_path,
+            token_file_path,
+            workers,
+            api_endpoint=api_endpoint,
+            partitions=partitions,
+            quota_per_second=quota_per_second
+        )
+        self.email_sync = EmailSync(self.gmail_client, self.db_helper)
+        self.label_directory = LabelDirectory(
+            self.gmail_client, self.db_helper)
+        self.action_executor = ActionExecutor(
+            self.gmail_client, self.label_directory, self.db_helper)
 
     def retrieve_emails(self, force=False):
         '''
         Fetch emails from Gmail and insert them into the database.
         Args:
-            force (bool): If True, fetch emails from Gmail and insert them
-            into the database.
+            force (bool): If True, sync the emails changed in Gmail since
+            the last sync into the database.
         '''
         if force:
-            emails = self.gmail_client.fetch_emails()
-            self.db_helper.insert_emails_into_table(emails)
+            self.email_sync.sync()
 
         return self.db_helper.fetch_emails_from_table()
 
-    def run(self, force_retrieve=False):
+    def retrieve_candidate_emails(self, query):
+        '''
+        Fetch the emails matching a Gmail search query, storing the ones
+        not in the database yet.
+        '''
+        message_ids = self.email_sync.search_sync(query)
+        return self.db_helper.fetch_emails_by_ids(message_ids)
+
+    def run(self, force_retrieve=False, search=False):
         '''
         Start the email automation process.
         Args:
             force_retrieve (bool): If True, fetch emails from Gmail and
             insert them into the database.
+            search (bool): If True, evaluate each rule that translates
+            into a Gmail search query only on the emails Gmail finds for
+            it. Other rules are evaluated on all emails in the database.
+        Returns:
+            dict: The number of emails modified and whether every
+            modification succeeded.
         '''
         rules = self.schema.validate()
-        emails = self.retrieve_emails(force=force_retrieve)
+        self.label_directory.resolve(self.get_mailboxes(rules))
+        synced = not force_retrieve
+        # The labels in the database are only trusted right after a sync
+        labels_synced = False
         for rule in rules:
-            self.apply_rule(rule, emails)
+            query = build_rule_query(rule) if search else None
+            if query:
+                self.apply_rule(rule, self.retrieve_candidate_emails(query))
+                continue
+
+            if not synced:
+                self.email_sync.sync()
+                synced = labels_synced = True
+            if self.apply_rule_sql(rule):
+                continue
+
+            self.apply_rule(rule, self.db_helper.iter_emails())
+
+        if labels_synced:
+            self.action_executor.drop_applied_changes()
+        modified = len(self.action_executor.label_changes)
+        return {
+            'modified': modified,
+            'success': self.action_executor.flush()
+        }
+
+    async def run_async(self, force_retrieve=False, search=False):
+        '''
+        Start the email automation process, fetching emails and applying
+        actions through an AsyncGmailClient. Takes the same arguments as
+        run.
+        '''
+        rules = self.schema.validate()
+        await asyncio.to_thread(
+            self.label_directory.resolve, self.get_mailboxes(rules))
+        async with AsyncGmailClient(self.gmail_client) as async_client:
+            email_sync = AsyncEmailSync(async_client, self.db_helper)
+            synced = not force_retrieve
+            labels_synced = False
+            for rule in rules:
+                query = build_rule_query(rule) if search else None
+                if query:
+                    message_ids = await email_sync.search_sync(query)
+                    self.apply_rule(
+                        rule, self.db_helper.fetch_emails_by_ids(message_ids))
+                    continue
+
+                if not synced:
+                    await email_sync.sync()
+                    synced = labels_synced = True
+                if self.apply_rule_sql(rule):
+                    continue
+
+                self.apply_rule(rule, self.db_helper.iter_emails())
+
+            if labels_synced:
+                self.action_executor.drop_applied_changes()
+            modified = len(self.action_executor.label_changes)
+            return {
+                'modified': modified,
+                'success': await self.action_executor.flush_async(
+                    async_client)
+            }
+
+    def get_mailboxes(self, rules):
+        '''
+        Get the names of the mailboxes the rules move emails to.
+        '''
+        return sorted({
+            action['mailbox']
+            for rule in rules
+            for action in rule['actions']
+            if action['action'] == 'move_to_mailbox'
+        })
+
+    def apply_rule_sql(self, rule):
+        '''
+        Apply the rule to the emails in the database that SQLite selects
+        for it.
+
+        A rule whose conditions all translate into SQL is applied to the
+        selected message IDs without loading the emails. Otherwise the
+        rule is evaluated on the emails its translated conditions select.
+        Returns:
+            bool: False if the rule has no translation into SQL, and was
+            not applied.
+        '''
+        translation = build_rule_sql(
+            rule, full_text_search=self.db_helper.has_full_text_index())
+        if translation is None:
+            return False
+
+        where, params, exact = translation
+        if not exact:
+            self.apply_rule(
+                rule, self.db_helper.iter_emails(where=where, params=params))
+            return True
+
+        for message_id in self.db_helper.fetch_message_ids_where(
+            where, params
+        ):
+            for action in rule['actions']:
+                self.action_executor.add(message_id, action)
+        return True
 
     def apply_rule(self, rule, emails):
         '''
         Apply the rule to the emails.
+
+        The emails may be any iterable, such as EmailDBHelper.iter_emails,
+        and are evaluated a page at a time. The bodies of the emails are
+        loaded only if the rule has a body condition, and only for the
+        emails its other conditions do not already decide.
         '''
         conditions = rule['conditions']
         actions = rule['actions']
         predicate = rule['predicate']
 
+        cheap_conditions = [
+            condition for condition in conditions
+            if condition['field'] != 'body'
+        ]
+        emails = iter(emails)
+        while page := list(islice(emails, ITER_ARRAYSIZE)):
+            if len(cheap_conditions) < len(conditions):
+                # An 'all' rule fails on any failed condition and an 'any'
+                # rule matches on any matched one, so only the remaining
+                # emails need their body.
+                decided = predicate == 'any'
+                self.load_bodies([
+                    email for email in page
+                    if not cheap_conditions or self.match_conditions(
+                        email, cheap_conditions, predicate) != decided
+                ])
+
+            for email in page:
+                if self.match_conditions(email, conditions, predicate):
+                    self.perform_actions(email, actions)
+
+    def load_bodies(self, emails):
+        '''
+        Set the body of the emails, fetching from Gmail and storing the
+        bodies that are not in the database yet.
+        '''
+        emails = [email for email in emails if 'body' not in email]
+        message_ids = [email['message_id'] for email in emails]
+        bodies = self.db_helper.fetch_bodies(message_ids)
+        missing_ids = [
+            message_id for message_id in message_ids
+            if message_id not in bodies
+        ]
+        for start in range(0, len(missing_ids), SYNC_COMMIT_SIZE):
+            fetched = self.gmail_client.get_message_bodies(
+                missing_ids[start:start + SYNC_COMMIT_SIZE])
+            self.db_helper.save_bodies(fetched)
+            bodies.update(fetched)
+
         for email in emails:
-            if self.match_conditions(email, conditions, predicate):
-                self.perform_actions(email, actions)
+            email['body'] = bodies.get(email['message_id'], '')
 
     def match_conditions(self, email, conditions, predicate):
         '''
-        Match the conditions with the email.
+        Match the conditions with the email. Body conditions are matched
+        last, as they may need the body to be fetched.
         '''
+        conditions = sorted(
+            conditions, key=lambda condition: condition['field'] == 'body')
         if predicate == 'all':
             return self.match_all_conditions(email, conditions)
         elif predicate == 'any':
@@ -98,14 +281,17 @@ class EmailAutomation:
         field = condition['field']
         value = condition['value']
         operator = condition['operator']
-        field_value = email[field]
 
         if field in ('to', 'from'):
-            return self.match_email_type(field_value, operator, value)
+            return self.match_email_type(email[field], operator, value)
         elif field == 'subject':
-            return self.match_string_type(field_value, operator, value)
+            return self.match_string_type(email[field], operator, value)
+        elif field == 'body':
+            if 'body' not in email:
+                self.load_bodies([email])
+            return self.match_string_type(email[field], operator, value)
         elif field == 'date_received':
-            return self.match_datetime_type(field_value, operator, value)
+            return self.match_datetime_type(email['date'], operator, value)
         else:
             raise ValueError('Invalid field')
 
@@ -113,12 +299,10 @@ class EmailAutomation:
         '''
         Match to condition with the email.
         '''
-        pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-        match = re.search(pattern, field_value)
-        if not match:
+        email_address = extract_address(field_value)
+        if not email_address:
             return False
 
-        email_address = match.group()
         return self.match_string_type(email_address, operator, value)
 
     def match_string_type(
@@ -187,15 +371,7 @@ class EmailAutomation:
 
     def perform_action(self, email, action):
         '''
-        Perform a single action on the email.
+        Queue a single action on the email. Queued actions are sent to
+        Gmail together once all the rules are applied.
         '''
-        action_type = action['action']
-        if action_type == 'mark_as_read':
-            self.gmail_client.mark_as_read(email['message_id'])
-        elif action_type == 'mark_as_unread':
-            self.gmail_client.mark_as_unread(email['message_id'])
-        elif action_type == 'move_to_mailbox':
-            self.gmail_client.move_to_mailbox(
-                email['message_id'], action['mailbox'])
-        else:
-            raise ValueError('Invalid action type')
+        self.action_executor.add(email['message_id'], action)
@@ -1,9 +1,19 @@
+import asyncio
+import sys
+import time
+
 from argparse import ArgumentParser
 
+from gmail_cli.accounts import read_accounts, run_accounts
 from gmail_cli.automate import EmailAutomation
 from gmail_cli.db_helper import EmailDBHelper
 from gmail_cli.api_client import GmailClient
-from gmail_cli.utils import tabulate_emails, write_emails_to_csv
+from gmail_cli.sync import EmailSync
+from gmail_cli.utils import (
+    tabulate_account_results,
+    tabulate_emails,
+    write_emails_to_csv
+)
 
 
 def main():
@@ -27,9 +37,21 @@ def main():
     list_parser.add_argument(
         '--write-to-csv-path',
         type=str, default='', help='Path to write emails to a CSV file')
+    list_parser.add_argument(
+        '--search',
+        type=str, default='',
+        help='Only list emails whose subject or snippet contains this text')
     list_parser.add_argument(
         '--force-retrieve',
         action='store_true', help='Force retrieve emails from Gmail')
+    list_parser.add_argument(
+        '--workers',
+        type=int, default=0,
+        help='Number of threads fetching emails from Gmail')
+    list_parser.add_argument(
+        '--partitions',
+        type=int, default=0,
+        help='Number of date ranges of the mailbox listed in parallel')
 
     automate_parser = subparsers.add_parser(
         'automate', help='Automate email processing')
@@ -50,6 +72,30 @@ def main():
     automate_parser.add_argument(
         '--force-retrieve',
         action='store_true', help='Force retrieve emails from Gmail')
+    automate_parser.add_argument(
+        '--search',
+        action='store_true',
+        help='Only evaluate rules on the emails Gmail search finds for them')
+    automate_parser.add_argument(
+        '--async',
+        action='store_true', dest='use_async',
+        help='Send Gmail requests concurrently from a single thread')
+    automate_parser.add_argument(
+        '--workers',
+        type=int, default=0,
+        help='Number of threads fetching emails from Gmail')
+    automate_parser.add_argument(
+        '--partitions',
+        type=int, default=0,
+        help='Number of date ranges of the mailbox listed in parallel')
+    automate_parser.add_argument(
+        '--accounts',
+        type=str, default='',
+        help='Path to a JSON file of accounts to run the rules on')
+    automate_parser.add_argument(
+        '--processes',
+        type=int, default=0,
+        help='Number of accounts run at once with --accounts')
     args = parser.parse_args()
 
     if args.command not in ['list', 'automate']:
@@ -57,20 +103,54 @@ def main():
         return
 
     if args.command == 'list':
-        email_db_helper = EmailDBHelper(args.db_path, args.table_name)
-        if args.force_retrieve:
-            gmail_client = GmailClient(
-                args.credentials_file_path,
-                args.token_file_path
-            )
-            emails = gmail_client.fetch_emails()
-            email_db_helper.insert_emails_into_table(emails)
+        with EmailDBHelper(args.db_path, args.table_name) as email_db_helper:
+            if args.force_retrieve:
+                gmail_client = GmailClient(
+                    args.credentials_file_path,
+                    args.token_file_path,
+                    args.workers,
+                    partitions=args.partitions
+                )
+                EmailSync(gmail_client, email_db_helper).sync()
 
-        emails = email_db_helper.fetch_emails_from_table()
-        if args.write_to_csv_path:
-            write_emails_to_csv(emails, args.write_to_csv_path)
-        else:
-            tabulate_emails(emails)
+            # The emails are streamed, so they are written before the
+            # connection closes
+            if args.search:
+                emails = email_db_helper.search_emails(args.search)
+            else:
+                emails = email_db_helper.iter_emails()
+            if args.write_to_csv_path:
+                write_emails_to_csv(emails, args.write_to_csv_path)
+            else:
+                tabulate_emails(emails)
+        return
+
+    if args.command == 'automate' and args.accounts:
+        defaults = {
+            option: value for option, value in [
+                ('db_path', args.db_path),
+                ('table_name', args.table_name),
+                ('credentials_file_path', args.credentials_file_path),
+                ('workers', args.workers),
+                ('partitions', args.partitions)
+            ] if value
+        }
+        accounts = [
+            {**defaults, **account}
+            for account in read_accounts(args.accounts)
+        ]
+        started_at = time.monotonic()
+        results = run_accounts(
+            args.schema,
+            accounts,
+            args.processes,
+            force_retrieve=args.force_retrieve,
+            search=args.search,
+            use_async=args.use_async
+        )
+        tabulate_account_results(results, time.monotonic() - started_at)
+        if any(result['status'] != 'ok' for result in results):
+            sys.exit(1)
         return
 
     if args.command == 'automate':
@@ -79,9 +159,26 @@ def main():
             db_path=args.db_path,
             table_name=args.table_name,
             credentials_file_path=args.credentials_file_path,
-            token_file_path=args.token_file_path
+            token_file_path=args.token_file_path,
+            workers=args.workers,
+            partitions=args.partitions
         )
-        email_automation.run(force_retrieve=args.force_retrieve)
+        if args.use_async:
+            summary = asyncio.run(email_automation.run_async(
+                force_retrieve=args.force_retrieve,
+                search=args.search
+            ))
+        else:
+            summary = email_automation.run(
+                force_retrieve=args.force_retrieve,
+                search=args.search
+            )
+        if not summary['success']:
+            print(
+                'Some email automation actions failed, '
+                f'{summary["modified"]} emails were to be modified'
+            )
+            sys.exit(1)
         print('Email automation rules applied successfully')
         return
 
@@ -1,11 +1,49 @@
+import os
+import re
 import sqlite3
-import pytz
+import threading
+import zlib
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import islice
+from zoneinfo import ZoneInfo
 
-from .settings import EMAILS_DB_PATH, EMAIL_TABLE_NAME, TIME_ZONE
+from .settings import (
+    EMAILS_DB_PATH,
+    EMAIL_TABLE_NAME,
+    SQLITE_CACHE_SIZE,
+    SQLITE_MMAP_SIZE,
+    TIME_ZONE
+)
 from .exceptions import DoesNotExist
+from .sql import build_search_sql
 
+MAX_QUERY_PARAMS = 500  # Stays below SQLite's bound parameter limit
+SQLITE_BUSY_TIMEOUT = 30  # Seconds a write waits for another writer
+SQLITE_CACHED_STATEMENTS = 256  # Prepared statements kept per connection
+INSERT_CHUNK_SIZE = 10000  # Rows held in memory per executemany call
+ITER_ARRAYSIZE = 1000  # Rows fetched at a time by iter_emails
+
+EMAIL_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S %z"
+# The usual shape of EMAIL_DATE_FORMAT, parsed without strptime
+EMAIL_DATE = re.compile(
+    r'(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun), (\d{1,2}) '
+    r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) (\d{4}) '
+    r'(\d{2}):(\d{2}):(\d{2}) ([+-]\d{4})'
+)
+# The first email address in a From or To header
+EMAIL_ADDRESS = re.compile(
+    r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+MONTHS = {
+    month: number for number, month in enumerate([
+        'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+        'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'
+    ], 1)
+}
+
+# The emails table as first released. Later columns are added by the
+# schema migrations
 CREATE_EMAIL_TABLE = '''CREATE TABLE IF NOT EXISTS {email_table_name} (
     message_id TEXT PRIMARY KEY,
     subject TEXT,
@@ -14,6 +52,67 @@ CREATE_EMAIL_TABLE = '''CREATE TABLE IF NOT EXISTS {email_table_name} (
     recipient TEXT,
     sender TEXT
 )'''
+CREATE_DATE_EPOCH_INDEX = '''CREATE INDEX IF NOT EXISTS
+{email_table_name}_date_epoch ON {email_table_name} (date_epoch)'''
+CREATE_SENDER_ADDRESS_INDEX = '''CREATE INDEX IF NOT EXISTS
+{email_table_name}_sender_address ON {email_table_name} (sender_address)'''
+CREATE_RECIPIENT_ADDRESS_INDEX = '''CREATE INDEX IF NOT EXISTS
+{email_table_name}_recipient_address
+ON {email_table_name} (recipient_address)'''
+# A trigram index over the subject and snippet of the emails table. New
+# emails are indexed in bulk by insert_emails_into_table, under the write
+# lock, which is several times faster than a trigger per row, and triggers
+# keep the index in sync with deletes and updates. It refers to emails by
+# rowid, so rebuild it after a VACUUM of the database.
+CREATE_FTS_TABLE = '''CREATE VIRTUAL TABLE IF NOT EXISTS
+{email_table_name}_fts USING fts5(
+    subject,
+    snippet,
+    content='{email_table_name}',
+    content_rowid='rowid',
+    tokenize='trigram'
+)'''
+CREATE_FTS_DELETE_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS
+{email_table_name}_fts_delete AFTER DELETE ON {email_table_name} BEGIN
+    INSERT INTO {email_table_name}_fts (
+        {email_table_name}_fts, rowid, subject, snippet)
+    VALUES ('delete', old.rowid, old.subject, old.snippet);
+END'''
+CREATE_FTS_UPDATE_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS
+{email_table_name}_fts_update AFTER UPDATE OF subject, snippet
+ON {email_table_name} BEGIN
+    INSERT INTO {email_table_name}_fts (
+        {email_table_name}_fts, rowid, subject, snippet)
+    VALUES ('delete', old.rowid, old.subject, old.snippet);
+    INSERT INTO {email_table_name}_fts (rowid, subject, snippet)
+    VALUES (new.rowid, new.subject, new.snippet);
+END'''
+# New rows always get a rowid above the largest one in the table
+SELECT_MAX_ROWID = 'SELECT max(rowid) FROM {email_table_name}'
+INDEX_NEW_EMAILS = '''INSERT INTO {email_table_name}_fts (
+    rowid,
+    subject,
+    snippet
+) SELECT rowid, subject, snippet FROM {email_table_name} WHERE rowid > ?'''
+REBUILD_FTS_TABLE = '''INSERT INTO
+{email_table_name}_fts ({email_table_name}_fts) VALUES ('rebuild')'''
+SELECT_TABLE = '''SELECT 1 FROM sqlite_master
+WHERE type = 'table' AND name = ?'''
+DROP_FTS_TABLE = 'DROP TABLE IF EXISTS {email_table_name}_fts'
+
+ADD_DATE_EPOCH_COLUMN = '''ALTER TABLE {email_table_name}
+ADD COLUMN date_epoch INTEGER'''
+ADD_SENDER_ADDRESS_COLUMN = '''ALTER TABLE {email_table_name}
+ADD COLUMN sender_address TEXT'''
+ADD_RECIPIENT_ADDRESS_COLUMN = '''ALTER TABLE {email_table_name}
+ADD COLUMN recipient_address TEXT'''
+SELECT_RAW_FIELDS = '''SELECT message_id, date, sender, recipient
+FROM {email_table_name}'''
+UPDATE_DERIVED_FIELDS = '''UPDATE {email_table_name} SET
+    date_epoch = ?,
+    sender_address = ?,
+    recipient_address = ?
+WHERE message_id = ?'''
 
 INSERT_EMAILS = '''INSERT OR IGNORE INTO {email_table_name} (
     message_id,
@@ -21,139 +120,1020 @@ INSERT_EMAILS = '''INSERT OR IGNORE INTO {email_table_name} (
     snippet,
     date,
     recipient,
-    sender
-) VALUES (?, ?, ?, ?, ?, ?)'''
+    sender,
+    date_epoch,
+    sender_address,
+    recipient_address,
+    labels_known
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
 
-SELECT_EMAILS = '''SELECT * FROM {email_table_name}'''
-SELECT_EMAILS_BY_ID = 'SELECT * FROM {email_table_name} WHERE message_id = ?'
+# Emails are read with their parsed date rather than the raw header
+EMAIL_COLUMNS = 'message_id, subject, snippet, date_epoch, recipient, sender'
+# The table column read into each key of an email
+EMAIL_FIELDS = {
+    'message_id': 'message_id',
+    'subject': 'subject',
+    'snippet': 'snippet',
+    'date': 'date_epoch',
+    'to': 'recipient',
+    'from': 'sender'
+}
+# The columns emails are paginated by, for each iter_emails order
+EMAIL_ORDERS = {
+    'message_id': 'message_id',
+    'date': 'date_epoch, message_id'
+}
+SELECT_EMAILS = '''SELECT {email_columns} FROM {email_table_name}'''
+SELECT_MESSAGE_IDS = '''SELECT message_id FROM {email_table_name}'''
+SELECT_EMAILS_BY_ID = '''SELECT {email_columns} FROM {email_table_name}
+WHERE message_id = ?'''
+SELECT_EMAILS_BY_IDS = '''SELECT {email_columns} FROM {email_table_name}
+WHERE message_id IN ({placeholders})'''
+# Emails whose date could not be parsed are never read
+ITER_EMAILS = '''SELECT {columns} FROM {email_table_name}
+WHERE date_epoch IS NOT NULL AND ({where})
+ORDER BY {order_by} LIMIT ?'''
+SELECT_MESSAGE_IDS_WHERE = '''SELECT message_id FROM {email_table_name}
+WHERE date_epoch IS NOT NULL AND ({where})'''
+DELETE_EMAILS = 'DELETE FROM {email_table_name} WHERE message_id = ?'
 DROP_EMAIL_TABLE = 'DROP TABLE IF EXISTS {email_table_name}'
 
+CREATE_SYNC_STATE_TABLE = '''CREATE TABLE IF NOT EXISTS
+{email_table_name}_sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+)'''
+SELECT_SYNC_STATE = '''SELECT value FROM {email_table_name}_sync_state
+WHERE key = ?'''
+UPSERT_SYNC_STATE = '''INSERT OR REPLACE INTO {email_table_name}_sync_state (
+    key,
+    value
+) VALUES (?, ?)'''
+DROP_SYNC_STATE_TABLE = 'DROP TABLE IF EXISTS {email_table_name}_sync_state'
+
+CREATE_SYNC_CHECKPOINT_TABLE = '''CREATE TABLE IF NOT EXISTS
+{email_table_name}_sync_checkpoint (
+    name TEXT PRIMARY KEY,
+    page_token TEXT,
+    history_id TEXT,
+    pages INTEGER,
+    messages INTEGER,
+    updated_at TEXT
+)'''
+SELECT_SYNC_CHECKPOINT = '''SELECT
+    page_token,
+    history_id,
+    pages,
+    messages,
+    updated_at
+FROM {email_table_name}_sync_checkpoint WHERE name = ?'''
+SELECT_SYNC_CHECKPOINTS = '''SELECT
+    name,
+    page_token,
+    history_id,
+    pages,
+    messages,
+    updated_at
+FROM {email_table_name}_sync_checkpoint WHERE substr(name, 1, ?) = ?
+ORDER BY name'''
+UPSERT_SYNC_CHECKPOINT = '''INSERT OR REPLACE INTO
+{email_table_name}_sync_checkpoint (
+    name,
+    page_token,
+    history_id,
+    pages,
+    messages,
+    updated_at
+) VALUES (?, ?, ?, ?, ?, ?)'''
+DELETE_SYNC_CHECKPOINT = '''DELETE FROM {email_table_name}_sync_checkpoint
+WHERE name = ?'''
+DROP_SYNC_CHECKPOINT_TABLE = '''DROP TABLE IF EXISTS
+{email_table_name}_sync_checkpoint'''
+
+CREATE_LABELS_TABLE = '''CREATE TABLE IF NOT EXISTS {email_table_name}_labels (
+    label_id TEXT PRIMARY KEY,
+    name TEXT,
+    fetched_at REAL
+)'''
+SELECT_LABELS = '''SELECT label_id, name, fetched_at
+FROM {email_table_name}_labels'''
+INSERT_LABELS = '''INSERT INTO {email_table_name}_labels (
+    label_id,
+    name,
+    fetched_at
+) VALUES (?, ?, ?)'''
+DELETE_LABELS = 'DELETE FROM {email_table_name}_labels'
+DROP_LABELS_TABLE = 'DROP TABLE IF EXISTS {email_table_name}_labels'
+
+CREATE_BODIES_TABLE = '''CREATE TABLE IF NOT EXISTS {email_table_name}_bodies (
+    message_id TEXT PRIMARY KEY,
+    body BLOB
+)'''
+SELECT_BODIES_BY_IDS = '''SELECT message_id, body
+FROM {email_table_name}_bodies WHERE message_id IN ({placeholders})'''
+INSERT_BODIES = '''INSERT OR REPLACE INTO {email_table_name}_bodies (
+    message_id,
+    body
+) VALUES (?, ?)'''
+DELETE_BODIES = 'DELETE FROM {email_table_name}_bodies WHERE message_id = ?'
+DROP_BODIES_TABLE = 'DROP TABLE IF EXISTS {email_table_name}_bodies'
+
+# Whether each label is on an email, as last seen in Gmail. Emails with
+# labels_known set have a row for every label they carry, and carry no
+# other labels. Other emails only have rows for the labels our own
+# actions changed.
+CREATE_MESSAGE_LABELS_TABLE = '''CREATE TABLE IF NOT EXISTS
+{email_table_name}_message_labels (
+    message_id TEXT NOT NULL,
+    label_id TEXT NOT NULL,
+    present INTEGER NOT NULL,
+    PRIMARY KEY (message_id, label_id)
+) WITHOUT ROWID'''
+ADD_LABELS_KNOWN_COLUMN = '''ALTER TABLE {email_table_name}
+ADD COLUMN labels_known INTEGER'''
+SELECT_LABEL_STATES_BY_IDS = '''SELECT
+    emails.message_id,
+    emails.labels_known,
+    labels.label_id,
+    labels.present
+FROM {email_table_name} AS emails
+LEFT JOIN {email_table_name}_message_labels AS labels
+ON labels.message_id = emails.message_id
+WHERE emails.message_id IN ({placeholders})'''
+UPSERT_MESSAGE_LABEL = '''INSERT OR REPLACE INTO
+{email_table_name}_message_labels (
+    message_id,
+    label_id,
+    present
+) VALUES (?, ?, ?)'''
+DELETE_MESSAGE_LABELS = '''DELETE FROM {email_table_name}_message_labels
+WHERE message_id = ?'''
+SET_LABELS_KNOWN = '''UPDATE {email_table_name} SET labels_known = 1
+WHERE message_id = ?'''
+CLEAR_MESSAGE_LABELS = 'DELETE FROM {email_table_name}_message_labels'
+CLEAR_LABELS_KNOWN = '''UPDATE {email_table_name} SET labels_known = NULL
+WHERE labels_known IS NOT NULL'''
+DROP_MESSAGE_LABELS_TABLE = '''DROP TABLE IF EXISTS
+{email_table_name}_message_labels'''
+
+# One row per schema migration applied to the tables of an emails table
+CREATE_SCHEMA_VERSION_TABLE = '''CREATE TABLE IF NOT EXISTS
+{email_table_name}_schema_version (
+    version INTEGER PRIMARY KEY,
+    migrated_at TEXT
+)'''
+SELECT_SCHEMA_VERSION = '''SELECT coalesce(max(version), 0)
+FROM {email_table_name}_schema_version'''
+INSERT_SCHEMA_VERSION = '''INSERT INTO {email_table_name}_schema_version (
+    version,
+    migrated_at
+) VALUES (?, ?)'''
+DROP_SCHEMA_VERSION_TABLE = '''DROP TABLE IF EXISTS
+{email_table_name}_schema_version'''
+
+
+# Columns derived from the raw headers, and the queries adding them to
+# tables created before they existed
+DERIVED_COLUMNS = {
+    'date_epoch': 'ADD_DATE_EPOCH_COLUMN',
+    'sender_address': 'ADD_SENDER_ADDRESS_COLUMN',
+    'recipient_address': 'ADD_RECIPIENT_ADDRESS_COLUMN'
+}
+# The EmailDBHelper methods migrating the tables from each schema version
+# to the next, in order. Migrations only ever add to the schema and
+# derive data from what the tables already hold, and must be safe to
+# rerun on tables created before versions were recorded. Append new
+# migrations to the end.
+SCHEMA_MIGRATIONS = [
+    '_create_base_tables',
+    '_add_derived_columns',
+    '_create_full_text_index',
+    '_add_message_labels'
+]
+
 EMAIL_QUERIES = {
     "CREATE_EMAIL_TABLE": CREATE_EMAIL_TABLE,
+    "CREATE_DATE_EPOCH_INDEX": CREATE_DATE_EPOCH_INDEX,
+    "CREATE_SENDER_ADDRESS_INDEX": CREATE_SENDER_ADDRESS_INDEX,
+    "CREATE_RECIPIENT_ADDRESS_INDEX": CREATE_RECIPIENT_ADDRESS_INDEX,
+    "CREATE_FTS_TABLE": CREATE_FTS_TABLE,
+    "CREATE_FTS_DELETE_TRIGGER": CREATE_FTS_DELETE_TRIGGER,
+    "CREATE_FTS_UPDATE_TRIGGER": CREATE_FTS_UPDATE_TRIGGER,
+    "SELECT_MAX_ROWID": SELECT_MAX_ROWID,
+    "INDEX_NEW_EMAILS": INDEX_NEW_EMAILS,
+    "REBUILD_FTS_TABLE": REBUILD_FTS_TABLE,
+    "SELECT_TABLE": SELECT_TABLE,
+    "DROP_FTS_TABLE": DROP_FTS_TABLE,
+    "ADD_DATE_EPOCH_COLUMN": ADD_DATE_EPOCH_COLUMN,
+    "ADD_SENDER_ADDRESS_COLUMN": ADD_SENDER_ADDRESS_COLUMN,
+    "ADD_RECIPIENT_ADDRESS_COLUMN": ADD_RECIPIENT_ADDRESS_COLUMN,
+    "SELECT_RAW_FIELDS": SELECT_RAW_FIELDS,
+    "UPDATE_DERIVED_FIELDS": UPDATE_DERIVED_FIELDS,
     "INSERT_EMAILS": INSERT_EMAILS,
     "SELECT_EMAILS": SELECT_EMAILS,
+    "SELECT_MESSAGE_IDS": SELECT_MESSAGE_IDS,
     "SELECT_EMAILS_BY_ID": SELECT_EMAILS_BY_ID,
-    "DROP_EMAIL_TABLE": DROP_EMAIL_TABLE
+    "SELECT_EMAILS_BY_IDS": SELECT_EMAILS_BY_IDS,
+    "SELECT_MESSAGE_IDS_WHERE": SELECT_MESSAGE_IDS_WHERE,
+    "ITER_EMAILS": ITER_EMAILS,
+    "DELETE_EMAILS": DELETE_EMAILS,
+    "DROP_EMAIL_TABLE": DROP_EMAIL_TABLE,
+    "CREATE_SYNC_STATE_TABLE": CREATE_SYNC_STATE_TABLE,
+    "SELECT_SYNC_STATE": SELECT_SYNC_STATE,
+    "UPSERT_SYNC_STATE": UPSERT_SYNC_STATE,
+    "DROP_SYNC_STATE_TABLE": DROP_SYNC_STATE_TABLE,
+    "CREATE_SYNC_CHECKPOINT_TABLE": CREATE_SYNC_CHECKPOINT_TABLE,
+    "SELECT_SYNC_CHECKPOINT": SELECT_SYNC_CHECKPOINT,
+    "SELECT_SYNC_CHECKPOINTS": SELECT_SYNC_CHECKPOINTS,
+    "UPSERT_SYNC_CHECKPOINT": UPSERT_SYNC_CHECKPOINT,
+    "DELETE_SYNC_CHECKPOINT": DELETE_SYNC_CHECKPOINT,
+    "DROP_SYNC_CHECKPOINT_TABLE": DROP_SYNC_CHECKPOINT_TABLE,
+    "CREATE_LABELS_TABLE": CREATE_LABELS_TABLE,
+    "SELECT_LABELS": SELECT_LABELS,
+    "INSERT_LABELS": INSERT_LABELS,
+    "DELETE_LABELS": DELETE_LABELS,
+    "DROP_LABELS_TABLE": DROP_LABELS_TABLE,
+    "CREATE_BODIES_TABLE": CREATE_BODIES_TABLE,
+    "SELECT_BODIES_BY_IDS": SELECT_BODIES_BY_IDS,
+    "INSERT_BODIES": INSERT_BODIES,
+    "DELETE_BODIES": DELETE_BODIES,
+    "DROP_BODIES_TABLE": DROP_BODIES_TABLE,
+    "CREATE_MESSAGE_LABELS_TABLE": CREATE_MESSAGE_LABELS_TABLE,
+    "ADD_LABELS_KNOWN_COLUMN": ADD_LABELS_KNOWN_COLUMN,
+    "SELECT_LABEL_STATES_BY_IDS": SELECT_LABEL_STATES_BY_IDS,
+    "UPSERT_MESSAGE_LABEL": UPSERT_MESSAGE_LABEL,
+    "DELETE_MESSAGE_LABELS": DELETE_MESSAGE_LABELS,
+    "SET_LABELS_KNOWN": SET_LABELS_KNOWN,
+    "CLEAR_MESSAGE_LABELS": CLEAR_MESSAGE_LABELS,
+    "CLEAR_LABELS_KNOWN": CLEAR_LABELS_KNOWN,
+    "DROP_MESSAGE_LABELS_TABLE": DROP_MESSAGE_LABELS_TABLE,
+    "CREATE_SCHEMA_VERSION_TABLE": CREATE_SCHEMA_VERSION_TABLE,
+    "SELECT_SCHEMA_VERSION": SELECT_SCHEMA_VERSION,
+    "INSERT_SCHEMA_VERSION": INSERT_SCHEMA_VERSION,
+    "DROP_SCHEMA_VERSION_TABLE": DROP_SCHEMA_VERSION_TABLE
 }
 
 
+@lru_cache(maxsize=None)
+def get_utc_offset(offset):
+    '''
+    Get the time zone of a "+hhmm" UTC offset.
+    '''
+    delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:]))
+    return timezone(-delta if offset[0] == '-' else delta)
+
+
+def extract_address(value):
+    '''
+    Extract the first email address of a From or To header.
+    Returns:
+        str: The address, or None if the header has none.
+    '''
+    match = EMAIL_ADDRESS.search(value or '')
+    return match.group() if match else None
+
+
+def parse_email_date(date_str):
+    '''
+    Parse the Date header of an email, ignoring a trailing comment such
+    as "(UTC)".
+    Raises:
+        ValueError: If the header does not match EMAIL_DATE_FORMAT.
+    '''
+    date_str = date_str.split('(')[0].strip()
+    if not date_str:
+        raise ValueError('Invalid date')
+
+    match = EMAIL_DATE.fullmatch(date_str)
+    if not match:
+        return datetime.strptime(date_str, EMAIL_DATE_FORMAT)
+
+    day, month, year, hour, minute, second, offset = match.groups()
+    return datetime(
+        int(year), MONTHS[month], int(day),
+        int(hour), int(minute), int(second),
+        tzinfo=get_utc_offset(offset)
+    )
+
+
 class EmailDBHelper:
     ''''
     Email database helper class to interact
     with the SQLite database.
+
+    Each thread keeps one connection open for the lifetime of the
+    helper, so repeated small queries reuse the connection and its
+    prepared statements. Use the helper as a context manager, or call
+    close, to close the connections.
     '''
     def __init__(self, db_path='', table_name='') -> None:
         self.db_path = db_path or EMAILS_DB_PATH
         self.table_name = table_name or EMAIL_TABLE_NAME
+        self._queries = {}
+        self._tables_ready = False
+        self._full_text_index = False
+        self._lock = threading.Lock()
+        self._reset_connections()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _reset_connections(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._connections = []
+
+    def _open_connection(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=SQLITE_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS
+        )
+        # WAL lets readers run alongside a writer, and NORMAL only syncs
+        # at checkpoints, which stays consistent in WAL mode
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE}')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
 
     def get_db_instance(self):
-        return sqlite3.connect(self.db_path)
+        '''
+        Get the connection of the current thread, opening it on first use.
+        '''
+        if self._pid != os.getpid():
+            # Connections must not be shared with a forked process
+            self._reset_connections()
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open_connection()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        '''
+        Close the connections opened by this helper.
+        '''
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def _connect(self):
+        if not self._tables_ready:
+            self.create_emails_table()
+        return self.get_db_instance()
+
+    def _query(self, name):
+        query = self._queries.get(name)
+        if query is None:
+            query = EMAIL_QUERIES[name].format(
+                email_table_name=self.table_name,
+                email_columns=EMAIL_COLUMNS
+            )
+            self._queries[name] = query
+        return query
+
+    def _query_for_ids(self, name, count):
+        return EMAIL_QUERIES[name].format(
+            email_table_name=self.table_name,
+            email_columns=EMAIL_COLUMNS,
+            placeholders=', '.join('?' * count)
+        )
+
+    def _query_where(self, name, where):
+        return EMAIL_QUERIES[name].format(
+            email_table_name=self.table_name,
+            email_columns=EMAIL_COLUMNS,
+            where=where.format(email_table_name=self.table_name)
+        )
 
     def create_emails_table(self, remove_existing=False):
+        '''
+        Create the tables, or migrate existing ones to the latest schema
+        version in place.
+        Args:
+            remove_existing (bool): If True, drop the tables and every
+            email stored in them first.
+        Returns:
+            list: The columns of the emails table.
+        '''
         conn = self.get_db_instance()
         cursor = conn.cursor()
 
         if remove_existing:
-            cursor.execute(EMAIL_QUERIES['DROP_EMAIL_TABLE'].format(
-                email_table_name=self.table_name))
+            cursor.execute(self._query('DROP_FTS_TABLE'))
+            cursor.execute(self._query('DROP_EMAIL_TABLE'))
+            cursor.execute(self._query('DROP_SYNC_STATE_TABLE'))
+            cursor.execute(self._query('DROP_SYNC_CHECKPOINT_TABLE'))
+            cursor.execute(self._query('DROP_LABELS_TABLE'))
+            cursor.execute(self._query('DROP_BODIES_TABLE'))
+            cursor.execute(self._query('DROP_MESSAGE_LABELS_TABLE'))
+            cursor.execute(self._query('DROP_SCHEMA_VERSION_TABLE'))
             conn.commit()
 
-        cursor.execute(EMAIL_QUERIES['CREATE_EMAIL_TABLE'].format(
-            email_table_name=self.table_name))
-        conn.commit()
+        self.migrate()
+        self._full_text_index = cursor.execute(
+            self._query('SELECT_TABLE'), (f'{self.table_name}_fts',)
+        ).fetchone() is not None
+        if not self._full_text_index:
+            # The index was skipped by a SQLite build without FTS5 when the
+            # tables were migrated, so try again with this one
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                self._full_text_index = self._create_full_text_index(cursor)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        self._tables_ready = True
 
         # Fetch table structure
         cursor.execute("PRAGMA table_info({})".format(self.table_name))
-        table_structure = cursor.fetchall()
-        conn.close()
-        return table_structure
-
-    def _validate_date(self, date_str):
-        date_str = date_str.split('(')[0].strip()
-        if not date_str:
-            raise ValueError('Invalid date')
+        return cursor.fetchall()
 
-        date_obj = datetime.strptime(
-            date_str, "%a, %d %b %Y %H:%M:%S %z")
-        return date_obj
+    def schema_version(self):
+        '''
+        Get the schema version of the tables, 0 if they were created
+        before versions were recorded.
+        '''
+        conn = self.get_db_instance()
+        conn.execute(self._query('CREATE_SCHEMA_VERSION_TABLE'))
+        return conn.execute(self._query('SELECT_SCHEMA_VERSION')).fetchone()[0]
 
-    def insert_emails_into_table(self, email_data):
-        self.create_emails_table()
+    def migrate(self):
+        '''
+        Apply the pending SCHEMA_MIGRATIONS to the tables, each in its own
+        transaction. Stored emails are kept and their new columns derived
+        from the raw data, so no email is fetched from Gmail again.
+        Returns:
+            int: The schema version of the tables.
+        '''
         conn = self.get_db_instance()
         cursor = conn.cursor()
+        version = self.schema_version()
+        conn.commit()
+        while version < len(SCHEMA_MIGRATIONS):
+            # Take the write lock before reading the version, so that
+            # processes opening the same tables migrate them only once
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                version = cursor.execute(
+                    self._query('SELECT_SCHEMA_VERSION')).fetchone()[0]
+                if version < len(SCHEMA_MIGRATIONS):
+                    getattr(self, SCHEMA_MIGRATIONS[version])(cursor)
+                    version += 1
+                    cursor.execute(
+                        self._query('INSERT_SCHEMA_VERSION'),
+                        (version, datetime.now(timezone.utc).isoformat())
+                    )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        return version
+
+    def _create_base_tables(self, cursor):
+        cursor.execute(self._query('CREATE_EMAIL_TABLE'))
+        cursor.execute(self._query('CREATE_SYNC_STATE_TABLE'))
+        cursor.execute(self._query('CREATE_SYNC_CHECKPOINT_TABLE'))
+        cursor.execute(self._query('CREATE_LABELS_TABLE'))
+        cursor.execute(self._query('CREATE_BODIES_TABLE'))
+
+    def _add_derived_columns(self, cursor):
+        cursor.execute("PRAGMA table_info({})".format(self.table_name))
+        columns = [column[1] for column in cursor.fetchall()]
+        missing_columns = [
+            column for column in DERIVED_COLUMNS if column not in columns]
+        if missing_columns:
+            for column in missing_columns:
+                cursor.execute(self._query(DERIVED_COLUMNS[column]))
+            self._backfill_derived_fields(cursor)
+
+        cursor.execute(self._query('CREATE_DATE_EPOCH_INDEX'))
+        cursor.execute(self._query('CREATE_SENDER_ADDRESS_INDEX'))
+        cursor.execute(self._query('CREATE_RECIPIENT_ADDRESS_INDEX'))
+
+    def _create_full_text_index(self, cursor):
+        exists = cursor.execute(
+            self._query('SELECT_TABLE'), (f'{self.table_name}_fts',)
+        ).fetchone()
+        try:
+            cursor.execute(self._query('CREATE_FTS_TABLE'))
+        except sqlite3.OperationalError:
+            # SQLite builds without FTS5 or its trigram tokenizer (3.34+)
+            # fall back to scanning the emails table
+            return False
+
+        cursor.execute(self._query('CREATE_FTS_DELETE_TRIGGER'))
+        cursor.execute(self._query('CREATE_FTS_UPDATE_TRIGGER'))
+        if not exists:
+            # Index the emails stored before the index existed
+            cursor.execute(self._query('REBUILD_FTS_TABLE'))
+        return True
+
+    def _add_message_labels(self, cursor):
+        # The labels of the emails stored before are unknown until Gmail
+        # reports them, and are never fetched here
+        cursor.execute(self._query('CREATE_MESSAGE_LABELS_TABLE'))
+        cursor.execute("PRAGMA table_info({})".format(self.table_name))
+        if 'labels_known' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute(self._query('ADD_LABELS_KNOWN_COLUMN'))
+
+    def has_full_text_index(self):
+        '''
+        Check whether the subject and snippet of the emails are indexed
+        for full-text search, which needs SQLite 3.34 or later.
+        '''
+        self._connect()
+        return self._full_text_index
+
+    def _backfill_derived_fields(self, cursor):
+        # Derive the columns of emails stored before the columns existed
+        rows = cursor.execute(self._query('SELECT_RAW_FIELDS')).fetchall()
+        updates = []
+        for message_id, date_str, sender, recipient in rows:
+            try:
+                date_epoch = self._date_epoch(date_str)
+            except ValueError:
+                date_epoch = None
+            updates.append((
+                date_epoch,
+                extract_address(sender),
+                extract_address(recipient),
+                message_id
+            ))
+        cursor.executemany(self._query('UPDATE_DERIVED_FIELDS'), updates)
+
+    def _validate_date(self, date_str):
+        return parse_email_date(date_str)
+
+    def _date_epoch(self, date_str):
+        return int(self._validate_date(date_str).timestamp())
+
+    def _email_rows(self, email_data):
         for email in email_data:
             try:
-                self._validate_date(email['date'])
+                date_epoch = self._date_epoch(email['date'])
             except ValueError:
                 continue
 
-            cursor.execute(EMAIL_QUERIES['INSERT_EMAILS'].format(
-                email_table_name=self.table_name), (
+            yield (
                 email['message_id'],
                 email['subject'],
                 email['snippet'],
                 email['date'],
                 email['to'],
-                email['from'])
+                email['from'],
+                date_epoch,
+                extract_address(email['from']),
+                extract_address(email['to']),
+                1 if email.get('label_ids') is not None else None
             )
 
-        conn.commit()
-        conn.close()
+    def insert_emails_into_table(self, email_data):
+        '''
+        Insert emails in a single transaction, skipping emails with an
+        invalid date and emails already in the table. The labels of the
+        emails that have `label_ids` are stored as well.
+        Args:
+            email_data: An iterable of emails, inserted in chunks of
+            INSERT_CHUNK_SIZE rows.
+        '''
+        conn = self._connect()
+        query = self._query('INSERT_EMAILS')
+        emails = iter(email_data)
+        with conn:
+            # Take the write lock before reading the largest rowid, so that
+            # rows inserted by another connection in between are not
+            # indexed twice by INDEX_NEW_EMAILS
+            if not conn.in_transaction:
+                conn.execute('BEGIN IMMEDIATE')
+            max_rowid = conn.execute(
+                self._query('SELECT_MAX_ROWID')).fetchone()[0]
+            while chunk := list(islice(emails, INSERT_CHUNK_SIZE)):
+                rows = list(self._email_rows(chunk))
+                conn.executemany(query, rows)
+                stored_ids = {row[0] for row in rows}
+                self._replace_labels(conn, {
+                    email['message_id']: email['label_ids']
+                    for email in chunk
+                    if email.get('label_ids') is not None and
+                    email['message_id'] in stored_ids
+                })
 
-    def fetch_emails_from_table(self):
-        conn = self.get_db_instance()
-        cursor = conn.cursor()
-        cursor.execute(EMAIL_QUERIES['SELECT_EMAILS'].format(
-            email_table_name=self.table_name))
-        emails = cursor.fetchall()
-        conn.close()
+            if self._full_text_index:
+                conn.execute(
+                    self._query('INDEX_NEW_EMAILS'), (max_rowid or 0,))
 
-        email_list = []
-        for email in emails:
-            date_str = email[3].split('(')[0].strip()
-            if not date_str:
-                continue
+    def _replace_labels(self, conn, labels):
+        conn.executemany(
+            self._query('DELETE_MESSAGE_LABELS'),
+            [(message_id,) for message_id in labels]
+        )
+        conn.executemany(
+            self._query('UPSERT_MESSAGE_LABEL'),
+            [
+                (message_id, label_id, 1)
+                for message_id, label_ids in labels.items()
+                for label_id in label_ids
+            ]
+        )
+        conn.executemany(
+            self._query('SET_LABELS_KNOWN'),
+            [(message_id,) for message_id in labels]
+        )
 
-            try:
-                server_timezone = pytz.timezone(TIME_ZONE)
-                date_obj = datetime.strptime(
-                    date_str, "%a, %d %b %Y %H:%M:%S %z")
-
-                email_list.append({
-                    "message_id": email[0],
-                    "subject": email[1],
-                    "snippet": email[2],
-                    "date": date_obj.astimezone(server_timezone),
-                    "to": email[4],
-                    "from": email[5]
-                })
-            except ValueError:
-                continue
+    def set_message_labels(self, labels):
+        '''
+        Store every label of some emails, as reported by Gmail.
+        Args:
+            labels (dict): The label ids of each email, by message ID.
+        '''
+        conn = self._connect()
+        with conn:
+            self._replace_labels(conn, labels)
 
-        return email_list
+    def clear_message_labels(self):
+        '''
+        Forget the labels of every email, for when changes made in Gmail
+        may have been missed.
+        '''
+        conn = self._connect()
+        with conn:
+            conn.execute(self._query('CLEAR_MESSAGE_LABELS'))
+            conn.execute(self._query('CLEAR_LABELS_KNOWN'))
 
-    def fetch_email_by_id(self, message_id):
+    def update_message_labels(
+        self,
+        message_ids,
+        add_label_ids=(),
+        remove_label_ids=()
+    ):
         '''
-        Fetch an email by its message ID.
+        Record labels added to and removed from emails in Gmail.
         '''
-        conn = self.get_db_instance()
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                self._query('UPSERT_MESSAGE_LABEL'),
+                [
+                    (message_id, label_id, present)
+                    for label_ids, present in [
+                        (add_label_ids, 1), (remove_label_ids, 0)]
+                    for label_id in label_ids
+                    for message_id in message_ids
+                ]
+            )
+
+    def fetch_label_states(self, message_ids):
+        '''
+        Fetch what is known of the labels of emails.
+        Returns:
+            dict: For the message ID of each email in the table, whether
+            all of its labels are known, and whether each known label is
+            on the email.
+        '''
+        cursor = self._connect().cursor()
+        states = {}
+        for start in range(0, len(message_ids), MAX_QUERY_PARAMS):
+            chunk = message_ids[start:start + MAX_QUERY_PARAMS]
+            cursor.execute(self._query_for_ids(
+                'SELECT_LABEL_STATES_BY_IDS', len(chunk)), chunk)
+            for message_id, known, label_id, present in cursor:
+                _, labels = states.setdefault(
+                    message_id, (bool(known), {}))
+                if label_id is not None:
+                    labels[label_id] = bool(present)
+        return states
+
+    def delete_emails_from_table(self, message_ids):
+        '''
+        Delete emails by their message IDs.
+        '''
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute(EMAIL_QUERIES['SELECT_EMAILS_BY_ID'].format(
-            email_table_name=self.table_name), (message_id,))
-        email = cursor.fetchone()
+        cursor.executemany(
+            self._query('DELETE_EMAILS'),
+            [(message_id,) for message_id in message_ids]
+        )
+        cursor.executemany(
+            self._query('DELETE_BODIES'),
+            [(message_id,) for message_id in message_ids]
+        )
+        cursor.executemany(
+            self._query('DELETE_MESSAGE_LABELS'),
+            [(message_id,) for message_id in message_ids]
+        )
+        conn.commit()
 
-        if not email:
-            raise DoesNotExist(
-                f'Email with pk {message_id} does not exist.')
+    def get_sync_state(self, key):
+        '''
+        Get a sync state value, or None if it is not set.
+        '''
+        cursor = self._connect().cursor()
+        cursor.execute(self._query('SELECT_SYNC_STATE'), (key,))
+        row = cursor.fetchone()
+        return row[0] if row else None
 
-        conn.close()
+    def set_sync_state(self, key, value):
+        '''
+        Set a sync state value.
+        '''
+        conn = self._connect()
+        conn.execute(self._query('UPSERT_SYNC_STATE'), (key, value))
+        conn.commit()
+
+    def get_sync_checkpoint(self, name):
+        '''
+        Get a sync checkpoint, or None if there is no such checkpoint.
+        '''
+        cursor = self._connect().cursor()
+        cursor.execute(self._query('SELECT_SYNC_CHECKPOINT'), (name,))
+        row = cursor.fetchone()
+
+        if not row:
+            return None
 
-        date_obj = self._validate_date(email[3])
+        return {
+            "page_token": row[0],
+            "history_id": row[1],
+            "pages": row[2],
+            "messages": row[3],
+            "updated_at": row[4]
+        }
+
+    def get_sync_checkpoints(self, prefix):
+        '''
+        Get the sync checkpoints whose name starts with a prefix.
+        Returns:
+            dict: The checkpoints keyed by name.
+        '''
+        cursor = self._connect().cursor()
+        cursor.execute(
+            self._query('SELECT_SYNC_CHECKPOINTS'), (len(prefix), prefix))
+        rows = cursor.fetchall()
+
+        return {
+            row[0]: {
+                "page_token": row[1],
+                "history_id": row[2],
+                "pages": row[3],
+                "messages": row[4],
+                "updated_at": row[5]
+            }
+            for row in rows
+        }
+
+    def save_sync_checkpoint(
+        self,
+        name,
+        page_token,
+        history_id,
+        pages,
+        messages
+    ):
+        '''
+        Save the progress of a sync so that it can be resumed.
+        '''
+        conn = self._connect()
+        conn.execute(self._query('UPSERT_SYNC_CHECKPOINT'), (
+            name,
+            page_token,
+            history_id,
+            pages,
+            messages,
+            datetime.now(timezone.utc).isoformat())
+        )
+        conn.commit()
+
+    def delete_sync_checkpoint(self, name):
+        '''
+        Delete a sync checkpoint once its sync has completed.
+        '''
+        conn = self._connect()
+        conn.execute(self._query('DELETE_SYNC_CHECKPOINT'), (name,))
+        conn.commit()
+
+    def fetch_labels(self):
+        '''
+        Fetch the cached Gmail labels.
+        Returns:
+            tuple: The labels, and the time they were fetched at or None
+            if no labels are cached.
+        '''
+        cursor = self._connect().cursor()
+        cursor.execute(self._query('SELECT_LABELS'))
+        rows = cursor.fetchall()
+
+        labels = [{"id": row[0], "name": row[1]} for row in rows]
+        fetched_at = min((row[2] for row in rows), default=None)
+        return labels, fetched_at
+
+    def save_labels(self, labels, fetched_at):
+        '''
+        Replace the cached Gmail labels.
+        '''
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute(self._query('DELETE_LABELS'))
+        cursor.executemany(
+            self._query('INSERT_LABELS'),
+            [(label['id'], label['name'], fetched_at) for label in labels]
+        )
+        conn.commit()
+
+    def _parse_email(self, email, server_timezone):
         return {
             "message_id": email[0],
             "subject": email[1],
             "snippet": email[2],
-            "date": date_obj.astimezone(pytz.timezone(TIME_ZONE)),
+            "date": datetime.fromtimestamp(email[3], server_timezone),
             "to": email[4],
             "from": email[5]
         }
+
+    def _parse_emails(self, emails):
+        # zoneinfo converts timestamps several times faster than pytz
+        server_timezone = ZoneInfo(TIME_ZONE)
+        return [
+            self._parse_email(email, server_timezone)
+            for email in emails if email[3] is not None
+        ]
+
+    def fetch_emails_from_table(self):
+        cursor = self._connect().cursor()
+        cursor.execute(self._query('SELECT_EMAILS'))
+        emails = cursor.fetchall()
+
+        return self._parse_emails(emails)
+
+    def fetch_emails_by_ids(self, message_ids):
+        '''
+        Fetch the emails with the given message IDs, in table order.
+        '''
+        cursor = self._connect().cursor()
+        emails = []
+        for start in range(0, len(message_ids), MAX_QUERY_PARAMS):
+            chunk = message_ids[start:start + MAX_QUERY_PARAMS]
+            cursor.execute(self._query_for_ids(
+                'SELECT_EMAILS_BY_IDS', len(chunk)), chunk)
+            emails.extend(cursor.fetchall())
+
+        return self._parse_emails(emails)
+
+    def iter_emails(
+        self,
+        columns=None,
+        where='',
+        params=(),
+        order_by='message_id',
+        after=None,
+        limit=None,
+        arraysize=ITER_ARRAYSIZE
+    ):
+        '''
+        Stream the emails of the table, fetching `arraysize` rows at a
+        time so that any number of emails is read in constant memory.
+        Args:
+            columns (list): The keys of the emails to read, all of them
+            if not given.
+            where (str): An SQL condition the emails match, as built by
+            build_rule_sql.
+            order_by (str): 'message_id' or 'date', the order the emails
+            are read in.
+            after: Only read the emails after this key, to read the next
+            page of emails. The key is the message ID of the last email
+            read, or a tuple of its date and message ID when ordered by
+            date.
+            limit (int): The most emails read, or all if not given.
+        Yields:
+            dict: The emails.
+        '''
+        columns = columns or list(EMAIL_FIELDS)
+        invalid = [column for column in columns if column not in EMAIL_FIELDS]
+        if invalid or order_by not in EMAIL_ORDERS:
+            raise ValueError(
+                f'Invalid columns or order: {invalid or order_by}')
+
+        conditions = [where] if where else []
+        params = list(params)
+        if after is not None and order_by == 'date':
+            date, message_id = after
+            if isinstance(date, datetime):
+                date = date.timestamp()
+            conditions.append('(date_epoch, message_id) > (?, ?)')
+            params.extend([date, message_id])
+        elif after is not None:
+            conditions.append('message_id > ?')
+            params.append(after)
+        params.append(-1 if limit is None else limit)
+
+        query = EMAIL_QUERIES['ITER_EMAILS'].format(
+            email_table_name=self.table_name,
+            columns=', '.join(EMAIL_FIELDS[column] for column in columns),
+            where=' AND '.join(
+                f'({condition})' for condition in conditions
+            ).format(email_table_name=self.table_name) or '1',
+            order_by=EMAIL_ORDERS[order_by]
+        )
+        cursor = self._connect().cursor()
+        cursor.arraysize = arraysize
+        cursor.execute(query, params)
+
+        server_timezone = ZoneInfo(TIME_ZONE)
+        parse_date = 'date' in columns
+        try:
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
+                for row in rows:
+                    email = dict(zip(columns, row))
+                    if parse_date:
+                        email['date'] = datetime.fromtimestamp(
+                            email['date'], server_timezone)
+                    yield email
+        finally:
+            cursor.close()
+
+    def search_emails(self, text):
+        '''
+        Stream the emails whose subject or snippet contains a text,
+        ignoring case.
+        '''
+        where, params = build_search_sql(text, self.has_full_text_index())
+        return self.iter_emails(where=where, params=params)
+
+    def fetch_message_ids_where(self, where, params=()):
+        '''
+        Fetch the message IDs of the emails matching an SQL condition, as
+        built by build_rule_sql.
+        '''
+        cursor = self._connect().cursor()
+        cursor.execute(
+            self._query_where('SELECT_MESSAGE_IDS_WHERE', where), params)
+        return [row[0] for row in cursor]
+
+    def fetch_bodies(self, message_ids):
+        '''
+        Fetch the stored bodies of emails.
+        Returns:
+            dict: The bodies of the emails that have one stored, keyed by
+            message ID.
+        '''
+        cursor = self._connect().cursor()
+        bodies = {}
+        for start in range(0, len(message_ids), MAX_QUERY_PARAMS):
+            chunk = message_ids[start:start + MAX_QUERY_PARAMS]
+            cursor.execute(self._query_for_ids(
+                'SELECT_BODIES_BY_IDS', len(chunk)), chunk)
+            for message_id, body in cursor:
+                bodies[message_id] = zlib.decompress(body).decode('utf-8')
+        return bodies
+
+    def save_bodies(self, bodies):
+        '''
+        Store the bodies of emails compressed.
+        Args:
+            bodies (dict): The bodies keyed by message ID.
+        '''
+        conn = self._connect()
+        conn.executemany(self._query('INSERT_BODIES'), [
+            (message_id, zlib.compress(body.encode('utf-8')))
+            for message_id, body in bodies.items()
+        ])
+        conn.commit()
+
+    def fetch_message_ids(self):
+        '''
+        Fetch the set of message IDs stored in the table.
+        '''
+        cursor = self._connect().cursor()
+        cursor.execute(self._query('SELECT_MESSAGE_IDS'))
+        return {row[0] for row in cursor}
+
+    def fetch_email_by_id(self, message_id):
+        '''
+        Fetch an email by its message ID.
+        '''
+        cursor = self._connect().cursor()
+        cursor.execute(self._query('SELECT_EMAILS_BY_ID'), (message_id,))
+        email = cursor.fetchone()
+
+        if not email:
+            raise DoesNotExist(
+                f'Email with pk {message_id} does not exist.')
+        if email[3] is None:
+            raise ValueError('Invalid date')
+
+        return self._parse_email(email, ZoneInfo(TIME_ZONE))
@@ -17,3 +17,10 @@ class DoesNotExist(Exception):
     Raised when an object does not exist.
     '''
     pass
+
+
+class HistoryExpired(Exception):
+    '''
+    Raised when a mailbox history id is too old to sync from.
+    '''
+    pass
@@ -0,0 +1,693 @@
+import base64
+import json
+import random
+import re
+import threading
+import time
+
+from argparse import ArgumentParser
+from collections import Counter
+from email.parser import BytesParser
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from .api_client import MAX_BATCH_MODIFY_SIZE, MAX_BATCH_SIZE
+from .rate_limit import QUOTA_UNITS
+
+API_PREFIX = '/gmail/v1/users/me/'
+BATCH_PATH = '/batch/gmail/v1'
+SYSTEM_LABELS = [
+    'INBOX',
+    'SENT',
+    'DRAFT',
+    'SPAM',
+    'TRASH',
+    'UNREAD',
+    'STARRED',
+    'IMPORTANT'
+]
+STATUS_REASONS = {
+    200: 'OK',
+    204: 'No Content',
+    400: 'Bad Request',
+    404: 'Not Found',
+    429: 'Too Many Requests',
+    503: 'Service Unavailable'
+}
+QUERY_TOKEN = re.compile(r'[{}]|[^\s{}"]+:"[^"]*"|"[^"]*"|[^\s{}]+')
+RELATIVE_UNITS = {'d': 1, 'm': 30, 'y': 365}  # Days per unit
+HISTORY_KEYS = {
+    'messageAdded': 'messagesAdded',
+    'messageDeleted': 'messagesDeleted',
+    'labelAdded': 'labelsAdded',
+    'labelRemoved': 'labelsRemoved'
+}
+
+
+class FakeGmailError(Exception):
+    '''
+    An error response of the fake Gmail API.
+    '''
+    def __init__(self, status, reason, message) -> None:
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    def to_json(self):
+        return {
+            'error': {
+                'code': self.status,
+                'message': self.message,
+                'errors': [{
+                    'domain': 'global',
+                    'reason': self.reason,
+                    'message': self.message
+                }]
+            }
+        }
+
+
+def parse_date_term(value):
+    '''
+    Parse the value of an after: or before: search term, given either as
+    seconds since the epoch or as a yyyy/mm/dd date.
+    '''
+    if value.isdigit():
+        return int(value)
+    date = datetime.strptime(value.replace('-', '/'), '%Y/%m/%d')
+    return int(date.replace(tzinfo=timezone.utc).timestamp())
+
+
+class FakeGmailServer:
+    '''
+    A local stand-in for the Gmail API, for testing and load testing
+    without a Google account.
+
+    It serves messages.list, messages.get, messages.modify,
+    messages.batchModify, labels.list, history.list, getProfile and
+    batch requests from an in-memory mailbox. Every request is delayed by
+    `latency` seconds, API calls fail with a 503 at `error_rate` and, when
+    `quota_per_second` is set, calls spending more quota units than it
+    allows a second are throttled with a 429 rateLimitExceeded error.
+    Point a GmailClient at it with its `url` as the API endpoint.
+    '''
+    def __init__(
+        self,
+        host='127.0.0.1',
+        port=0,
+        latency=0,
+        error_rate=0,
+        quota_per_second=None,
+        labels=None,
+        seed=None
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_per_second = quota_per_second
+        self.calls = Counter()
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+        self.messages = {}
+        self._message_count = 0
+        self.labels = {
+            label_id: {'id': label_id, 'name': label_id, 'type': 'system'}
+            for label_id in SYSTEM_LABELS
+        }
+        for name in labels or []:
+            self.create_label(name)
+
+        self._history = []
+        self._history_id = 1
+        self._min_history_id = 1
+        self._random = random.Random(seed)
+        self._tokens = float(quota_per_second or 0)
+        self._updated_at = time.monotonic()
+
+        self.httpd = ThreadingHTTPServer((host, port), FakeGmailHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.gmail = self
+        self._thread = None
+
+    @property
+    def url(self):
+        '''
+        The API endpoint to point a GmailClient at.
+        '''
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self):
+        '''
+        Serve requests on a background thread.
+        '''
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop serving requests and close the listening socket.
+        '''
+        if self._thread:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _record(self, key, message):
+        self._history_id += 1
+        self._history.append((self._history_id, key, message['id']))
+        message['history_id'] = self._history_id
+
+    def create_label(self, name):
+        '''
+        Create a user label and return its id.
+        '''
+        with self._lock:
+            label_id = f'Label_{len(self.labels) - len(SYSTEM_LABELS) + 1}'
+            self.labels[label_id] = {
+                'id': label_id, 'name': name, 'type': 'user'}
+            return label_id
+
+    def add_message(
+        self,
+        sender,
+        to,
+        subject,
+        snippet='',
+        body='',
+        date=None,
+        label_ids=('INBOX', 'UNREAD')
+    ):
+        '''
+        Add a message to the mailbox and return its id.
+        Args:
+            date (datetime): When the message was received, now if not
+            given.
+        '''
+        date = date or datetime.now(timezone.utc)
+        with self._lock:
+            self._message_count += 1
+            message_id = format(self._message_count, '016x')
+            self.messages[message_id] = {
+                'id': message_id,
+                'thread_id': message_id,
+                'label_ids': list(label_ids),
+                'snippet': snippet or body[:100],
+                'body': body,
+                'internal_date': int(date.timestamp() * 1000),
+                'headers': [
+                    {'name': 'From', 'value': sender},
+                    {'name': 'To', 'value': to},
+                    {'name': 'Subject', 'value': subject},
+                    {'name': 'Date', 'value': format_datetime(date)}
+                ]
+            }
+            self._record('messagesAdded', self.messages[message_id])
+            return message_id
+
+    def populate(self, count, senders=10):
+        '''
+        Add `count` synthetic messages received an hour apart, the
+        newest an hour ago.
+        '''
+        now = datetime.now(timezone.utc)
+        return [
+            self.add_message(
+                f'Sender {index % senders} '
+                f'<sender{index % senders}@example.com>',
+                'me@example.com',
+                f'Message {index}',
+                body=f'Body of message {index}',
+                date=now - timedelta(hours=count - index)
+            )
+            for index in range(count)
+        ]
+
+    def delete_message(self, message_id):
+        '''
+        Delete a message from the mailbox.
+        '''
+        with self._lock:
+            message = self.messages.pop(message_id)
+            self._record('messagesDeleted', message)
+
+    def expire_history(self):
+        '''
+        Expire every history id handed out so far, so listing history
+        from them fails as it does once Gmail drops old history.
+        '''
+        with self._lock:
+            self._min_history_id = self._history_id
+
+    def _throttle(self, method, count):
+        with self._lock:
+            self.calls[method] += count
+            if not self.quota_per_second:
+                return
+
+            now = time.monotonic()
+            self._tokens = min(
+                self.quota_per_second,
+                self._tokens + (now - self._updated_at) * self.quota_per_second
+            )
+            self._updated_at = now
+            units = QUOTA_UNITS[method] * count
+            if self._tokens < units:
+                self.throttled += 1
+                raise FakeGmailError(
+                    429, 'rateLimitExceeded', 'User-rate limit exceeded')
+            self._tokens -= units
+
+    def call(self, method, path, params, body):
+        '''
+        Handle a single API call.
+        Args:
+            path (str): The request path below the users/me prefix.
+            params (dict): The query parameters, each a list of values.
+            body (dict): The decoded JSON request body.
+        Returns:
+            tuple: The response status and JSON body, or None for an
+            empty body.
+        '''
+        try:
+            name, handler, count = self._route(method, path, body)
+            self._throttle(name, count)
+            if self._random.random() < self.error_rate:
+                raise FakeGmailError(
+                    503, 'backendError', 'Backend Error')
+            with self._lock:
+                return handler(params, body)
+        except FakeGmailError as e:
+            return e.status, e.to_json()
+
+    def _route(self, method, path, body):
+        parts = path.split('/')
+        if method == 'GET' and path == 'messages':
+            return 'messages.list', self._list_messages, 1
+        if method == 'GET' and parts[0] == 'messages' and len(parts) == 2:
+            return 'messages.get', (
+                lambda params, body: self._get_message(parts[1], params)
+            ), 1
+        if method == 'POST' and path == 'messages/batchModify':
+            return 'messages.batchModify', self._batch_modify, 1
+        if (
+            method == 'POST' and len(parts) == 3 and
+            parts[0] == 'messages' and parts[2] == 'modify'
+        ):
+            return 'messages.modify', (
+                lambda params, body: self._modify_message(parts[1], body)
+            ), 1
+        if method == 'GET' and path == 'labels':
+            return 'labels.list', self._list_labels, 1
+        if method == 'GET' and path == 'history':
+            return 'history.list', self._list_history, 1
+        if method == 'GET' and path == 'profile':
+            return 'getProfile', self._get_profile, 1
+        raise FakeGmailError(404, 'notFound', f'No method at {path}')
+
+    def _get(self, message_id):
+        try:
+            return self.messages[message_id]
+        except KeyError:
+            raise FakeGmailError(
+                404, 'notFound', 'Requested entity was not found.')
+
+    def _matches(self, message, term):
+        field, _, value = term.partition(':')
+        value = value.strip('"').lower()
+        headers = {
+            header['name'].lower(): header['value'].lower()
+            for header in message['headers']
+        }
+        received = message['internal_date'] // 1000
+        if not value:
+            value, field = field.strip('"').lower(), ''
+
+        if field in ('from', 'to', 'subject'):
+            return value in headers[field]
+        elif field in ('older_than', 'newer_than'):
+            days = int(value[:-1]) * RELATIVE_UNITS[value[-1]]
+            cutoff = time.time() - days * 86400
+            return (received < cutoff) == (field == 'older_than')
+        elif field == 'after':
+            return received >= parse_date_term(value)
+        elif field == 'before':
+            return received < parse_date_term(value)
+        elif field in ('in', 'label'):
+            return value.upper() in message['label_ids']
+        elif field == 'is' and value in ('read', 'unread'):
+            return ('UNREAD' in message['label_ids']) == (value == 'unread')
+        return any(
+            value in text.lower()
+            for text in (headers['subject'], message['body'])
+        )
+
+    def _search(self, messages, query):
+        '''
+        Filter messages with the subset of the Gmail search syntax the
+        client sends: field terms, bare words and {} groups of
+        alternatives, all of which must match.
+        '''
+        groups = []
+        alternatives = None
+        for token in QUERY_TOKEN.findall(query):
+            if token == '{':
+                alternatives = []
+            elif token == '}':
+                groups.append(alternatives or [])
+                alternatives = None
+            elif alternatives is not None:
+                alternatives.append(token)
+            else:
+                groups.append([token])
+
+        return [
+            message for message in messages
+            if all(
+                any(self._matches(message, term) for term in terms)
+                for terms in groups
+            )
+        ]
+
+    def _list_messages(self, params, body):
+        messages = sorted(
+            self.messages.values(),
+            key=lambda message: message['internal_date'],
+            reverse=True
+        )
+        for label_id in params.get('labelIds', []):
+            messages = [
+                message for message in messages
+                if label_id in message['label_ids']
+            ]
+        if params.get('q'):
+            messages = self._search(messages, params['q'][0])
+
+        max_results = min(int(params.get('maxResults', ['100'])[0]), 500)
+        offset = int(params.get('pageToken', ['0'])[0])
+        page = messages[offset:offset + max_results]
+        response = {'resultSizeEstimate': len(messages)}
+        if page:
+            response['messages'] = [
+                {'id': message['id'], 'threadId': message['thread_id']}
+                for message in page
+            ]
+        if offset + max_results < len(messages):
+            response['nextPageToken'] = str(offset + max_results)
+        return 200, response
+
+    def _get_message(self, message_id, params):
+        message = self._get(message_id)
+        message_format = params.get('format', ['full'])[0]
+        response = {
+            'id': message['id'],
+            'threadId': message['thread_id'],
+            'labelIds': list(message['label_ids']),
+            'historyId': str(message['history_id'])
+        }
+        if message_format == 'minimal':
+            return 200, response
+
+        response['snippet'] = message['snippet']
+        response['internalDate'] = str(message['internal_date'])
+        if message_format == 'metadata':
+            names = {
+                name.lower() for name in params.get('metadataHeaders', [])
+            }
+            headers = [
+                header for header in message['headers']
+                if not names or header['name'].lower() in names
+            ]
+            response['payload'] = {'headers': headers}
+        else:
+            data = base64.urlsafe_b64encode(message['body'].encode()).decode()
+            response['payload'] = {
+                'mimeType': 'text/plain',
+                'headers': list(message['headers']),
+                'body': {'size': len(message['body']), 'data': data}
+            }
+
+        if params.get('fields'):
+            fields = {
+                field.split('/')[0]
+                for field in params['fields'][0].split(',')
+            }
+            response = {
+                key: value for key, value in response.items() if key in fields
+            }
+        return 200, response
+
+    def _check_labels(self, label_ids):
+        for label_id in label_ids:
+            if label_id not in self.labels:
+                raise FakeGmailError(
+                    400, 'invalidArgument', f'Invalid label: {label_id}')
+
+    def _change_labels(self, message, add_label_ids, remove_label_ids):
+        self._check_labels(add_label_ids + remove_label_ids)
+        added = [
+            label_id for label_id in add_label_ids
+            if label_id not in message['label_ids']
+        ]
+        removed = [
+            label_id for label_id in remove_label_ids
+            if label_id in message['label_ids'] and label_id not in added
+        ]
+        message['label_ids'] = [
+            label_id for label_id in message['label_ids']
+            if label_id not in removed
+        ] + added
+        if added:
+            self._record('labelsAdded', message)
+        if removed:
+            self._record('labelsRemoved', message)
+
+    def _modify_message(self, message_id, body):
+        message = self._get(message_id)
+        self._change_labels(
+            message,
+            body.get('addLabelIds', []),
+            body.get('removeLabelIds', [])
+        )
+        return 200, {
+            'id': message['id'],
+            'threadId': message['thread_id'],
+            'labelIds': list(message['label_ids'])
+        }
+
+    def _batch_modify(self, params, body):
+        ids = body.get('ids', [])
+        if len(ids) > MAX_BATCH_MODIFY_SIZE:
+            raise FakeGmailError(
+                400, 'invalidArgument', 'Too many ids in request')
+        self._check_labels(
+            body.get('addLabelIds', []) + body.get('removeLabelIds', []))
+        for message_id in ids:
+            if message_id in self.messages:
+                self._change_labels(
+                    self.messages[message_id],
+                    body.get('addLabelIds', []),
+                    body.get('removeLabelIds', [])
+                )
+        return 204, None
+
+    def _list_labels(self, params, body):
+        return 200, {'labels': list(self.labels.values())}
+
+    def _list_history(self, params, body):
+        start_history_id = int(params['startHistoryId'][0])
+        if start_history_id < self._min_history_id:
+            raise FakeGmailError(
+                404, 'notFound', 'Requested entity was not found.')
+
+        keys = {
+            HISTORY_KEYS[history_type]
+            for history_type in params.get('historyTypes', [])
+        }
+        records = [
+            {
+                'id': str(history_id),
+                'messages': [{'id': message_id}],
+                key: [{'message': self._history_message(message_id)}]
+            }
+            for history_id, key, message_id in self._history
+            if history_id > start_history_id and (not keys or key in keys)
+        ]
+        max_results = min(int(params.get('maxResults', ['100'])[0]), 500)
+        offset = int(params.get('pageToken', ['0'])[0])
+        response = {'historyId': str(self._history_id)}
+        if records[offset:offset + max_results]:
+            response['history'] = records[offset:offset + max_results]
+        if offset + max_results < len(records):
+            response['nextPageToken'] = str(offset + max_results)
+        return 200, response
+
+    def _history_message(self, message_id):
+        # Like Gmail, history records carry the current labels of messages
+        # that still exist
+        message = {'id': message_id}
+        if message_id in self.messages:
+            message['labelIds'] = list(self.messages[message_id]['label_ids'])
+        return message
+
+    def _get_profile(self, params, body):
+        return 200, {
+            'emailAddress': 'me@example.com',
+            'messagesTotal': len(self.messages),
+            'threadsTotal': len(self.messages),
+            'historyId': str(self._history_id)
+        }
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    '''
+    Serve the HTTP requests of a FakeGmailServer.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body=b'', content_type='application/json'):
+        self.send_response(status)
+        if body:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _call(self, method, target, body):
+        gmail = self.server.gmail
+        url = urlsplit(target)
+        if not url.path.startswith(API_PREFIX):
+            return 404, FakeGmailError(
+                404, 'notFound', f'No method at {url.path}').to_json()
+
+        try:
+            body = json.loads(body) if body else {}
+        except ValueError:
+            return 400, FakeGmailError(
+                400, 'parseError', 'Invalid JSON payload').to_json()
+        return gmail.call(
+            method,
+            url.path[len(API_PREFIX):],
+            parse_qs(url.query),
+            body
+        )
+
+    def _handle(self, method):
+        time.sleep(self.server.gmail.latency)
+        body = self._read_body()
+        if method == 'POST' and urlsplit(self.path).path == BATCH_PATH:
+            return self._handle_batch(body)
+
+        status, response = self._call(method, self.path, body)
+        self._send(status, json.dumps(response).encode() if response else b'')
+
+    def _handle_batch(self, body):
+        content_type = self.headers.get('Content-Type', '')
+        batch = BytesParser().parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        if not batch.is_multipart():
+            return self._send(400, json.dumps(FakeGmailError(
+                400, 'badRequest', 'Expected a multipart batch'
+            ).to_json()).encode())
+
+        parts = batch.get_payload()
+        if len(parts) > MAX_BATCH_SIZE:
+            return self._send(400, json.dumps(FakeGmailError(
+                400, 'badRequest', 'Too many requests in batch'
+            ).to_json()).encode())
+
+        boundary = f'batch_{random.getrandbits(64):016x}'
+        lines = []
+        for part in parts:
+            request = part.get_payload().replace('\r\n', '\n')
+            request_line, _, rest = request.partition('\n')
+            method, target, _ = request_line.split(' ', 2)
+            _, _, request_body = rest.partition('\n\n')
+
+            status, response = self._call(
+                method, target, request_body.encode())
+            content_id = ' '.join(part['Content-ID'].split())
+            lines += [
+                f'--{boundary}',
+                'Content-Type: application/http',
+                f'Content-ID: <response-{content_id[1:]}',
+                '',
+                f'HTTP/1.1 {status} {STATUS_REASONS.get(status, "")}',
+                'Content-Type: application/json; charset=UTF-8',
+                '',
+                json.dumps(response) if response else ''
+            ]
+        lines += [f'--{boundary}--', '']
+        self._send(
+            200,
+            '\r\n'.join(lines).encode(),
+            f'multipart/mixed; boundary={boundary}'
+        )
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def main():
+    parser = ArgumentParser(description='Serve a fake Gmail API')
+    parser.add_argument(
+        '--host', type=str, default='127.0.0.1', help='Host to listen on')
+    parser.add_argument(
+        '--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument(
+        '--messages',
+        type=int, default=1000, help='Number of messages in the mailbox')
+    parser.add_argument(
+        '--latency',
+        type=float, default=0, help='Seconds each request is delayed by')
+    parser.add_argument(
+        '--error-rate',
+        type=float, default=0, help='Fraction of API calls that fail')
+    parser.add_argument(
+        '--quota-per-second',
+        type=int, default=0,
+        help='Quota units allowed a second before calls are throttled')
+    args = parser.parse_args()
+
+    server = FakeGmailServer(
+        args.host,
+        args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        quota_per_second=args.quota_per_second or None
+    )
+    server.populate(args.messages)
+    print(f'Serving a fake Gmail API with {args.messages} messages at '
+          f'{server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
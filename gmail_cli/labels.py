@@ -0,0 +1,74 @@
+import time
+
+from .settings import LABEL_CACHE_TTL
+
+
+class LabelDirectory:
+    '''
+    Resolve Gmail mailbox names to label ids.
+
+    Labels are cached in memory and, when a database helper is given, in
+    the database for `ttl` seconds. A name missing from the cache forces
+    a refresh before it is reported as not found.
+    '''
+    def __init__(self, gmail_client, db_helper=None, ttl=LABEL_CACHE_TTL):
+        self.gmail_client = gmail_client
+        self.db_helper = db_helper
+        self.ttl = ttl
+        self._label_ids = {}
+        self._fetched_at = None
+
+    def _is_fresh(self, fetched_at):
+        return fetched_at is not None and time.time() - fetched_at < self.ttl
+
+    def _load(self):
+        if self._is_fresh(self._fetched_at):
+            return
+
+        if self.db_helper:
+            labels, fetched_at = self.db_helper.fetch_labels()
+            if self._is_fresh(fetched_at):
+                self._label_ids = {
+                    label['name']: label['id'] for label in labels}
+                self._fetched_at = fetched_at
+                return
+
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Fetch the labels from Gmail and cache them.
+        '''
+        labels = self.gmail_client.list_mailboxes()
+        if not labels:  # Every account has system labels
+            return
+
+        self._label_ids = {label['name']: label['id'] for label in labels}
+        self._fetched_at = time.time()
+        if self.db_helper:
+            self.db_helper.save_labels(labels, self._fetched_at)
+
+    def resolve(self, mailboxes):
+        '''
+        Get the label ids of mailboxes, refreshing the cache at most once.
+        Returns:
+            dict: Label ids keyed by mailbox name.
+        '''
+        if not mailboxes:
+            return {}
+
+        self._load()
+        if any(mailbox not in self._label_ids for mailbox in mailboxes):
+            self.refresh()
+
+        for mailbox in mailboxes:
+            if mailbox not in self._label_ids:
+                raise ValueError(f'Mailbox "{mailbox}" not found')
+
+        return {mailbox: self._label_ids[mailbox] for mailbox in mailboxes}
+
+    def get_label_id(self, mailbox):
+        '''
+        Get the label id of a mailbox by its name.
+        '''
+        return self.resolve([mailbox])[mailbox]
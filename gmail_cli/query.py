@@ -0,0 +1,92 @@
+import time
+
+from .settings import LIST_PARTITION_DAYS
+
+
+def quote(value):
+    '''
+    Quote a value for a Gmail search query, or return None if it cannot
+    be quoted.
+    '''
+    value = value.strip()
+    if not value or '"' in value:
+        return None
+    return f'"{value}"'
+
+
+def build_condition_query(condition):
+    '''
+    Translate a condition into a Gmail search term.
+
+    Contains conditions have no translation, as Gmail matches whole
+    words and would miss emails that only contain the value inside a
+    longer word, such as "voice" in "Invoice".
+    Returns:
+        str: The search term, or None if the condition has no
+        translation.
+    '''
+    field = condition['field']
+    operator = condition['operator']
+    value = condition['value']
+
+    if field in ('from', 'to') and operator == 'eq':
+        value = quote(value)
+        return f'{field}:{value}' if value else None
+    elif field == 'date_received' and operator == 'gt':
+        return f'older_than:{value}d'
+    elif field == 'date_received' and operator == 'lt':
+        return f'newer_than:{value}d'
+    return None
+
+
+def build_rule_query(rule):
+    '''
+    Translate a rule into a Gmail search query.
+
+    The query only narrows down the emails the rule is evaluated on, so
+    it may match more emails than the rule but should not match fewer.
+    Conditions of an 'all' rule that have no translation are dropped, as
+    the remaining terms still match every email the rule matches. An
+    'any' rule has a query only if all of its conditions translate.
+    Returns:
+        str: The search query, or None if the rule has no translation.
+    '''
+    terms = [
+        build_condition_query(condition) for condition in rule['conditions']
+    ]
+    if rule['predicate'] == 'all':
+        terms = [term for term in terms if term]
+        return ' '.join(terms) if terms else None
+    elif rule['predicate'] == 'any':
+        if not terms or not all(terms):
+            return None
+        return '{' + ' '.join(terms) + '}'
+    else:
+        raise ValueError('Invalid predicate')
+
+
+def partition_queries(partitions, days=0, now=None):
+    '''
+    Split the mailbox into date ranges that can be listed independently.
+
+    The newest range is open-ended so that it covers emails dated in the
+    future, and the oldest range covers every email older than the
+    others. The remaining ranges span `days` days each, or
+    LIST_PARTITION_DAYS if not given, newest first.
+    Neighbouring ranges overlap by two seconds, as Gmail does not say
+    which side of a bound an email received exactly on it falls.
+    Returns:
+        list: The search query of each range, or [None] for a single
+        range.
+    '''
+    if partitions <= 1:
+        return [None]
+
+    days = days or LIST_PARTITION_DAYS
+    now = int(now or time.time())
+    bounds = [now - index * days * 86400 for index in range(1, partitions)]
+    queries = [f'after:{bounds[0] - 1}']
+    for newer, older in zip(bounds, bounds[1:]):
+        queries.append(f'after:{older - 1} before:{newer + 1}')
+    queries.append(f'before:{bounds[-1] + 1}')
+    return queries
@@ -0,0 +1,281 @@
+import asyncio
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from .settings import (
+    GMAIL_QUOTA_PER_SECOND,
+    REQUEST_MAX_RETRIES,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY
+)
+
+# Quota units charged by Gmail for each API method
+QUOTA_UNITS = {
+    'messages.get': 5,
+    'messages.list': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'labels.list': 1,
+    'history.list': 2,
+    'getProfile': 1
+}
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+def is_retryable_error(exception):
+    '''
+    Check whether a failed request is worth retrying.
+    '''
+    if not isinstance(exception, HttpError):
+        return False
+
+    status = exception.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+
+    if status == 403:
+        # Gmail reports quota errors as 403 with a rateLimitExceeded,
+        # userRateLimitExceeded or RATE_LIMIT_EXCEEDED reason
+        content = exception.content.lower().replace(b'_', b'')
+        return b'ratelimitexceeded' in content
+    return False
+
+
+def get_retry_after(exception):
+    '''
+    Get the delay in seconds a throttled response asks for, if any.
+    '''
+    try:
+        return float(exception.resp['retry-after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    '''
+    Schedule Gmail API requests within the per-user quota.
+
+    Requests are paced by a token bucket refilled with `quota_per_second`
+    quota units a second. Throttled and failed requests are retried with
+    jittered exponential backoff. The number of concurrent requests is
+    halved whenever Gmail throttles and grows back by one after as many
+    successful requests as the current limit.
+    '''
+    def __init__(
+        self,
+        quota_per_second=GMAIL_QUOTA_PER_SECOND,
+        max_concurrency=1,
+        max_retries=REQUEST_MAX_RETRIES,
+        base_delay=RETRY_BASE_DELAY,
+        max_delay=RETRY_MAX_DELAY
+    ) -> None:
+        self.quota_per_second = quota_per_second
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.concurrency = self.max_concurrency
+        self._tokens = float(quota_per_second)
+        self._updated_at = time.monotonic()
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def _take(self, units):
+        # Spend the units if the bucket allows it, or return the seconds
+        # to wait for it to
+        self._refill()
+        needed = min(units, self.quota_per_second)
+        if self._tokens >= needed:
+            self._tokens -= units
+            return 0
+        return (needed - self._tokens) / self.quota_per_second
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.quota_per_second,
+            self._tokens + (now - self._updated_at) * self.quota_per_second
+        )
+        self._updated_at = now
+
+    def acquire(self, units):
+        '''
+        Wait until the quota allows spending `units` quota units.
+
+        Requests costing more than a second of quota wait for a full
+        bucket and leave it in debt.
+        '''
+        with self._condition:
+            while True:
+                delay = self._take(units)
+                if not delay:
+                    return
+                self._condition.wait(delay)
+
+    def _acquire_slot(self):
+        with self._condition:
+            while self._in_flight >= self.concurrency:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def _release_slot(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _grow(self):
+        # Returns whether the concurrency limit grew
+        self._successes += 1
+        if (
+            self._successes >= self.concurrency and
+            self.concurrency < self.max_concurrency
+        ):
+            self.concurrency += 1
+            self._successes = 0
+            return True
+        return False
+
+    def _shrink(self):
+        self.concurrency = max(1, self.concurrency // 2)
+        self._successes = 0
+
+    def record_success(self):
+        '''
+        Record a successful request, growing the concurrency limit.
+        '''
+        with self._condition:
+            if self._grow():
+                self._condition.notify_all()
+
+    def record_throttled(self):
+        '''
+        Record a throttled request, halving the concurrency limit.
+        '''
+        with self._condition:
+            self._shrink()
+
+    def get_backoff_delay(self, attempt, exception=None):
+        '''
+        Get the seconds to wait before retrying a request for the given
+        attempt.
+        '''
+        delay = get_retry_after(exception)
+        if delay is None:
+            delay = random.uniform(
+                0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return delay
+
+    def backoff(self, attempt, exception=None):
+        '''
+        Sleep before retrying a request for the given attempt.
+        '''
+        time.sleep(self.get_backoff_delay(attempt, exception))
+
+    def execute(self, request, units):
+        '''
+        Execute a request once the quota allows it, retrying it when it
+        is throttled or fails with a server error.
+        Raises:
+            HttpError: If the request fails for good.
+        '''
+        for attempt in range(self.max_retries + 1):
+            self._acquire_slot()
+            try:
+                self.acquire(units)
+                response = request.execute()
+            except Exception as e:
+                if not is_retryable_error(e) or attempt == self.max_retries:
+                    raise
+                self.record_throttled()
+                error = e
+            else:
+                self.record_success()
+                return response
+            finally:
+                self._release_slot()
+
+            self.backoff(attempt, error)
+
+
+class AsyncRequestScheduler(RequestScheduler):
+    '''
+    A RequestScheduler for coroutines, which waits on the event loop
+    instead of blocking the thread.
+    '''
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, units):
+        '''
+        Wait until the quota allows spending `units` quota units.
+        '''
+        while True:
+            delay = self._take(units)
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    async def _acquire_slot(self):
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self._in_flight < self.concurrency)
+            self._in_flight += 1
+
+    async def _release_slot(self):
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    async def record_success(self):
+        '''
+        Record a successful request, growing the concurrency limit.
+        '''
+        async with self._condition:
+            if self._grow():
+                self._condition.notify_all()
+
+    async def record_throttled(self):
+        '''
+        Record a throttled request, halving the concurrency limit.
+        '''
+        self._shrink()
+
+    async def backoff(self, attempt, exception=None):
+        '''
+        Wait before retrying a request for the given attempt.
+        '''
+        await asyncio.sleep(self.get_backoff_delay(attempt, exception))
+
+    async def execute(self, send, units):
+        '''
+        Send a request once the quota allows it, retrying it when it is
+        throttled or fails with a server error.
+        Args:
+            send: A coroutine function sending the request, called again
+            for every retry.
+        Raises:
+            HttpError: If the request fails for good.
+        '''
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_slot()
+            try:
+                await self.acquire(units)
+                response = await send()
+            except Exception as e:
+                if not is_retryable_error(e) or attempt == self.max_retries:
+                    raise
+                await self.record_throttled()
+                error = e
+            else:
+                await self.record_success()
+                return response
+            finally:
+                await self._release_slot()
+
+            await self.backoff(attempt, error)
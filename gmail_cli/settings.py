@@ -12,7 +12,27 @@ CREDENTIALS_FILE_PATH = environ.get("CREDENTIALS_FILE_PATH",
                                     "credentials.json")
 TOKEN_FILE_PATH = environ.get("TOKEN_FILE_PATH", "token.json")
 
+# HTTP settings
+GMAIL_API_ENDPOINT = environ.get("GMAIL_API_ENDPOINT", "")
+TOKEN_REFRESH_MARGIN = int(environ.get("TOKEN_REFRESH_MARGIN", 300))  # Seconds
+HTTP_TIMEOUT = int(environ.get("HTTP_TIMEOUT", 60))  # Seconds
+GMAIL_BATCH_SIZE = int(environ.get("GMAIL_BATCH_SIZE", 100))
+FETCH_WORKERS = int(environ.get("FETCH_WORKERS", 1))
+ASYNC_CONCURRENCY = int(environ.get("ASYNC_CONCURRENCY", 100))
+LIST_PARTITIONS = int(environ.get("LIST_PARTITIONS", 1))
+LIST_PARTITION_DAYS = int(environ.get("LIST_PARTITION_DAYS", 365))
+SYNC_COMMIT_SIZE = int(environ.get("SYNC_COMMIT_SIZE", 1000))
+LABEL_CACHE_TTL = int(environ.get("LABEL_CACHE_TTL", 3600))  # Seconds
+
+# Rate limit settings
+GMAIL_QUOTA_PER_SECOND = int(environ.get("GMAIL_QUOTA_PER_SECOND", 250))
+REQUEST_MAX_RETRIES = int(environ.get("REQUEST_MAX_RETRIES", 5))
+RETRY_BASE_DELAY = float(environ.get("RETRY_BASE_DELAY", 1))  # Seconds
+RETRY_MAX_DELAY = float(environ.get("RETRY_MAX_DELAY", 32))  # Seconds
+
 # Database settings
 EMAILS_DB_PATH = environ.get("EMAILS_DB_PATH", "emails.db")
 EMAIL_TABLE_NAME = environ.get("EMAIL_TABLE_NAME", "emails")
 TIME_ZONE = environ.get("TIME_ZONE", "Asia/Kolkata")
+SQLITE_CACHE_SIZE = int(environ.get("SQLITE_CACHE_SIZE", 65536))  # KiB
+SQLITE_MMAP_SIZE = int(environ.get("SQLITE_MMAP_SIZE", 268435456))  # Bytes
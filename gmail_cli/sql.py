@@ -0,0 +1,167 @@
+import time
+
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from .settings import TIME_ZONE
+
+# The table columns string conditions match, with the address columns
+# holding the first address of the From and To headers
+STRING_COLUMNS = {
+    'from': 'sender_address',
+    'to': 'recipient_address',
+    'subject': 'subject'
+}
+# The characters str.strip removes
+WHITESPACE = '''char(
+    9, 10, 11, 12, 13, 28, 29, 30, 31, 32, 133, 160, 5760, 8192, 8193, 8194,
+    8195, 8196, 8197, 8198, 8199, 8200, 8201, 8202, 8232, 8233, 8239, 8287,
+    12288
+)'''
+DATE_FORMATS = ['%d-%m-%Y', '%d-%m-%Y %H:%M:%S']
+# The trigram index only finds texts of at least three characters
+MIN_FULL_TEXT_LENGTH = 3
+FULL_TEXT_MATCH = '''rowid IN (SELECT rowid FROM {email_table_name}_fts
+WHERE {email_table_name}_fts MATCH ?)'''
+
+
+def parse_condition_date(value):
+    '''
+    Parse the value of a date_received eq or neq condition.
+    '''
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(f'Invalid datetime format: {value}')
+
+
+def day_bounds(value):
+    '''
+    Get the epochs of the start of a day in TIME_ZONE and of the next
+    day.
+    '''
+    day = parse_condition_date(value)
+    server_timezone = ZoneInfo(TIME_ZONE)
+    start = datetime(day.year, day.month, day.day, tzinfo=server_timezone)
+    end = start + timedelta(days=1)
+    # Rebuild the end from its date in case a DST change falls in between
+    end = datetime(end.year, end.month, end.day, tzinfo=server_timezone)
+    return start.timestamp(), end.timestamp()
+
+
+def full_text_phrase(text, column=None):
+    '''
+    Quote a text as a full-text query matching it anywhere in a column,
+    or in any column if none is given.
+    '''
+    phrase = '"' + text.replace('"', '""') + '"'
+    return f'{column} : {phrase}' if column else phrase
+
+
+def build_search_sql(text, full_text_search=False):
+    '''
+    Build an SQL condition matching the emails whose subject or snippet
+    contains a text, ignoring case.
+    Args:
+        full_text_search (bool): If True, look the text up in the
+        full-text index of the emails table.
+    Returns:
+        tuple: The SQL condition and its parameters.
+    '''
+    if full_text_search and len(text) >= MIN_FULL_TEXT_LENGTH:
+        return FULL_TEXT_MATCH, [full_text_phrase(text)]
+
+    # lower() only folds ASCII letters, unlike the trigram index
+    return (
+        '(instr(lower(subject), ?) > 0 OR instr(lower(snippet), ?) > 0)',
+        [text.lower(), text.lower()]
+    )
+
+
+def build_condition_sql(condition, now=None, full_text_search=False):
+    '''
+    Translate a condition into an SQL condition on the emails table that
+    matches exactly the emails EmailAutomation.match_condition does.
+    Args:
+        full_text_search (bool): If True, look subject contains
+        conditions up in the full-text index of the emails table.
+    Returns:
+        tuple: The SQL condition and its parameters, or None if the
+        condition has no translation.
+    '''
+    field = condition['field']
+    operator = condition['operator']
+    value = condition['value']
+
+    if field in STRING_COLUMNS:
+        column = STRING_COLUMNS[field]
+        value = value.strip()
+        if operator == 'eq' and field == 'subject':
+            return f'trim({column}, {WHITESPACE}) = ?', [value]
+        elif operator == 'eq':
+            return f'{column} = ?', [value]
+        elif operator == 'neq' and field == 'subject':
+            return f'trim({column}, {WHITESPACE}) != ?', [value]
+        elif operator == 'neq':
+            return f'{column} != ?', [value]
+        elif (
+            operator == 'contains' and field == 'subject' and
+            full_text_search and len(value) >= MIN_FULL_TEXT_LENGTH
+        ):
+            # The index ignores case, so instr checks the matches it finds
+            return f'{FULL_TEXT_MATCH} AND instr({column}, ?) > 0', [
+                full_text_phrase(value, column), value]
+        elif operator == 'contains':
+            return f'instr({column}, ?) > 0', [value]
+        elif operator == 'ncontains':
+            return f'instr({column}, ?) = 0', [value]
+    elif field == 'date_received':
+        now = time.time() if now is None else now
+        if operator == 'gt':  # Received more than `value` days ago
+            return 'date_epoch < ?', [now - value * 86400]
+        elif operator == 'lt':
+            return 'date_epoch >= ?', [now - value * 86400]
+        elif operator == 'eq':
+            return 'date_epoch >= ? AND date_epoch < ?', list(
+                day_bounds(value))
+        elif operator == 'neq':
+            return '(date_epoch < ? OR date_epoch >= ?)', list(
+                day_bounds(value))
+    return None
+
+
+def build_rule_sql(rule, now=None, full_text_search=False):
+    '''
+    Translate a rule into an SQL condition on the emails table.
+
+    Conditions of an 'all' rule that have no translation, such as body
+    conditions, are dropped, and the result only narrows down the emails
+    the rule is evaluated on. An 'any' rule has a translation only if
+    all of its conditions translate.
+    Returns:
+        tuple: The SQL condition, its parameters and whether it matches
+        exactly the emails the rule matches, or None if the rule has no
+        translation.
+    '''
+    clauses = [
+        build_condition_sql(condition, now, full_text_search)
+        for condition in rule['conditions']
+    ]
+    if rule['predicate'] == 'all':
+        translated = [clause for clause in clauses if clause]
+        joiner = ' AND '
+    elif rule['predicate'] == 'any':
+        translated = clauses if clauses and all(clauses) else []
+        joiner = ' OR '
+    else:
+        raise ValueError('Invalid predicate')
+
+    if not translated:
+        return None
+
+    where = joiner.join(f'({sql})' for sql, _ in translated)
+    params = [param for _, clause_params in translated
+              for param in clause_params]
+    return where, params, len(translated) == len(clauses)
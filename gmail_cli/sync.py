@@ -0,0 +1,462 @@
+from collections import deque
+
+from .exceptions import HistoryExpired
+from .query import partition_queries
+from .settings import SYNC_COMMIT_SIZE
+
+FULL_SYNC = 'full_sync'
+PARTITION_PREFIX = f'{FULL_SYNC}:'
+
+
+class SyncProgress:
+    '''
+    Track the pages of a full sync, committing their emails in batches
+    of SYNC_COMMIT_SIZE and checkpointing the sync after every commit.
+
+    A sync listing date partitions in parallel also checkpoints the next
+    page of every partition, and drops the checkpoint of a partition
+    once its last page is committed.
+    '''
+    def __init__(self, email_sync, checkpoint, partitions=None) -> None:
+        self.email_sync = email_sync
+        self.checkpoint = checkpoint
+        self.partitions = partitions
+        self.progress = dict(checkpoint)
+        self.batch = []
+        self.next_pages = deque()
+        self.changed = set()
+
+    def listed(self, messages, page_token, partition=None):
+        '''
+        Record a listed page, whose emails are stored in listing order.
+        '''
+        self.next_pages.append((partition, page_token, len(messages)))
+
+    def store(self, emails):
+        '''
+        Store the emails of the next listed page.
+        '''
+        partition, page_token, listed = self.next_pages.popleft()
+        self.batch.extend(emails)
+        if partition is None:
+            self.progress['page_token'] = page_token
+        else:
+            state = self.partitions[partition]
+            state['page_token'] = page_token
+            state['pages'] += 1
+            state['messages'] += listed
+            self.changed.add(partition)
+        self.progress['pages'] += 1
+        self.progress['messages'] += listed
+        if len(self.batch) >= SYNC_COMMIT_SIZE or not page_token:
+            self.commit()
+
+    def commit(self):
+        '''
+        Commit the stored emails and checkpoint the sync.
+        '''
+        db_helper = self.email_sync.db_helper
+        db_helper.insert_emails_into_table(self.batch)
+        self.batch.clear()
+        self.checkpoint.update(self.progress)
+        self.email_sync._save_checkpoint(self.checkpoint)
+        for partition in self.changed:
+            state = self.partitions[partition]
+            name = PARTITION_PREFIX + partition
+            if state['page_token']:
+                self.email_sync._save_checkpoint(state, name)
+            else:
+                db_helper.delete_sync_checkpoint(name)
+        self.changed.clear()
+
+    def stop(self):
+        '''
+        Commit the stored emails of a sync that failed part way.
+        '''
+        self.commit()
+        print(
+            f'Sync stopped after {self.checkpoint["pages"]} pages and '
+            f'{self.checkpoint["messages"]} messages, run it again to resume'
+        )
+
+
+class EmailSync:
+    '''
+    Sync emails from Gmail into the database.
+    '''
+    def __init__(self, gmail_client, db_helper) -> None:
+        self.gmail_client = gmail_client
+        self.db_helper = db_helper
+
+    def sync(self):
+        '''
+        Sync the emails changed since the last sync, or all emails if
+        there was no previous sync or its history id has expired.
+        '''
+        history_id = self.db_helper.get_sync_state('history_id')
+        if history_id:
+            try:
+                return self.incremental_sync(history_id)
+            except HistoryExpired:
+                print('Mailbox history has expired, running a full sync')
+
+        return self.full_sync()
+
+    def full_sync(self):
+        '''
+        List every message in the mailbox and store the emails that are
+        not in the database yet.
+
+        Progress is checkpointed after every committed batch, so a sync
+        that fails part way resumes from the last committed page when
+        run again.
+
+        With more than one partition, the date ranges of the mailbox are
+        listed in parallel and each resumes from its own checkpoint.
+        '''
+        checkpoint = self._load_checkpoint()
+        if not checkpoint:
+            self._forget_labels()
+            # Read the history id before listing so that changes made
+            # while listing are picked up by the next incremental sync.
+            checkpoint = self._new_checkpoint(
+                self.gmail_client.get_profile()['historyId'])
+
+        partitions = self._load_partitions()
+        if partitions:
+            self._list_partitions_and_store(checkpoint, partitions)
+        elif checkpoint['page_token'] or not checkpoint['pages']:
+            self._list_and_store(checkpoint)
+
+        self._finish_full_sync(checkpoint)
+
+    def _load_checkpoint(self):
+        checkpoint = self.db_helper.get_sync_checkpoint(FULL_SYNC)
+        if checkpoint:
+            print(
+                f'Resuming sync after {checkpoint["pages"]} pages and '
+                f'{checkpoint["messages"]} messages'
+            )
+        return checkpoint
+
+    def _forget_labels(self):
+        # A full sync only fetches the emails not stored yet, so the labels
+        # of stored emails may have changed in Gmail unnoticed
+        self.db_helper.clear_message_labels()
+
+    def _new_checkpoint(self, history_id):
+        checkpoint = {
+            'page_token': None,
+            'history_id': history_id,
+            'pages': 0,
+            'messages': 0
+        }
+        self._save_checkpoint(checkpoint)
+
+        queries = partition_queries(self.gmail_client.partitions)
+        if len(queries) > 1:
+            for query in queries:
+                self._save_checkpoint(
+                    dict(checkpoint), PARTITION_PREFIX + query)
+        return checkpoint
+
+    def _load_partitions(self):
+        checkpoints = self.db_helper.get_sync_checkpoints(PARTITION_PREFIX)
+        return {
+            name[len(PARTITION_PREFIX):]: checkpoint
+            for name, checkpoint in checkpoints.items()
+        }
+
+    def _save_checkpoint(self, checkpoint, name=FULL_SYNC):
+        self.db_helper.save_sync_checkpoint(
+            name,
+            checkpoint['page_token'],
+            checkpoint['history_id'],
+            checkpoint['pages'],
+            checkpoint['messages']
+        )
+
+    def _finish_full_sync(self, checkpoint):
+        self.db_helper.set_sync_state('history_id', checkpoint['history_id'])
+        self.db_helper.delete_sync_checkpoint(FULL_SYNC)
+
+    def _list_and_store(self, checkpoint):
+        known_ids = self.db_helper.fetch_message_ids()
+        progress = SyncProgress(self, checkpoint)
+
+        def list_unknown_messages():
+            for messages, page_token in self.gmail_client.list_message_pages(
+                page_token=checkpoint['page_token']
+            ):
+                progress.listed(messages, page_token)
+                yield [
+                    message for message in messages
+                    if message['id'] not in known_ids
+                ]
+
+        pages = self.gmail_client.hydrate_pages(list_unknown_messages())
+        try:
+            for emails in pages:
+                progress.store(emails)
+        except Exception:
+            progress.stop()
+            raise
+
+    def _list_partitions_and_store(self, checkpoint, partitions):
+        known_ids = self.db_helper.fetch_message_ids()
+        progress = SyncProgress(self, checkpoint, partitions)
+
+        def list_unknown_messages():
+            for query, messages, page_token in (
+                self.gmail_client.list_partition_pages(
+                    list(partitions),
+                    {
+                        query: state['page_token']
+                        for query, state in partitions.items()
+                    }
+                )
+            ):
+                progress.listed(messages, page_token, query)
+                yield [
+                    message for message in messages
+                    if message['id'] not in known_ids
+                ]
+
+        pages = self.gmail_client.hydrate_pages(list_unknown_messages())
+        try:
+            for emails in pages:
+                progress.store(emails)
+        except Exception:
+            progress.stop()
+            raise
+
+    def store_emails(self, pages):
+        '''
+        Commit pages of emails to the database as they arrive, in batches
+        of SYNC_COMMIT_SIZE emails. Batches already committed are kept if
+        fetching fails part way.
+        Returns:
+            int: The number of emails stored.
+        '''
+        batch = []
+        stored = 0
+        try:
+            for emails in pages:
+                batch.extend(emails)
+                if len(batch) >= SYNC_COMMIT_SIZE:
+                    self.db_helper.insert_emails_into_table(batch)
+                    stored += len(batch)
+                    batch = []
+        finally:
+            if batch:
+                self.db_helper.insert_emails_into_table(batch)
+                stored += len(batch)
+
+        return stored
+
+    def search_sync(self, query):
+        '''
+        Store the emails matching a Gmail search query that are not in
+        the database yet.
+        Returns:
+            list: The message ids matching the query.
+        '''
+        known_ids = self.db_helper.fetch_message_ids()
+        message_ids = []
+
+        def list_unknown_messages():
+            for messages, _ in self.gmail_client.list_message_pages(
+                query=query
+            ):
+                message_ids.extend(message['id'] for message in messages)
+                yield [
+                    message for message in messages
+                    if message['id'] not in known_ids
+                ]
+
+        self.store_emails(
+            self.gmail_client.hydrate_pages(list_unknown_messages()))
+        return message_ids
+
+    def incremental_sync(self, history_id):
+        '''
+        Apply the messages added, deleted and relabelled since a history
+        id.
+        '''
+        changes = self.gmail_client.list_history(history_id)
+        self.db_helper.delete_emails_from_table(changes['deleted'])
+
+        self.store_emails(self.gmail_client.hydrate_pages(
+            self._message_pages(changes['added'])))
+
+        self.db_helper.set_message_labels(changes['labels'])
+        for emails in self.gmail_client.hydrate_pages(
+            self._message_pages(self._unlabelled_ids(changes))
+        ):
+            self.db_helper.set_message_labels(self._email_labels(emails))
+
+        self.db_helper.set_sync_state('history_id', changes['history_id'])
+
+    def _message_pages(self, message_ids):
+        # Pages of SYNC_COMMIT_SIZE messages, each committed as it arrives
+        return [
+            [
+                {'id': message_id} for message_id in
+                message_ids[start:start + SYNC_COMMIT_SIZE]
+            ]
+            for start in range(0, len(message_ids), SYNC_COMMIT_SIZE)
+        ]
+
+    def _unlabelled_ids(self, changes):
+        # The relabelled messages whose history records lack their labels
+        return [
+            message_id for message_id in changes['labels_changed']
+            if message_id not in changes['labels']
+        ]
+
+    def _email_labels(self, emails):
+        return {
+            email['message_id']: email['label_ids'] for email in emails
+            if email.get('label_ids') is not None
+        }
+
+
+class AsyncEmailSync(EmailSync):
+    '''
+    Sync emails from Gmail into the database through an AsyncGmailClient.
+    '''
+    async def sync(self):
+        '''
+        Sync the emails changed since the last sync, or all emails if
+        there was no previous sync or its history id has expired.
+        '''
+        history_id = self.db_helper.get_sync_state('history_id')
+        if history_id:
+            try:
+                return await self.incremental_sync(history_id)
+            except HistoryExpired:
+                print('Mailbox history has expired, running a full sync')
+
+        return await self.full_sync()
+
+    async def full_sync(self):
+        '''
+        List every message in the mailbox and store the emails that are
+        not in the database yet, checkpointing progress as it goes.
+        '''
+        checkpoint = self._load_checkpoint()
+        if not checkpoint:
+            self._forget_labels()
+            profile = await self.gmail_client.get_profile()
+            checkpoint = self._new_checkpoint(profile['historyId'])
+
+        partitions = self._load_partitions()
+        if partitions:
+            await self._list_partitions_and_store(checkpoint, partitions)
+        elif checkpoint['page_token'] or not checkpoint['pages']:
+            await self._list_and_store(checkpoint)
+
+        self._finish_full_sync(checkpoint)
+
+    async def _list_and_store(self, checkpoint):
+        known_ids = self.db_helper.fetch_message_ids()
+        progress = SyncProgress(self, checkpoint)
+
+        async def list_unknown_messages():
+            async for messages, page_token in (
+                self.gmail_client.list_message_pages(
+                    page_token=checkpoint['page_token'])
+            ):
+                progress.listed(messages, page_token)
+                yield [
+                    message for message in messages
+                    if message['id'] not in known_ids
+                ]
+
+        try:
+            async for emails in self.gmail_client.hydrate_pages(
+                list_unknown_messages()
+            ):
+                progress.store(emails)
+        except Exception:
+            progress.stop()
+            raise
+
+    async def _list_partitions_and_store(self, checkpoint, partitions):
+        known_ids = self.db_helper.fetch_message_ids()
+        progress = SyncProgress(self, checkpoint, partitions)
+
+        async def list_unknown_messages():
+            async for query, messages, page_token in (
+                self.gmail_client.list_partition_pages(
+                    list(partitions),
+                    {
+                        query: state['page_token']
+                        for query, state in partitions.items()
+                    }
+                )
+            ):
+                progress.listed(messages, page_token, query)
+                yield [
+                    message for message in messages
+                    if message['id'] not in known_ids
+                ]
+
+        try:
+            async for emails in self.gmail_client.hydrate_pages(
+                list_unknown_messages()
+            ):
+                progress.store(emails)
+        except Exception:
+            progress.stop()
+            raise
+
+    async def search_sync(self, query):
+        '''
+        Store the emails matching a Gmail search query that are not in
+        the database yet.
+        Returns:
+            list: The message ids matching the query.
+        '''
+        known_ids = self.db_helper.fetch_message_ids()
+        message_ids = []
+
+        async def list_unknown_messages():
+            async for messages, _ in self.gmail_client.list_message_pages(
+                query=query
+            ):
+                message_ids.extend(message['id'] for message in messages)
+                yield [
+                    message for message in messages
+                    if message['id'] not in known_ids
+                ]
+
+        batch = []
+        async for emails in self.gmail_client.hydrate_pages(
+            list_unknown_messages()
+        ):
+            batch.extend(emails)
+            if len(batch) >= SYNC_COMMIT_SIZE:
+                self.store_emails([batch])
+                batch = []
+        self.store_emails([batch])
+        return message_ids
+
+    async def incremental_sync(self, history_id):
+        '''
+        Apply the messages added, deleted and relabelled since a history
+        id.
+        '''
+        changes = await self.gmail_client.list_history(history_id)
+        self.db_helper.delete_emails_from_table(changes['deleted'])
+
+        for messages in self._message_pages(changes['added']):
+            self.store_emails(
+                [await self.gmail_client.get_emails_from_messages(messages)])
+
+        self.db_helper.set_message_labels(changes['labels'])
+        for messages in self._message_pages(self._unlabelled_ids(changes)):
+            self.db_helper.set_message_labels(self._email_labels(
+                await self.gmail_client.get_emails_from_messages(messages)))
+
+        self.db_helper.set_sync_state('history_id', changes['history_id'])
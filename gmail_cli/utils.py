@@ -1,19 +1,49 @@
 import csv
+
+from itertools import islice
 from tabulate import tabulate
 
+TABLE_PAGE_SIZE = 1000  # Emails printed per table
+
 
 def tabulate_emails(emails):
     '''
-    Print the emails in a tabular format.
+    Print the emails in a tabular format, a table of at most
+    TABLE_PAGE_SIZE emails at a time so that any number of emails can be
+    streamed through.
     '''
-    if not emails:
+    emails = iter(emails)
+    printed = False
+    while page := list(islice(emails, TABLE_PAGE_SIZE)):
+        headers = page[0].keys()
+        rows = [list(email.values()) for email in page]
+        print(tabulate(rows, headers=headers, tablefmt='grid'))
+        printed = True
+
+    if not printed:
         print('No emails found')
-        return
 
-    headers = emails[0].keys()
-    rows = [list(email.values()) for email in emails]
+
+def tabulate_account_results(results, seconds):
+    '''
+    Print the summaries of a multi-account run and their totals.
+    Args:
+        results (list): The summary of each account.
+        seconds (float): The wall time of the whole run.
+    '''
+    headers = ['account', 'status', 'emails', 'modified', 'seconds', 'error']
+    rows = [[result[header] for header in headers] for result in results]
     print(tabulate(rows, headers=headers, tablefmt='grid'))
 
+    succeeded = sum(result['status'] == 'ok' for result in results)
+    print(
+        f'{succeeded} of {len(results)} accounts succeeded, '
+        f'{sum(result["emails"] for result in results)} emails, '
+        f'{sum(result["modified"] for result in results)} modified, '
+        f'in {seconds:.2f}s (slowest account '
+        f'{max(result["seconds"] for result in results):.2f}s)'
+    )
+
 
 def write_emails_to_csv(emails, file_path):
     '''
@@ -101,7 +101,7 @@ class AutomationSchemaValidation:
             raise ValidationError(
                 'Field is required in condition', condition)
 
-        if field not in ['from', 'to', 'subject', 'date_received']:
+        if field not in ['from', 'to', 'subject', 'body', 'date_received']:
             raise ValidationError(
                 f'Invalid field: {field}', condition)
 
@@ -125,7 +125,7 @@ class AutomationSchemaValidation:
         validated_condition = self._validate_condition(condition)
         field = validated_condition['field']
 
-        if field in ['from', 'to', 'subject']:
+        if field in ['from', 'to', 'subject', 'body']:
             self._validate_string_condition(validated_condition)
         elif field == 'date_received':
             self._validate_datetime_condition(validated_condition)
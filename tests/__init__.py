@@ -1,6 +1,16 @@
 from .test_automate import * # noqa
 from .test_validate import * # noqa
 from .test_db_helper import * # noqa
+from .test_api_client import * # noqa
+from .test_sync import * # noqa
+from .test_actions import * # noqa
+from .test_labels import * # noqa
+from .test_rate_limit import * # noqa
+from .test_query import * # noqa
+from .test_fake_server import * # noqa
+from .test_async_client import * # noqa
+from .test_accounts import * # noqa
+from .test_sql import * # noqa
 
 
 def main():
@@ -0,0 +1,119 @@
+import json
+import os
+import tempfile
+
+from unittest import TestCase
+
+from gmail_cli.accounts import read_accounts, run_accounts
+from gmail_cli.exceptions import ValidationError
+from gmail_cli.fake_server import FakeGmailServer
+
+
+class TestAccounts(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.servers = [
+            FakeGmailServer(labels=['movies', 'refer', 'archive'], seed=1)
+            for _ in range(2)
+        ]
+        for server, count in zip(self.servers, [30, 40]):
+            server.start()
+            server.populate(count)
+
+    def tearDown(self) -> None:
+        for server in self.servers:
+            server.stop()
+        self.directory.cleanup()
+
+    def write_accounts(self, accounts):
+        path = os.path.join(self.directory.name, 'accounts.json')
+        with open(path, 'w') as f:
+            json.dump(accounts, f)
+        return path
+
+    def test_read_accounts(self):
+        accounts = [
+            {'name': 'first', 'token_file_path': 'first.json'},
+            {'name': 'second', 'table_name': 'second', 'workers': 2}
+        ]
+        self.assertListEqual(
+            read_accounts(self.write_accounts(accounts)), accounts)
+
+        for accounts in [
+            {},
+            [],
+            [{'token_file_path': 'first.json'}],
+            [{'name': 'first'}, {'name': 'first'}],
+            [{'name': 'first', 'token': 'first.json'}],
+            [{'name': 'first', 'workers': '2'}]
+        ]:
+            self.assertRaises(
+                ValidationError,
+                read_accounts,
+                self.write_accounts(accounts)
+            )
+        self.assertRaises(ValidationError, read_accounts, 'missing.json')
+
+    def test_run_accounts(self):
+        db_path = os.path.join(self.directory.name, 'emails.db')
+        accounts = [
+            {
+                'name': f'account_{index}',
+                'db_path': db_path,
+                'table_name': f'emails_{index}',
+                'api_endpoint': server.url
+            }
+            for index, server in enumerate(self.servers)
+        ]
+        accounts.append({
+            'name': 'offline',
+            'db_path': db_path,
+            'table_name': 'offline',
+            'api_endpoint': 'http://127.0.0.1:1/'
+        })
+
+        results = run_accounts(
+            "samples/automate_1.json", accounts, force_retrieve=True)
+        self.assertListEqual(
+            [result['account'] for result in results],
+            ['account_0', 'account_1', 'offline']
+        )
+        self.assertListEqual(
+            [result['status'] for result in results], ['ok', 'ok', 'failed'])
+        self.assertListEqual(
+            [result['emails'] for result in results], [30, 40, 0])
+        self.assertListEqual(
+            [result['modified'] for result in results], [30, 40, 0])
+        self.assertTrue(results[2]['error'])
+        for server in self.servers:
+            self.assertEqual(server.calls['messages.batchModify'], 1)
+
+        # The labels set by the first run are known, so nothing is resent
+        gets = [server.calls['messages.get'] for server in self.servers]
+        results = run_accounts(
+            "samples/automate_1.json", accounts[:2], force_retrieve=True)
+        self.assertListEqual(
+            [result['modified'] for result in results], [0, 0])
+        for server, count in zip(self.servers, gets):
+            self.assertEqual(server.calls['messages.batchModify'], 1)
+            self.assertEqual(server.calls['messages.get'], count)
+
+        accounts[1]['table_name'] = 'emails_0'
+        self.assertRaises(
+            ValidationError,
+            run_accounts,
+            "samples/automate_1.json",
+            accounts
+        )
+
+    def test_run_accounts_sharing_a_token(self):
+        accounts = [
+            {'name': 'first', 'table_name': 'first'},
+            {'name': 'second', 'table_name': 'second'}
+        ]
+        self.assertRaises(
+            ValidationError,
+            run_accounts,
+            "samples/automate_1.json",
+            accounts
+        )
@@ -0,0 +1,115 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, call, patch
+
+from gmail_cli.actions import ActionExecutor
+from gmail_cli.api_client import GmailClient
+from gmail_cli.db_helper import EmailDBHelper
+
+
+class TestActionExecutor(TestCase):
+    def setUp(self) -> None:
+        self.gmail_client = MagicMock()
+        self.gmail_client.batch_modify.return_value = True
+        self.label_directory = MagicMock()
+        self.label_directory.get_label_id.side_effect = (
+            lambda mailbox: f'Label_{mailbox}')
+        self.action_executor = ActionExecutor(
+            self.gmail_client, self.label_directory)
+
+    def test_group_label_changes(self):
+        for message_id in ('1', '2', '3'):
+            self.action_executor.add(message_id, {'action': 'mark_as_read'})
+            self.action_executor.add(
+                message_id,
+                {'action': 'move_to_mailbox', 'mailbox': 'movies'}
+            )
+        self.action_executor.add('3', {'action': 'mark_as_unread'})
+        self.action_executor.add('4', {'action': 'mark_as_unread'})
+        self.action_executor.add('4', {'action': 'mark_as_read'})
+
+        self.assertDictEqual(self.action_executor.group_label_changes(), {
+            (('Label_movies',), ('UNREAD',)): ['1', '2'],
+            (('Label_movies', 'UNREAD'), ()): ['3'],
+            ((), ('UNREAD',)): ['4']
+        })
+        self.assertEqual(self.label_directory.get_label_id.call_count, 3)
+        self.assertRaises(
+            ValueError, self.action_executor.add, '5', {'action': 'invalid'})
+
+    def test_flush(self):
+        for message_id in range(2500):
+            self.action_executor.add(
+                str(message_id), {'action': 'mark_as_read'})
+        self.assertTrue(self.action_executor.flush())
+        self.gmail_client.batch_modify.assert_called_once_with(
+            [str(message_id) for message_id in range(2500)],
+            add_label_ids=[],
+            remove_label_ids=['UNREAD']
+        )
+        self.assertDictEqual(self.action_executor.label_changes, {})
+
+    def test_drop_applied_changes(self):
+        db_helper = EmailDBHelper("test.db", "emails")
+        db_helper.create_emails_table(remove_existing=True)
+        db_helper.insert_emails_into_table([
+            {
+                'message_id': message_id,
+                'subject': 'Subject',
+                'snippet': 'Snippet',
+                'date': 'Thu, 01 Jul 2021 00:00:00 +0000',
+                'to': 'Maria <maria@maria.com>',
+                'from': 'abc@abc.com',
+                'label_ids': label_ids
+            }
+            for message_id, label_ids in [
+                ('1', ['INBOX', 'Label_movies']),
+                ('2', ['INBOX', 'UNREAD']),
+                ('3', None)
+            ]
+        ])
+        action_executor = ActionExecutor(
+            self.gmail_client, self.label_directory, db_helper)
+        for message_id in ('1', '2', '3', '4'):
+            action_executor.add(message_id, {'action': 'mark_as_read'})
+            action_executor.add(
+                message_id,
+                {'action': 'move_to_mailbox', 'mailbox': 'movies'}
+            )
+
+        action_executor.drop_applied_changes()
+        self.assertTrue(action_executor.flush())
+        self.assertListEqual(self.gmail_client.batch_modify.call_args_list, [
+            call(['2', '3', '4'], add_label_ids=['Label_movies'],
+                 remove_label_ids=['UNREAD'])
+        ])
+        self.assertDictEqual(db_helper.fetch_label_states(['2', '3']), {
+            '2': (True, {
+                'INBOX': True, 'Label_movies': True, 'UNREAD': False}),
+            '3': (False, {'Label_movies': True, 'UNREAD': False})
+        })
+
+        for message_id in ('1', '2', '3'):
+            action_executor.add(message_id, {'action': 'mark_as_read'})
+        action_executor.add('3', {'action': 'mark_as_unread'})
+        self.gmail_client.batch_modify.return_value = False
+        action_executor.drop_applied_changes()
+        self.assertFalse(action_executor.flush())
+        self.gmail_client.batch_modify.assert_called_with(
+            ['3'], add_label_ids=['UNREAD'], remove_label_ids=[])
+        self.assertFalse(db_helper.fetch_label_states(['3'])['3'][1]['UNREAD'])
+
+    @patch("gmail_cli.api_client.GmailClient.get_service")
+    def test_batch_modify_chunks(self, mock_get_service):
+        batch_modify = mock_get_service.return_value.users().messages(
+        ).batchModify
+        message_ids = [str(message_id) for message_id in range(2500)]
+        self.assertTrue(GmailClient().batch_modify(
+            message_ids, remove_label_ids=['UNREAD']))
+        self.assertListEqual(batch_modify.call_args_list, [
+            call(userId='me', body={
+                'ids': message_ids[start:start + 1000],
+                'addLabelIds': [],
+                'removeLabelIds': ['UNREAD']
+            })
+            for start in (0, 1000, 2000)
+        ])
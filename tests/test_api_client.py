@@ -0,0 +1,283 @@
+import base64
+import random
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from httplib2 import Response
+from googleapiclient.errors import HttpError
+
+from gmail_cli.api_client import GmailClient
+from gmail_cli.exceptions import HistoryExpired
+from gmail_cli.rate_limit import RequestScheduler
+
+
+def http_error(status):
+    return HttpError(Response({'status': status}), b'{}')
+
+
+class FakeBatch:
+    def __init__(self, callback, errors):
+        self.callback = callback
+        self.errors = errors
+        self.request_ids = []
+
+    def add(self, request, request_id):
+        self.request_ids.append(request_id)
+
+    def execute(self):
+        for request_id in self.request_ids:
+            errors = self.errors.get(request_id, [])
+            if errors:
+                self.callback(request_id, None, http_error(errors.pop(0)))
+            else:
+                self.callback(request_id, {
+                    'id': request_id,
+                    'snippet': f'Snippet {request_id}',
+                    'payload': {
+                        'headers': [
+                            {'name': 'Subject', 'value': 'Subject'},
+                            {'name': 'Date', 'value': 'Date'},
+                            {'name': 'From', 'value': 'abc@abc.com'},
+                            {'name': 'To', 'value': 'xyz@xyz.com'}
+                        ]
+                    }
+                }, None)
+
+
+class TestGmailClient(TestCase):
+    def setUp(self) -> None:
+        self.gmail_client = GmailClient(
+            "credentials.json", "token.json")
+        self.gmail_client.scheduler = RequestScheduler(
+            quota_per_second=10 ** 6, max_concurrency=8, max_retries=3)
+
+    @patch("gmail_cli.api_client.build")
+    @patch("gmail_cli.api_client.GmailClient.authenticate")
+    def test_service_is_reused(self, mock_authenticate, mock_build):
+        credentials = MagicMock(refresh_token=None)
+        mock_authenticate.return_value = credentials
+
+        service_1 = self.gmail_client.get_service()
+        service_2 = self.gmail_client.get_service()
+        self.assertIs(service_1, service_2)
+        mock_authenticate.assert_called_once()
+        mock_build.assert_called_once()
+
+        self.gmail_client.close()
+        self.gmail_client.get_service()
+        self.assertEqual(mock_build.call_count, 2)
+        mock_authenticate.assert_called_once()
+
+    @patch("gmail_cli.api_client.GmailClient._save_credentials")
+    @patch("gmail_cli.api_client.GmailClient.authenticate")
+    def test_credentials_refreshed_ahead_of_expiry(
+        self, mock_authenticate, mock_save_credentials
+    ):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        credentials = MagicMock(
+            refresh_token='refresh', expiry=now + timedelta(hours=1))
+        mock_authenticate.return_value = credentials
+
+        self.gmail_client.get_credentials()
+        self.gmail_client.get_credentials()
+        credentials.refresh.assert_not_called()
+
+        credentials.expiry = now + timedelta(seconds=10)
+        self.gmail_client.get_credentials()
+        credentials.refresh.assert_called_once()
+        mock_save_credentials.assert_called_once_with(credentials)
+
+    @patch("gmail_cli.rate_limit.RequestScheduler.backoff")
+    @patch("gmail_cli.api_client.GmailClient.get_service")
+    def test_batch_get_messages(self, mock_get_service, mock_backoff):
+        errors = {'2': [429, 503], '3': [404]}
+        batches = []
+
+        def new_batch_http_request(callback):
+            batches.append(FakeBatch(callback, errors))
+            return batches[-1]
+
+        service = mock_get_service.return_value
+        service.new_batch_http_request.side_effect = new_batch_http_request
+
+        message_ids = [str(index) for index in range(150, 0, -1)]
+        emails = self.gmail_client.get_emails_from_messages(
+            [{'id': message_id} for message_id in message_ids])
+
+        expected_ids = [
+            message_id for message_id in message_ids if message_id != '3']
+        self.assertListEqual(
+            [email['message_id'] for email in emails], expected_ids)
+        self.assertListEqual(
+            [len(batch.request_ids) for batch in batches], [100, 50, 1, 1])
+
+        errors['4'] = [400]
+        self.assertRaises(
+            HttpError, self.gmail_client.batch_get_messages, ['4'])
+
+    def test_parse_email(self):
+        msg = {
+            'id': '1',
+            'snippet': 'Test Snippet',
+            'payload': {
+                'headers': [
+                    {'name': 'subject', 'value': 'Test Subject'},
+                    {'name': 'Date', 'value': 'Thu, 01 Jul 2021 00:00:00'},
+                    {'name': 'From', 'value': 'abc@abc.com'},
+                    {'name': 'From', 'value': 'xyz@xyz.com'}
+                ]
+            }
+        }
+        self.assertDictEqual(self.gmail_client.parse_email(msg), {
+            'message_id': '1',
+            'subject': 'Test Subject',
+            'snippet': 'Test Snippet',
+            'date': 'Thu, 01 Jul 2021 00:00:00',
+            'from': 'abc@abc.com',
+            'to': None,
+            'label_ids': None
+        })
+
+    def test_parse_body(self):
+        def encode(text):
+            return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+        msg = {
+            'id': '1',
+            'payload': {
+                'mimeType': 'multipart/mixed',
+                'parts': [
+                    {
+                        'mimeType': 'multipart/alternative',
+                        'parts': [
+                            {
+                                'mimeType': 'text/html',
+                                'body': {'data': encode('<p>Hi &amp; bye</p>')}
+                            },
+                            {
+                                'mimeType': 'text/plain',
+                                'body': {'data': encode('Hi & bye')}
+                            }
+                        ]
+                    },
+                    {
+                        'mimeType': 'application/pdf',
+                        'body': {'attachmentId': 'a1'}
+                    }
+                ]
+            }
+        }
+        self.assertEqual(self.gmail_client.parse_body(msg), 'Hi & bye')
+
+        msg['payload']['parts'][0]['parts'].pop()
+        self.assertEqual(
+            self.gmail_client.parse_body(msg).strip(), 'Hi & bye')
+        self.assertEqual(self.gmail_client.parse_body({'payload': {}}), '')
+
+    def test_message_params(self):
+        params = self.gmail_client._get_message_params('metadata')
+        self.assertEqual(params['format'], 'metadata')
+        self.assertListEqual(
+            params['metadataHeaders'], ['Subject', 'Date', 'From', 'To'])
+        self.assertEqual(
+            params['fields'], 'id,labelIds,snippet,payload/headers')
+        self.assertDictEqual(
+            self.gmail_client._get_message_params('full'), {'format': 'full'})
+        self.assertRaises(
+            ValueError, self.gmail_client._get_message_params, 'raw')
+
+    @patch("gmail_cli.api_client.GmailClient.get_service")
+    def test_list_history(self, mock_get_service):
+        history = mock_get_service.return_value.users().history()
+        history.list().execute.side_effect = [
+            {
+                'history': [
+                    {'messagesAdded': [{'message': {'id': '1'}}]},
+                    {'messagesAdded': [{'message': {'id': '2'}}]},
+                    {'labelsAdded': [{'message': {'id': '3'}}]},
+                    {'labelsAdded': [
+                        {'message': {'id': '1', 'labelIds': ['INBOX']}},
+                        {'message': {'id': '4', 'labelIds': ['INBOX']}}
+                    ]},
+                    {'labelsRemoved': [{'message': {'id': '4'}}]},
+                    {'labelsRemoved': [
+                        {'message': {'id': '4', 'labelIds': []}}
+                    ]}
+                ],
+                'nextPageToken': 'page-2',
+                'historyId': '110'
+            },
+            {
+                'history': [
+                    {'messagesDeleted': [{'message': {'id': '1'}}]},
+                    {'labelsRemoved': [{'message': {'id': '1'}}]}
+                ],
+                'historyId': '120'
+            }
+        ]
+        changes = self.gmail_client.list_history('100')
+        self.assertListEqual(sorted(changes.pop('labels_changed')), ['3', '4'])
+        self.assertDictEqual(changes, {
+            'history_id': '120',
+            'added': ['2'],
+            'deleted': ['1'],
+            'labels': {'4': []}
+        })
+
+        history.list().execute.side_effect = http_error(404)
+        self.assertRaises(
+            HistoryExpired, self.gmail_client.list_history, '1')
+
+    @patch("gmail_cli.api_client.GmailClient.get_service")
+    def test_list_mailboxes(self, mock_get_service):
+        labels = mock_get_service.return_value.users().labels()
+        labels.list().execute.return_value = {
+            'labels': [{'id': 'INBOX', 'name': 'INBOX'}]}
+        self.assertListEqual(
+            self.gmail_client.list_mailboxes(),
+            [{'id': 'INBOX', 'name': 'INBOX'}]
+        )
+
+        labels.list().execute.side_effect = http_error(404)
+        self.assertRaises(HttpError, self.gmail_client.list_mailboxes)
+
+    @patch("gmail_cli.api_client.build")
+    @patch("gmail_cli.api_client.GmailClient.authenticate")
+    def test_service_per_thread(self, mock_authenticate, mock_build):
+        mock_authenticate.return_value = MagicMock(refresh_token=None)
+        mock_build.side_effect = lambda *args, **kwargs: MagicMock()
+
+        services = []
+        thread = threading.Thread(
+            target=lambda: services.append(self.gmail_client.get_service()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(services[0], self.gmail_client.get_service())
+        self.assertIs(
+            self.gmail_client.get_service(), self.gmail_client.get_service())
+        mock_authenticate.assert_called_once()
+
+    @patch("gmail_cli.api_client.GMAIL_BATCH_SIZE", 2)
+    @patch("gmail_cli.api_client.GmailClient.get_emails_from_messages")
+    def test_hydrate_pages_concurrently(self, mock_get_emails):
+        def get_emails_from_messages(messages, message_format):
+            time.sleep(random.random() / 100)
+            return [message['id'] for message in messages]
+
+        mock_get_emails.side_effect = get_emails_from_messages
+        pages = [
+            [{'id': str(index)} for index in range(start, start + 5)]
+            for start in range(0, 50, 5)
+        ]
+        self.gmail_client.workers = 4
+        emails = [
+            email
+            for page_emails in self.gmail_client.hydrate_pages(iter(pages))
+            for email in page_emails
+        ]
+        self.assertListEqual(emails, [str(index) for index in range(50)])
+        self.assertEqual(mock_get_emails.call_count, 30)
@@ -0,0 +1,141 @@
+import asyncio
+
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import patch
+
+from gmail_cli.api_client import GmailClient
+from gmail_cli.async_client import AsyncGmailClient
+from gmail_cli.automate import EmailAutomation
+from gmail_cli.exceptions import HistoryExpired
+from gmail_cli.fake_server import FakeGmailServer
+from gmail_cli.rate_limit import AsyncRequestScheduler
+
+
+def fast_scheduler(quota_per_second, max_concurrency):
+    return AsyncRequestScheduler(
+        quota_per_second=10 ** 6,
+        max_concurrency=max_concurrency,
+        max_retries=10,
+        base_delay=0.01,
+        max_delay=0.05
+    )
+
+
+@patch("gmail_cli.async_client.AsyncRequestScheduler", fast_scheduler)
+class TestAsyncGmailClient(TestCase):
+    def setUp(self) -> None:
+        self.server = FakeGmailServer(
+            labels=['movies', 'refer', 'archive'], seed=1).start()
+        self.message_ids = self.server.populate(120)
+        self.gmail_client = GmailClient(api_endpoint=self.server.url)
+
+    def tearDown(self) -> None:
+        self.server.stop()
+
+    def run_with_client(self, coroutine_function, concurrency=20):
+        async def run():
+            async with AsyncGmailClient(
+                self.gmail_client, concurrency
+            ) as async_client:
+                return await coroutine_function(async_client)
+
+        return asyncio.run(run())
+
+    def test_fetch_emails(self):
+        emails = self.run_with_client(
+            lambda client: client.fetch_emails(max_results=50))
+        self.assertListEqual(
+            [email['message_id'] for email in emails],
+            self.message_ids[::-1]
+        )
+        self.assertEqual(emails[0]['subject'], 'Message 119')
+        self.assertEqual(self.server.calls['messages.list'], 3)
+
+    @patch("gmail_cli.query.LIST_PARTITION_DAYS", 1)
+    def test_fetch_emails_in_partitions(self):
+        self.gmail_client.partitions = 3
+        emails = self.run_with_client(
+            lambda client: client.fetch_emails(max_results=20))
+        self.assertListEqual(
+            sorted(email['message_id'] for email in emails),
+            self.message_ids
+        )
+
+    def test_fetch_emails_with_errors_and_throttling(self):
+        self.server.error_rate = 0.1
+        self.server.quota_per_second = 300
+        emails = self.run_with_client(lambda client: client.fetch_emails())
+        self.assertEqual(len(emails), 120)
+        self.assertGreater(self.server.throttled, 0)
+
+    def test_modify_and_history(self):
+        async def modify(client):
+            history_id = (await client.get_profile())['historyId']
+            labels = await client.list_mailboxes()
+            label_ids = {label['name']: label['id'] for label in labels}
+            results = [
+                await client.batch_modify(
+                    self.message_ids[:2], [label_ids['refer']], ['UNREAD']),
+                await client.mark_as_unread(self.message_ids[2]),
+                await client.mark_as_read(self.message_ids[3]),
+                await client.batch_modify(['1'], ['Missing'])
+            ]
+            return history_id, results, await client.list_history(history_id)
+
+        history_id, results, changes = self.run_with_client(modify)
+        self.assertListEqual(results, [True, True, True, False])
+        self.assertListEqual(
+            sorted(changes['labels_changed']),
+            self.message_ids[:2] + self.message_ids[3:4]
+        )
+        self.assertIn('Label_2', self.server.messages[self.message_ids[0]][
+            'label_ids'])
+
+        self.server.expire_history()
+        self.assertRaises(
+            HistoryExpired,
+            self.run_with_client,
+            lambda client: client.list_history(history_id)
+        )
+
+    def test_run_async(self):
+        now = datetime.now(timezone.utc)
+        old_id = self.server.add_message(
+            'abc@abc.com', 'me@example.com', 'Old',
+            date=now - timedelta(days=9)
+        )
+        new_id = self.server.add_message(
+            'Abc <abc@abc.com>', 'me@example.com', 'your code always')
+
+        automation = EmailAutomation(
+            "samples/automate_1.json",
+            db_path="test.db",
+            table_name="emails"
+        )
+        automation.db_helper.create_emails_table(remove_existing=True)
+        automation.gmail_client.api_endpoint = self.server.url
+        asyncio.run(automation.run_async(force_retrieve=True))
+
+        self.assertEqual(
+            len(automation.db_helper.fetch_message_ids()), 122)
+        self.assertListEqual(
+            self.server.messages[new_id]['label_ids'], ['INBOX', 'Label_1'])
+        self.assertListEqual(
+            self.server.messages[old_id]['label_ids'],
+            ['INBOX', 'UNREAD', 'Label_3']
+        )
+
+
+class TestAsyncGmailClientQuota(TestCase):
+    def test_quota_per_second(self):
+        async def get_quota(gmail_client):
+            async with AsyncGmailClient(gmail_client) as async_client:
+                return async_client.scheduler.quota_per_second
+
+        self.assertEqual(
+            asyncio.run(get_quota(GmailClient(quota_per_second=1000))), 1000)
+        self.assertEqual(
+            asyncio.run(get_quota(GmailClient())),
+            GmailClient().scheduler.quota_per_second
+        )
@@ -1,10 +1,12 @@
 import pytz
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import call, patch
 
 from gmail_cli.automate import EmailAutomation
+from gmail_cli.fake_server import FakeGmailServer
 from gmail_cli.settings import TIME_ZONE
 
 
@@ -22,9 +24,18 @@ class TestAutomate(TestCase):
         emails = self.automate_1.retrieve_emails()
         self.assertListEqual(emails, [])
 
-    @patch("gmail_cli.automate.GmailClient.fetch_emails")
-    def test_retrieve_emails_with_force(self, mock_fetch_emails):
+    @patch("gmail_cli.automate.GmailClient.get_emails_from_messages")
+    @patch("gmail_cli.automate.GmailClient.list_message_pages")
+    @patch("gmail_cli.automate.GmailClient.get_profile")
+    def test_retrieve_emails_with_force(
+        self,
+        mock_get_profile,
+        mock_list_message_pages,
+        mock_fetch_emails
+    ):
         self.automate_1.db_helper.create_emails_table(remove_existing=True)
+        mock_get_profile.return_value = {'historyId': '100'}
+        mock_list_message_pages.return_value = [([{'id': '1'}], None)]
         mock_fetch_emails.return_value = [
             {
                 'message_id': '1',
@@ -52,6 +63,143 @@ class TestAutomate(TestCase):
         ]
         self.assertListEqual(emails, expected_emails)
 
+    @patch("gmail_cli.automate.GmailClient.batch_modify")
+    @patch("gmail_cli.automate.GmailClient.get_emails_from_messages")
+    @patch("gmail_cli.automate.GmailClient.list_message_pages")
+    @patch("gmail_cli.automate.GmailClient.list_mailboxes")
+    def test_run_with_search(
+        self,
+        mock_list_mailboxes,
+        mock_list_message_pages,
+        mock_fetch_emails,
+        mock_batch_modify
+    ):
+        self.automate_1.db_helper.create_emails_table(remove_existing=True)
+        mock_list_mailboxes.return_value = [
+            {'id': f'Label_{name}', 'name': name}
+            for name in ('movies', 'refer', 'archive')
+        ]
+        mock_list_message_pages.return_value = [
+            ([{'id': '1'}, {'id': '2'}], None)
+        ]
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        mock_fetch_emails.return_value = [
+            {
+                'message_id': '1',
+                'subject': 'Refer a friend',
+                'snippet': 'Test Snippet',
+                'date': format_datetime(now - timedelta(days=1)),
+                'to': 'Maria <maria@maria.com>',
+                'from': 'abc <abc@abc.com>'
+            },
+            {
+                'message_id': '2',
+                'subject': 'your code always wins',
+                'snippet': 'Test Snippet',
+                'date': format_datetime(now - timedelta(days=10)),
+                'to': 'Maria <maria@maria.com>',
+                'from': 'xyz@xyz.com'
+            }
+        ]
+        self.automate_1.run(search=True)
+
+        queries = [
+            kwargs['query']
+            for _, kwargs in mock_list_message_pages.call_args_list
+        ]
+        # Rules with contains conditions are evaluated on the database,
+        # which the first search filled after Rule 1 had run
+        self.assertListEqual(queries, [
+            '{from:"abc@abc.com"}',
+            '{newer_than:2d}',
+            '{older_than:2d}'
+        ])
+        mock_fetch_emails.assert_called_once()
+        self.assertListEqual(mock_batch_modify.call_args_list, [
+            call(
+                ['1'],
+                add_label_ids=['Label_refer'],
+                remove_label_ids=['UNREAD']
+            ),
+            call(
+                ['2'],
+                add_label_ids=['Label_archive'],
+                remove_label_ids=[]
+            )
+        ])
+
+    @patch("gmail_cli.automate.GmailClient.get_message_bodies")
+    def test_body_condition_fetches_bodies_lazily(self, mock_get_bodies):
+        self.automate_1.db_helper.create_emails_table(remove_existing=True)
+        self.automate_1.db_helper.save_bodies({'2': 'Your invoice is ready'})
+        mock_get_bodies.side_effect = lambda message_ids: {
+            message_id: f'Body of {message_id} with invoice'
+            for message_id in message_ids if message_id != '4'
+        }
+        emails = [
+            {'message_id': str(index), 'subject': subject}
+            for index, subject in enumerate(
+                ['Hello', 'Invoice', 'Invoice', 'Invoice'], 1)
+        ]
+        rule = {
+            'predicate': 'all',
+            'conditions': [
+                {'field': 'body', 'operator': 'contains', 'value': 'invoice'},
+                {'field': 'subject', 'operator': 'eq', 'value': 'Invoice'}
+            ],
+            'actions': [{'action': 'mark_as_read'}]
+        }
+        self.automate_1.apply_rule(rule, emails)
+
+        mock_get_bodies.assert_called_once_with(['3', '4'])
+        self.assertNotIn('body', emails[0])
+        self.assertEqual(emails[1]['body'], 'Your invoice is ready')
+        self.assertEqual(emails[3]['body'], '')
+        self.assertListEqual(
+            list(self.automate_1.action_executor.label_changes), ['2', '3'])
+        self.assertDictEqual(
+            self.automate_1.db_helper.fetch_bodies(['1', '2', '3', '4']),
+            {'2': 'Your invoice is ready', '3': 'Body of 3 with invoice'}
+        )
+
+        rule['predicate'] = 'any'
+        emails = [email for email in emails if email['message_id'] != '2']
+        emails[0].pop('body', None)
+        emails[1].pop('body')
+        self.automate_1.apply_rule(rule, emails)
+        mock_get_bodies.assert_called_with(['1'])
+
+    def test_run_after_history_expires(self):
+        server = FakeGmailServer(
+            labels=['movies', 'refer', 'archive'], seed=1).start()
+        self.addCleanup(server.stop)
+        message_id = server.add_message(
+            'Abc <abc@abc.com>', 'me@example.com', 'your code always')
+        self.automate_1.db_helper.create_emails_table(remove_existing=True)
+        self.automate_1.gmail_client.api_endpoint = server.url
+
+        self.assertEqual(
+            self.automate_1.run(force_retrieve=True)['modified'], 1)
+        self.assertListEqual(
+            server.messages[message_id]['label_ids'], ['INBOX', 'Label_1'])
+        self.assertEqual(
+            self.automate_1.run(force_retrieve=True)['modified'], 0)
+
+        # Changes made in Gmail while the history expires are not missed
+        self.automate_1.gmail_client.mark_as_unread(message_id)
+        server.expire_history()
+        self.assertEqual(
+            self.automate_1.run(force_retrieve=True)['modified'], 1)
+        self.assertListEqual(
+            server.messages[message_id]['label_ids'], ['INBOX', 'Label_1'])
+
+        # Without a sync the labels in the database are not trusted
+        self.automate_1.gmail_client.mark_as_unread(message_id)
+        self.assertEqual(self.automate_1.run()['modified'], 1)
+        self.assertListEqual(
+            server.messages[message_id]['label_ids'], ['INBOX', 'Label_1'])
+        self.assertEqual(server.calls['messages.batchModify'], 3)
+
     def test_match_string_type(self):
         field_value = 'abc'
         operator_value = 'eq'
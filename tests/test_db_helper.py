@@ -1,9 +1,12 @@
 import pytz
+import sqlite3
+import threading
 
 from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from gmail_cli.db_helper import EmailDBHelper
+from gmail_cli.db_helper import EmailDBHelper, parse_email_date
 from gmail_cli.settings import TIME_ZONE
 from gmail_cli.exceptions import DoesNotExist
 
@@ -15,6 +18,27 @@ class TestDBHelper(TestCase):
     def test_db_instance(self):
         self.assertIsNotNone(self.db_helper.get_db_instance())
 
+    def test_connection_per_thread(self):
+        conn = self.db_helper.get_db_instance()
+        self.assertIs(self.db_helper.get_db_instance(), conn)
+        self.assertEqual(
+            conn.execute('PRAGMA journal_mode').fetchone(), ('wal',))
+        self.assertEqual(
+            conn.execute('PRAGMA synchronous').fetchone(), (1,))
+
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(
+                self.db_helper.get_db_instance()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], conn)
+
+        with self.db_helper:
+            self.db_helper.fetch_message_ids()
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute, 'SELECT 1')
+        self.assertIsNot(self.db_helper.get_db_instance(), conn)
+
     def test_create_table(self):
         table_structure = [
             (0, 'message_id', 'TEXT', 0, None, 1),
@@ -22,10 +46,150 @@ class TestDBHelper(TestCase):
             (2, 'snippet', 'TEXT', 0, None, 0),
             (3, 'date', 'TEXT', 0, None, 0),
             (4, 'recipient', 'TEXT', 0, None, 0),
-            (5, 'sender', 'TEXT', 0, None, 0)
+            (5, 'sender', 'TEXT', 0, None, 0),
+            (6, 'date_epoch', 'INTEGER', 0, None, 0),
+            (7, 'sender_address', 'TEXT', 0, None, 0),
+            (8, 'recipient_address', 'TEXT', 0, None, 0),
+            (9, 'labels_known', 'INTEGER', 0, None, 0)
         ]
         self.assertEqual(self.db_helper.create_emails_table(), table_structure)
 
+    def test_derived_fields_backfill(self):
+        self.db_helper.create_emails_table(remove_existing=True)
+        conn = self.db_helper.get_db_instance()
+        conn.executescript('''
+            DROP TABLE emails_schema_version;
+            DROP TABLE emails_fts;
+            DROP TABLE emails;
+            CREATE TABLE emails (
+                message_id TEXT PRIMARY KEY,
+                subject TEXT,
+                snippet TEXT,
+                date TEXT,
+                recipient TEXT,
+                sender TEXT
+            );
+            INSERT INTO emails VALUES
+                ('1', 'Old', '', 'Thu, 01 Jul 2021 05:30:00 +0530',
+                 'Maria <maria@maria.com>', 'abc@abc.com'),
+                ('2', 'Bad', '', 'invalid', '', '');
+        ''')
+
+        db_helper = EmailDBHelper("test.db", "emails")
+        self.assertListEqual(
+            [column[1] for column in db_helper.create_emails_table()[6:]],
+            [
+                'date_epoch',
+                'sender_address',
+                'recipient_address',
+                'labels_known'
+            ]
+        )
+        self.assertListEqual(
+            conn.execute(
+                '''SELECT message_id, date_epoch, sender_address,
+                recipient_address FROM emails ORDER BY 1'''
+            ).fetchall(),
+            [
+                ('1', 1625097600, 'abc@abc.com', 'maria@maria.com'),
+                ('2', None, None, None)
+            ]
+        )
+        self.assertListEqual(
+            [email['message_id'] for email in
+             db_helper.fetch_emails_from_table()],
+            ['1']
+        )
+        self.assertListEqual(
+            [email['message_id'] for email in db_helper.search_emails('old')],
+            ['1']
+        )
+        self.assertIn(
+            ('emails_date_epoch',),
+            conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            ).fetchall()
+        )
+
+    def test_migrate(self):
+        self.db_helper.create_emails_table(remove_existing=True)
+        self.assertEqual(self.db_helper.schema_version(), 4)
+        conn = self.db_helper.get_db_instance()
+        conn.executescript('''
+            DROP TABLE emails_fts;
+            DROP TABLE emails;
+            DELETE FROM emails_schema_version WHERE version > 1;
+            CREATE TABLE emails (
+                message_id TEXT PRIMARY KEY,
+                subject TEXT,
+                snippet TEXT,
+                date TEXT,
+                recipient TEXT,
+                sender TEXT
+            );
+            INSERT INTO emails VALUES
+                ('1', 'Kept', '', 'Thu, 01 Jul 2021 05:30:00 +0530',
+                 'Maria <maria@maria.com>', 'abc@abc.com');
+            INSERT INTO emails_sync_state VALUES ('history_id', '42');
+        ''')
+
+        db_helper = EmailDBHelper("test.db", "emails")
+        self.assertEqual(db_helper.migrate(), 4)
+        self.assertListEqual(
+            [
+                version for version, in conn.execute(
+                    'SELECT version FROM emails_schema_version ORDER BY 1')
+            ],
+            [1, 2, 3, 4]
+        )
+        self.assertListEqual(
+            [
+                (email['message_id'], email['date'].timestamp())
+                for email in db_helper.search_emails('kept')
+            ],
+            [('1', 1625097600)]
+        )
+        self.assertEqual(
+            conn.execute('SELECT value FROM emails_sync_state').fetchone(),
+            ('42',)
+        )
+
+        with patch.object(
+            EmailDBHelper, '_create_base_tables'
+        ) as create_base_tables:
+            self.assertEqual(EmailDBHelper("test.db", "emails").migrate(), 4)
+        create_base_tables.assert_not_called()
+
+    def test_full_text_index_recovered(self):
+        with patch.dict(
+            "gmail_cli.db_helper.EMAIL_QUERIES",
+            {'CREATE_FTS_TABLE': 'CREATE VIRTUAL TABLE x USING missing()'}
+        ):
+            db_helper = EmailDBHelper("test.db", "emails")
+            db_helper.create_emails_table(remove_existing=True)
+        self.assertFalse(db_helper.has_full_text_index())
+        self.assertEqual(db_helper.schema_version(), 4)
+        db_helper.insert_emails_into_table([
+            {
+                'message_id': '1',
+                'subject': 'Test Subject',
+                'snippet': 'Test Snippet',
+                'date': 'Thu, 01 Jul 2021 00:00:00 +0000',
+                'to': 'Maria <maria@maria.com>',
+                'from': 'leo@mv3@gmail.com'
+            }
+        ])
+
+        db_helper = EmailDBHelper("test.db", "emails")
+        db_helper.create_emails_table()
+        self.assertTrue(db_helper.has_full_text_index())
+        self.assertEqual(
+            db_helper.get_db_instance().execute(
+                "SELECT rowid FROM emails_fts WHERE emails_fts MATCH 'subj'"
+            ).fetchall(),
+            [(1,)]
+        )
+
     def test_insert_emails(self):
         self.db_helper.create_emails_table(remove_existing=True)
         emails_1 = [
@@ -67,6 +231,143 @@ class TestDBHelper(TestCase):
         ]
         self.assertListEqual(emails, expected_emails_data)
 
+    def test_parse_email_date(self):
+        for date_str in [
+            'Thu, 01 Jul 2021 00:00:00 +0000',
+            'Thu, 1 Jul 2021 10:00:00 -0530 (EST)',
+            'thu, 01 jul 2021 00:00:00 +05:30'
+        ]:
+            self.assertEqual(
+                parse_email_date(date_str),
+                datetime.strptime(
+                    date_str.split('(')[0].strip(),
+                    "%a, %d %b %Y %H:%M:%S %z"
+                )
+            )
+
+        for date_str in [
+            '',
+            '2021-07-01',
+            'Thu, 32 Jul 2021 00:00:00 +0000',
+            'Thu, 01 Jul 2021 00:00:00 GMT'
+        ]:
+            self.assertRaises(ValueError, parse_email_date, date_str)
+
+    @patch("gmail_cli.db_helper.INSERT_CHUNK_SIZE", 2)
+    def test_bulk_insert(self):
+        self.db_helper.create_emails_table(remove_existing=True)
+        emails = (
+            {
+                'message_id': str(index % 4),
+                'subject': f'Subject {index}',
+                'snippet': 'Test Snippet',
+                'date': 'invalid' if index == 1 else
+                'Thu, 01 Jul 2021 00:00:00 +0000',
+                'to': 'Maria <maria@maria.com>',
+                'from': 'leo@mv3@gmail.com'
+            }
+            for index in range(7)
+        )
+        self.db_helper.insert_emails_into_table(emails)
+        self.assertListEqual(
+            sorted(
+                (email['message_id'], email['subject'])
+                for email in self.db_helper.fetch_emails_from_table()
+            ),
+            [
+                ('0', 'Subject 0'),
+                ('1', 'Subject 5'),
+                ('2', 'Subject 2'),
+                ('3', 'Subject 3')
+            ]
+        )
+
+    def test_insert_holds_write_lock(self):
+        self.db_helper.create_emails_table(remove_existing=True)
+
+        def emails():
+            # Another writer can't add rows once the largest rowid is read
+            conn = sqlite3.connect("test.db", timeout=0)
+            self.assertRaises(
+                sqlite3.OperationalError, conn.execute,
+                "INSERT INTO emails (message_id) VALUES ('2')")
+            conn.close()
+            yield {
+                'message_id': '1',
+                'subject': 'Test Subject',
+                'snippet': 'Test Snippet',
+                'date': 'Thu, 01 Jul 2021 00:00:00 +0000',
+                'to': 'Maria <maria@maria.com>',
+                'from': 'leo@mv3@gmail.com'
+            }
+
+        self.db_helper.insert_emails_into_table(emails())
+        self.assertListEqual(
+            [email['message_id'] for email in
+             self.db_helper.search_emails('subject')],
+            ['1']
+        )
+
+    def test_iter_emails(self):
+        self.db_helper.create_emails_table(remove_existing=True)
+        self.db_helper.insert_emails_into_table([
+            {
+                'message_id': f'{index:02}',
+                'subject': f'Subject {index}',
+                'snippet': 'Test Snippet',
+                'date': 'invalid' if index == 3 else
+                f'Thu, 01 Jul 2021 00:00:00 +00{9 - index % 5:02}',
+                'to': 'Maria <maria@maria.com>',
+                'from': 'leo@mv3@gmail.com'
+            }
+            for index in range(10)
+        ])
+
+        emails = list(self.db_helper.iter_emails(arraysize=2))
+        self.assertListEqual(
+            emails, self.db_helper.fetch_emails_from_table())
+        self.assertListEqual(
+            [email['message_id'] for email in emails],
+            ['00', '01', '02', '04', '05', '06', '07', '08', '09']
+        )
+
+        message_ids = []
+        after = None
+        while page := list(self.db_helper.iter_emails(
+            ['message_id'], after=after, limit=4
+        )):
+            message_ids.extend(email['message_id'] for email in page)
+            after = page[-1]['message_id']
+        self.assertListEqual(
+            message_ids, [email['message_id'] for email in emails])
+
+        emails = []
+        after = None
+        while page := list(self.db_helper.iter_emails(
+            ['date', 'message_id'], order_by='date', after=after, limit=2
+        )):
+            emails.extend(page)
+            after = (page[-1]['date'], page[-1]['message_id'])
+        self.assertListEqual(
+            [email['message_id'] for email in emails],
+            ['00', '05', '01', '06', '02', '07', '08', '04', '09']
+        )
+        self.assertListEqual(list(emails[0]), ['date', 'message_id'])
+
+        self.assertListEqual(
+            [
+                email['message_id'] for email in self.db_helper.iter_emails(
+                    where='subject = ? OR subject = ?',
+                    params=['Subject 3', 'Subject 8']
+                )
+            ],
+            ['08']
+        )
+        self.assertRaises(
+            ValueError, list, self.db_helper.iter_emails(['body']))
+        self.assertRaises(
+            ValueError, list, self.db_helper.iter_emails(order_by='subject'))
+
     def test_fetch_email(self):
         self.db_helper.create_emails_table(remove_existing=True)
         emails = self.db_helper.fetch_emails_from_table()
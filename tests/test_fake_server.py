@@ -0,0 +1,125 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from googleapiclient.errors import HttpError
+
+from gmail_cli.api_client import GmailClient
+from gmail_cli.db_helper import EmailDBHelper
+from gmail_cli.exceptions import HistoryExpired
+from gmail_cli.fake_server import FakeGmailServer
+from gmail_cli.rate_limit import RequestScheduler
+from gmail_cli.sync import EmailSync
+
+
+class TestFakeGmailServer(TestCase):
+    def setUp(self) -> None:
+        self.server = FakeGmailServer(labels=['Work'], seed=1).start()
+        self.message_ids = self.server.populate(150)
+        self.gmail_client = GmailClient(api_endpoint=self.server.url)
+        self.gmail_client.scheduler = RequestScheduler(
+            quota_per_second=10 ** 6,
+            max_concurrency=8,
+            max_retries=10,
+            base_delay=0.01,
+            max_delay=0.05
+        )
+
+    def tearDown(self) -> None:
+        self.gmail_client.close()
+        self.server.stop()
+
+    def test_fetch_emails(self):
+        self.gmail_client.workers = 4
+        emails = self.gmail_client.fetch_emails(max_results=40)
+        self.assertListEqual(
+            [email['message_id'] for email in emails],
+            self.message_ids[::-1]
+        )
+        self.assertEqual(emails[0]['subject'], 'Message 149')
+        self.assertEqual(self.server.calls['messages.list'], 4)
+        self.assertEqual(self.server.calls['messages.get'], 150)
+
+    @patch("gmail_cli.query.LIST_PARTITION_DAYS", 1)
+    def test_fetch_emails_in_partitions(self):
+        self.gmail_client.partitions = 4
+        emails = self.gmail_client.fetch_emails(max_results=20)
+        self.assertListEqual(
+            sorted(email['message_id'] for email in emails),
+            self.message_ids
+        )
+        self.assertGreaterEqual(self.server.calls['messages.list'], 10)
+
+    def test_search(self):
+        pages = list(self.gmail_client.list_message_pages(
+            query='{subject:"Message 14" subject:"Message 9"} newer_than:1d'))
+        self.assertListEqual(
+            [message['id'] for message in pages[0][0]],
+            self.message_ids[149:139:-1]
+        )
+
+    def test_modify_and_history(self):
+        history_id = self.gmail_client.get_profile()['historyId']
+        label_ids = self.gmail_client.label_directory.resolve(['Work'])
+        self.assertTrue(self.gmail_client.batch_modify(
+            self.message_ids[:2], [label_ids['Work']], ['UNREAD']))
+        self.assertTrue(self.gmail_client.mark_as_read(self.message_ids[2]))
+        self.server.delete_message(self.message_ids[0])
+        new_id = self.server.add_message(
+            'abc@abc.com', 'me@example.com', 'New message')
+
+        changes = self.gmail_client.list_history(history_id)
+        self.assertListEqual(changes['added'], [new_id])
+        self.assertListEqual(changes['deleted'], [self.message_ids[0]])
+        self.assertListEqual(
+            sorted(changes['labels_changed']), self.message_ids[1:3])
+        self.assertListEqual(
+            self.server.messages[self.message_ids[1]]['label_ids'],
+            ['INBOX', 'Label_1']
+        )
+
+        self.server.expire_history()
+        self.assertRaises(
+            HistoryExpired, self.gmail_client.list_history, history_id)
+
+    def test_errors_are_retried(self):
+        self.server.error_rate = 0.2
+        self.gmail_client.workers = 4
+        emails = self.gmail_client.fetch_emails()
+        self.assertEqual(len(emails), 150)
+
+    def test_fetch_errors_propagate(self):
+        self.server.error_rate = 1
+        self.gmail_client.scheduler.max_retries = 1
+        self.assertRaises(HttpError, self.gmail_client.fetch_emails)
+
+    def test_quota_throttling(self):
+        self.server.quota_per_second = 500
+        self.gmail_client.workers = 4
+        emails = self.gmail_client.fetch_emails()
+        self.assertEqual(len(emails), 150)
+        self.assertGreater(self.server.throttled, 0)
+
+    @patch("gmail_cli.query.LIST_PARTITION_DAYS", 1)
+    def test_sync(self):
+        self.gmail_client.partitions = 3
+        db_helper = EmailDBHelper("test.db", "emails")
+        db_helper.create_emails_table(remove_existing=True)
+        email_sync = EmailSync(self.gmail_client, db_helper)
+        email_sync.sync()
+        self.assertEqual(len(db_helper.fetch_message_ids()), 150)
+
+        self.server.delete_message(self.message_ids[0])
+        self.server.add_message('abc@abc.com', 'me@example.com', 'New')
+        self.gmail_client.batch_modify(
+            self.message_ids[1:3], remove_label_ids=['UNREAD'])
+        email_sync.sync()
+        self.assertEqual(len(db_helper.fetch_message_ids()), 150)
+        self.assertNotIn(self.message_ids[0], db_helper.fetch_message_ids())
+        self.assertDictEqual(
+            db_helper.fetch_label_states(self.message_ids[1:4]),
+            {
+                self.message_ids[1]: (True, {'INBOX': True}),
+                self.message_ids[2]: (True, {'INBOX': True}),
+                self.message_ids[3]: (True, {'INBOX': True, 'UNREAD': True})
+            }
+        )
@@ -0,0 +1,54 @@
+import time
+
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from gmail_cli.db_helper import EmailDBHelper
+from gmail_cli.labels import LabelDirectory
+
+
+class TestLabelDirectory(TestCase):
+    def setUp(self) -> None:
+        self.db_helper = EmailDBHelper("test.db", "emails")
+        self.db_helper.create_emails_table(remove_existing=True)
+        self.gmail_client = MagicMock()
+        self.gmail_client.list_mailboxes.return_value = [
+            {'id': 'INBOX', 'name': 'INBOX'},
+            {'id': 'Label_1', 'name': 'movies'}
+        ]
+
+    def test_labels_are_cached(self):
+        label_directory = LabelDirectory(self.gmail_client, self.db_helper)
+        self.assertEqual(label_directory.get_label_id('movies'), 'Label_1')
+        self.assertDictEqual(
+            label_directory.resolve(['INBOX', 'movies']),
+            {'INBOX': 'INBOX', 'movies': 'Label_1'}
+        )
+        self.gmail_client.list_mailboxes.assert_called_once()
+
+        # A new directory reads the labels cached in the database
+        label_directory = LabelDirectory(self.gmail_client, self.db_helper)
+        self.assertEqual(label_directory.get_label_id('INBOX'), 'INBOX')
+        self.gmail_client.list_mailboxes.assert_called_once()
+
+    def test_missing_label_forces_refresh(self):
+        label_directory = LabelDirectory(self.gmail_client, self.db_helper)
+        label_directory.get_label_id('movies')
+
+        self.gmail_client.list_mailboxes.return_value.append(
+            {'id': 'Label_2', 'name': 'refer'})
+        self.assertEqual(label_directory.get_label_id('refer'), 'Label_2')
+        self.assertEqual(self.gmail_client.list_mailboxes.call_count, 2)
+
+        self.assertRaises(ValueError, label_directory.get_label_id, 'other')
+        self.assertEqual(self.gmail_client.list_mailboxes.call_count, 3)
+        self.assertDictEqual(label_directory.resolve([]), {})
+        self.assertEqual(self.gmail_client.list_mailboxes.call_count, 3)
+
+    def test_expired_labels_are_refreshed(self):
+        self.db_helper.save_labels(
+            [{'id': 'Label_0', 'name': 'movies'}], time.time() - 7200)
+        label_directory = LabelDirectory(
+            self.gmail_client, self.db_helper, ttl=3600)
+        self.assertEqual(label_directory.get_label_id('movies'), 'Label_1')
+        self.gmail_client.list_mailboxes.assert_called_once()
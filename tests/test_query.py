@@ -0,0 +1,74 @@
+from unittest import TestCase
+
+from gmail_cli.query import (
+    build_condition_query,
+    build_rule_query,
+    partition_queries
+)
+
+
+class TestQuery(TestCase):
+    def test_build_condition_query(self):
+        conditions = [
+            ({"field": "from", "operator": "eq", "value": "abc@abc.com"},
+             'from:"abc@abc.com"'),
+            ({"field": "to", "operator": "eq", "value": " abc@abc.com "},
+             'to:"abc@abc.com"'),
+            ({"field": "subject", "operator": "contains", "value": "Refer"},
+             None),
+            ({"field": "body", "operator": "contains", "value": "invoice"},
+             None),
+            ({"field": "date_received", "operator": "gt", "value": 2},
+             'older_than:2d'),
+            ({"field": "date_received", "operator": "lt", "value": 2},
+             'newer_than:2d'),
+            ({"field": "from", "operator": "neq", "value": "abc@abc.com"},
+             None),
+            ({"field": "from", "operator": "contains", "value": "abc"},
+             None),
+            ({"field": "from", "operator": "eq", "value": 'a "b"'},
+             None),
+            ({"field": "date_received", "operator": "eq",
+              "value": "12-12-2020"}, None)
+        ]
+        for condition, query in conditions:
+            self.assertEqual(build_condition_query(condition), query)
+
+    def test_build_rule_query(self):
+        rule = {
+            "predicate": "all",
+            "conditions": [
+                {"field": "from", "operator": "eq", "value": "abc@abc.com"},
+                {"field": "subject", "operator": "contains", "value": "Refer"},
+                {"field": "date_received", "operator": "gt", "value": 2}
+            ]
+        }
+        self.assertEqual(
+            build_rule_query(rule), 'from:"abc@abc.com" older_than:2d')
+
+        rule["predicate"] = "any"
+        self.assertIsNone(build_rule_query(rule))
+
+        rule["conditions"].pop(1)
+        self.assertEqual(
+            build_rule_query(rule), '{from:"abc@abc.com" older_than:2d}')
+
+        rule = {
+            "predicate": "all",
+            "conditions": [
+                {"field": "from", "operator": "neq", "value": "abc@abc.com"}
+            ]
+        }
+        self.assertIsNone(build_rule_query(rule))
+
+    def test_partition_queries(self):
+        self.assertListEqual(partition_queries(1), [None])
+        self.assertListEqual(
+            partition_queries(4, days=1, now=1000000),
+            [
+                'after:913599',
+                'after:827199 before:913601',
+                'after:740799 before:827201',
+                'before:740801'
+            ]
+        )
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from httplib2 import Response
+from googleapiclient.errors import HttpError
+
+from gmail_cli.rate_limit import (
+    AsyncRequestScheduler,
+    RequestScheduler,
+    is_retryable_error
+)
+
+
+def http_error(status, content=b'{}', headers=None):
+    return HttpError(Response({'status': status, **(headers or {})}), content)
+
+
+class TestRequestScheduler(TestCase):
+    def setUp(self) -> None:
+        self.scheduler = RequestScheduler(
+            quota_per_second=100, max_concurrency=8, max_retries=2)
+
+    def test_is_retryable_error(self):
+        self.assertTrue(is_retryable_error(http_error(429)))
+        self.assertTrue(is_retryable_error(http_error(503)))
+        self.assertTrue(is_retryable_error(http_error(
+            403,
+            b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'
+        )))
+        self.assertFalse(is_retryable_error(http_error(403)))
+        self.assertFalse(is_retryable_error(http_error(404)))
+        self.assertFalse(is_retryable_error(ValueError()))
+
+    @patch("gmail_cli.rate_limit.time.sleep")
+    def test_execute_retries_throttled_requests(self, mock_sleep):
+        request = MagicMock()
+        request.execute.side_effect = [
+            http_error(429, headers={'retry-after': '3'}),
+            http_error(500),
+            {'id': '1'}
+        ]
+        self.assertDictEqual(self.scheduler.execute(request, 5), {'id': '1'})
+        self.assertEqual(request.execute.call_count, 3)
+        self.assertEqual(mock_sleep.call_args_list[0].args, (3.0,))
+        self.assertLessEqual(mock_sleep.call_args_list[1].args[0], 2)
+        self.assertEqual(self.scheduler.concurrency, 2)
+
+        request.execute.side_effect = http_error(429)
+        self.assertRaises(HttpError, self.scheduler.execute, request, 5)
+        self.assertEqual(request.execute.call_count, 6)
+
+        request.execute.side_effect = http_error(400)
+        self.assertRaises(HttpError, self.scheduler.execute, request, 5)
+        self.assertEqual(request.execute.call_count, 7)
+
+    def test_concurrency_adapts(self):
+        self.scheduler.record_throttled()
+        self.scheduler.record_throttled()
+        self.assertEqual(self.scheduler.concurrency, 2)
+        for _ in range(2):
+            self.scheduler.record_success()
+        self.assertEqual(self.scheduler.concurrency, 3)
+        for _ in range(100):
+            self.scheduler.record_success()
+        self.assertEqual(self.scheduler.concurrency, 8)
+
+    def test_acquire_paces_quota(self):
+        start = time.monotonic()
+        self.scheduler.acquire(100)
+        self.assertLess(time.monotonic() - start, 0.05)
+        self.scheduler.acquire(10)
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+class TestAsyncRequestScheduler(TestCase):
+    def test_execute_retries_throttled_requests(self):
+        scheduler = AsyncRequestScheduler(
+            quota_per_second=10 ** 6,
+            max_concurrency=4,
+            max_retries=2,
+            base_delay=0.01
+        )
+        responses = [http_error(503), http_error(429), {'id': '1'}]
+        in_flight = []
+
+        async def send():
+            in_flight.append(scheduler._in_flight)
+            await asyncio.sleep(0)
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.assertDictEqual(
+            asyncio.run(scheduler.execute(send, 5)), {'id': '1'})
+        self.assertListEqual(in_flight, [1, 1, 1])
+        self.assertEqual(scheduler.concurrency, 2)
+
+        async def send_many():
+            return await asyncio.gather(*(
+                scheduler.execute(send, 5) for _ in range(10)))
+
+        responses = [{'id': str(index)} for index in range(10)]
+        asyncio.run(send_many())
+        self.assertEqual(max(in_flight), 4)
+        self.assertEqual(scheduler.concurrency, 4)
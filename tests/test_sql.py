@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest import TestCase
+
+from gmail_cli.automate import EmailAutomation
+from gmail_cli.sql import build_condition_sql, build_rule_sql
+
+
+class TestSQL(TestCase):
+    def setUp(self) -> None:
+        self.automation = EmailAutomation(
+            "samples/automate_1.json",
+            db_path="test.db",
+            table_name="emails"
+        )
+        self.db_helper = self.automation.db_helper
+        self.db_helper.create_emails_table(remove_existing=True)
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        headers = [
+            ('Refer a friend', 'Abc <abc@abc.com>', 'me@me.com', 1),
+            ('  Hello  ', 'xyz@xyz.com', 'Abc <abc@abc.com>', 3),
+            ('refer', 'no address', 'me@me.com', 10),
+            ('\u3000Weekly news\xa0', 'news@abc.com', 'undisclosed', 30)
+        ]
+        self.db_helper.insert_emails_into_table([
+            {
+                'message_id': str(index),
+                'subject': subject,
+                'snippet': '',
+                'date': format_datetime(now - timedelta(days=days)),
+                'to': to,
+                'from': sender
+            }
+            for index, (subject, sender, to, days) in enumerate(headers)
+        ])
+        self.emails = self.db_helper.fetch_emails_from_table()
+        self.day = (now - timedelta(days=3)).astimezone(
+            self.emails[0]['date'].tzinfo).strftime('%d-%m-%Y')
+
+    def test_conditions_match_like_python(self):
+        conditions = [
+            {"field": field, "operator": operator, "value": value}
+            for field in ('from', 'to')
+            for operator in ('eq', 'neq', 'contains', 'ncontains')
+            for value in ('abc@abc.com', ' abc ')
+        ] + [
+            {"field": "subject", "operator": operator, "value": value}
+            for operator in ('eq', 'neq', 'contains', 'ncontains')
+            for value in ('Hello', 'Refer', 'efer ', 'Weekly news')
+        ] + [
+            {"field": "date_received", "operator": operator, "value": value}
+            for operator, value in [
+                ('gt', 2), ('lt', 2), ('gt', 20), ('eq', self.day),
+                ('neq', self.day), ('eq', f'{self.day} 10:00:00')
+            ]
+        ]
+        self.assertTrue(self.db_helper.has_full_text_index())
+        for condition in conditions:
+            for full_text_search in (False, True):
+                where, params = build_condition_sql(
+                    condition, full_text_search=full_text_search)
+                self.assertListEqual(
+                    sorted(self.db_helper.fetch_message_ids_where(
+                        where, params)),
+                    [
+                        email['message_id'] for email in self.emails
+                        if self.automation.match_condition(email, condition)
+                    ],
+                    condition
+                )
+
+    def test_search_emails(self):
+        for text, message_ids in [
+            ('REFER', ['0', '2']),
+            ('ell', ['1']),
+            ('e', ['0', '1', '2', '3']),
+            ('missing', [])
+        ]:
+            self.assertListEqual(
+                sorted(
+                    email['message_id']
+                    for email in self.db_helper.search_emails(text)
+                ),
+                message_ids
+            )
+
+        self.db_helper.delete_emails_from_table(['0'])
+        self.assertListEqual(
+            [
+                email['message_id']
+                for email in self.db_helper.search_emails('refer')
+            ],
+            ['2']
+        )
+
+    def test_build_rule_sql(self):
+        rule = {
+            "predicate": "all",
+            "conditions": [
+                {"field": "subject", "operator": "contains", "value": "efer"},
+                {"field": "body", "operator": "contains", "value": "invoice"},
+                {"field": "date_received", "operator": "gt", "value": 2}
+            ]
+        }
+        where, params, exact = build_rule_sql(rule, now=100000)
+        self.assertEqual(
+            where, '(instr(subject, ?) > 0) AND (date_epoch < ?)')
+        self.assertListEqual(params, ['efer', 100000 - 2 * 86400])
+        self.assertFalse(exact)
+        self.assertListEqual(
+            self.db_helper.fetch_message_ids_where(
+                *build_rule_sql(rule)[:2]),
+            ['2']
+        )
+
+        rule["predicate"] = "any"
+        self.assertIsNone(build_rule_sql(rule))
+
+        rule["conditions"].pop(1)
+        where, params, exact = build_rule_sql(rule)
+        self.assertEqual(
+            where, '(instr(subject, ?) > 0) OR (date_epoch < ?)')
+        self.assertTrue(exact)
+        self.assertListEqual(
+            sorted(self.db_helper.fetch_message_ids_where(where, params)),
+            ['0', '1', '2', '3']
+        )
+        self.assertIsNone(build_rule_sql({
+            "predicate": "all",
+            "conditions": [
+                {"field": "body", "operator": "eq", "value": "invoice"}
+            ]
+        }))
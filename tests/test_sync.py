@@ -0,0 +1,217 @@
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from gmail_cli.db_helper import EmailDBHelper
+from gmail_cli.exceptions import HistoryExpired
+from gmail_cli.sync import AsyncEmailSync, EmailSync
+
+
+def make_email(message_id):
+    return {
+        'message_id': message_id,
+        'subject': f'Subject {message_id}',
+        'snippet': f'Snippet {message_id}',
+        'date': 'Thu, 01 Jul 2021 00:00:00 +0000',
+        'to': 'Maria <maria@maria.com>',
+        'from': 'abc@abc.com',
+        'label_ids': ['INBOX', 'UNREAD']
+    }
+
+
+def get_emails_from_messages(messages):
+    return [make_email(message['id']) for message in messages]
+
+
+class TestEmailSync(TestCase):
+    def setUp(self) -> None:
+        self.db_helper = EmailDBHelper("test.db", "emails")
+        self.db_helper.create_emails_table(remove_existing=True)
+        self.gmail_client = MagicMock(partitions=1)
+        self.gmail_client.get_emails_from_messages.side_effect = (
+            get_emails_from_messages)
+        self.gmail_client.hydrate_pages.side_effect = lambda pages: (
+            self.gmail_client.get_emails_from_messages(messages)
+            if messages else []
+            for messages in pages
+        )
+        self.email_sync = EmailSync(self.gmail_client, self.db_helper)
+
+    def get_message_ids(self):
+        return sorted(
+            email['message_id']
+            for email in self.db_helper.fetch_emails_from_table()
+        )
+
+    def test_full_sync(self):
+        self.gmail_client.get_profile.return_value = {'historyId': '100'}
+        self.gmail_client.list_message_pages.return_value = [
+            ([{'id': '1'}, {'id': '2'}], 'page-2'),
+            ([{'id': '3'}], None)
+        ]
+        self.email_sync.sync()
+        self.assertListEqual(self.get_message_ids(), ['1', '2', '3'])
+        self.assertEqual(self.db_helper.get_sync_state('history_id'), '100')
+        self.gmail_client.list_history.assert_not_called()
+
+    def test_full_sync_skips_known_emails(self):
+        self.db_helper.insert_emails_into_table(
+            [make_email('1'), make_email('3')])
+        self.gmail_client.get_profile.return_value = {'historyId': '100'}
+        self.gmail_client.list_message_pages.return_value = [
+            ([{'id': '1'}, {'id': '2'}], 'page-2'),
+            ([{'id': '3'}], None)
+        ]
+        self.email_sync.full_sync()
+        self.gmail_client.get_emails_from_messages.assert_called_once_with(
+            [{'id': '2'}])
+        self.assertListEqual(self.get_message_ids(), ['1', '2', '3'])
+
+    @patch("gmail_cli.sync.SYNC_COMMIT_SIZE", 3)
+    def test_full_sync_resumes_from_checkpoint(self):
+        def list_message_pages(page_token=None):
+            yield [{'id': '1'}, {'id': '2'}], 'page-2'
+            yield [{'id': '3'}, {'id': '4'}], 'page-3'
+            yield [{'id': '5'}], 'page-4'
+            raise ConnectionError('Connection lost')
+
+        self.gmail_client.get_profile.return_value = {'historyId': '100'}
+        self.gmail_client.list_message_pages.side_effect = list_message_pages
+        self.assertRaises(ConnectionError, self.email_sync.sync)
+        self.assertListEqual(
+            self.get_message_ids(), ['1', '2', '3', '4', '5'])
+        self.assertIsNone(self.db_helper.get_sync_state('history_id'))
+        checkpoint = self.db_helper.get_sync_checkpoint('full_sync')
+        self.assertEqual(checkpoint['page_token'], 'page-4')
+        self.assertEqual(checkpoint['history_id'], '100')
+        self.assertEqual(checkpoint['pages'], 3)
+        self.assertEqual(checkpoint['messages'], 5)
+
+        self.gmail_client.get_profile.return_value = {'historyId': '200'}
+        self.gmail_client.list_message_pages.side_effect = None
+        self.gmail_client.list_message_pages.return_value = [
+            ([{'id': '6'}], None)
+        ]
+        self.email_sync.sync()
+        self.gmail_client.list_message_pages.assert_called_with(
+            page_token='page-4')
+        self.assertListEqual(
+            self.get_message_ids(), ['1', '2', '3', '4', '5', '6'])
+        self.assertEqual(self.db_helper.get_sync_state('history_id'), '100')
+        self.assertIsNone(self.db_helper.get_sync_checkpoint('full_sync'))
+
+    def test_incremental_sync(self):
+        self.db_helper.insert_emails_into_table(
+            [make_email('1'), make_email('2')])
+        self.db_helper.set_sync_state('history_id', '100')
+        self.gmail_client.list_history.return_value = {
+            'history_id': '120',
+            'added': ['3'],
+            'deleted': ['1'],
+            'labels_changed': ['2', '3'],
+            'labels': {'2': ['Label_1']}
+        }
+        self.db_helper.set_message_labels({'2': ['INBOX', 'UNREAD']})
+        self.email_sync.sync()
+        self.gmail_client.list_history.assert_called_once_with('100')
+        self.gmail_client.list_message_pages.assert_not_called()
+        self.gmail_client.get_emails_from_messages.assert_called_with(
+            [{'id': '3'}])
+        self.assertListEqual(self.get_message_ids(), ['2', '3'])
+        self.assertDictEqual(
+            self.db_helper.fetch_label_states(['1', '2', '3']),
+            {
+                '2': (True, {'Label_1': True}),
+                '3': (True, {'INBOX': True, 'UNREAD': True})
+            }
+        )
+        self.assertEqual(self.db_helper.get_sync_state('history_id'), '120')
+
+    @patch("gmail_cli.sync.SYNC_COMMIT_SIZE", 2)
+    def test_incremental_sync_commits_in_batches(self):
+        changes = {
+            'history_id': '120',
+            'added': ['1', '2', '3', '4', '5'],
+            'deleted': [],
+            'labels_changed': [],
+            'labels': {}
+        }
+        self.gmail_client.list_history.return_value = changes
+        async_client = MagicMock(
+            list_history=AsyncMock(return_value=changes),
+            get_emails_from_messages=AsyncMock(
+                side_effect=get_emails_from_messages)
+        )
+
+        for run_sync in [
+            self.email_sync.sync,
+            lambda: asyncio.run(
+                AsyncEmailSync(async_client, self.db_helper).sync())
+        ]:
+            self.db_helper.delete_emails_from_table(self.get_message_ids())
+            self.db_helper.set_sync_state('history_id', '100')
+            with patch.object(
+                self.db_helper, 'insert_emails_into_table',
+                wraps=self.db_helper.insert_emails_into_table
+            ) as insert_emails:
+                run_sync()
+            self.assertListEqual(
+                [len(call.args[0]) for call in insert_emails.call_args_list],
+                [2, 2, 1]
+            )
+            self.assertListEqual(
+                self.get_message_ids(), ['1', '2', '3', '4', '5'])
+
+    def test_expired_history_falls_back_to_full_sync(self):
+        self.db_helper.set_sync_state('history_id', '1')
+        self.gmail_client.list_history.side_effect = HistoryExpired()
+        self.gmail_client.get_profile.return_value = {'historyId': '100'}
+        self.gmail_client.list_message_pages.return_value = [
+            ([{'id': '1'}], None)
+        ]
+        self.email_sync.sync()
+        self.assertListEqual(self.get_message_ids(), ['1'])
+        self.assertEqual(self.db_helper.get_sync_state('history_id'), '100')
+
+    def test_drop_table_resets_sync_state(self):
+        self.db_helper.set_sync_state('history_id', '100')
+        self.db_helper.create_emails_table(remove_existing=True)
+        self.assertIsNone(self.db_helper.get_sync_state('history_id'))
+
+    @patch("gmail_cli.sync.partition_queries")
+    def test_partitioned_full_sync_resumes_each_partition(
+        self, mock_partition_queries
+    ):
+        mock_partition_queries.return_value = ['after:10', 'before:11']
+        self.gmail_client.partitions = 2
+
+        def list_partition_pages(queries, page_tokens):
+            yield 'after:10', [{'id': '1'}], 'new-2'
+            yield 'before:11', [{'id': '2'}], 'old-2'
+            yield 'after:10', [{'id': '3'}], None
+            raise ConnectionError('Connection lost')
+
+        self.gmail_client.get_profile.return_value = {'historyId': '100'}
+        self.gmail_client.list_partition_pages.side_effect = (
+            list_partition_pages)
+        self.assertRaises(ConnectionError, self.email_sync.sync)
+        self.assertListEqual(self.get_message_ids(), ['1', '2', '3'])
+        checkpoints = self.db_helper.get_sync_checkpoints('full_sync:')
+        self.assertListEqual(list(checkpoints), ['full_sync:before:11'])
+        self.assertEqual(checkpoints['full_sync:before:11']['page_token'],
+                         'old-2')
+        checkpoint = self.db_helper.get_sync_checkpoint('full_sync')
+        self.assertEqual(checkpoint['pages'], 3)
+
+        self.gmail_client.list_partition_pages.side_effect = None
+        self.gmail_client.list_partition_pages.return_value = [
+            ('before:11', [{'id': '4'}], None)
+        ]
+        self.email_sync.sync()
+        self.gmail_client.list_partition_pages.assert_called_with(
+            ['before:11'], {'before:11': 'old-2'})
+        self.assertListEqual(self.get_message_ids(), ['1', '2', '3', '4'])
+        self.assertEqual(self.db_helper.get_sync_state('history_id'), '100')
+        self.assertDictEqual(
+            self.db_helper.get_sync_checkpoints('full_sync'), {})
@@ -132,6 +132,18 @@ class TestAutomationValidationTestCase(TestCase):
             "value": "test"
         }
         self.assertDictEqual(self.validator_1.validate_condition(condition_1), condition_1)
+        condition_1 = {
+            "field": "body",
+            "operator": "ncontains",
+            "value": "test"
+        }
+        self.assertDictEqual(self.validator_1.validate_condition(condition_1), condition_1)
+        condition_1 = {
+            "field": "body",
+            "operator": "gt",
+            "value": "test"
+        }
+        self.assertRaises(ValidationError, self.validator_1.validate_condition, condition_1)
         condition_1 = {
             "field": "invalid",
             "operator": "contains",